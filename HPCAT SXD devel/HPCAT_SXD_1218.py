@@ -10,13 +10,44 @@ from Tkinter import *
 import tkMessageBox
 import tkFileDialog
 import tkFont
-from epics import *
-from epics.devices import Struck
 import time
 import os.path
-from math import cos, sin, radians, pi, sqrt
-import ftplib
-import XPS_Q8_drivers
+import numpy
+from collections import OrderedDict
+from contextlib import contextmanager
+if os.environ.get('SXD_BACKEND') == 'sim':
+    # simulated motors, scaler, detector and XPS (see SXD_sim)
+    from SXD_sim import SimBeamline
+    sim = SimBeamline(speedup=float(os.environ.get('SXD_SIM_SPEEDUP', 1.0)))
+    Motor, PV, Device, Struck = sim.motor, sim.pv, sim.device, sim.struck
+else:
+    from epics import *
+    from epics.devices import Struck
+    sim = None
+from SXD_xps import XPSPool
+from SXD_trajectory import TrajectoryStore
+from SXD_epics import ShadowCache, Snapshot, STRUCK_EXTERNAL, DETECTOR_SETUP, wait_done, \
+    move_group, require_move, MoveError, ReadoutError
+from SXD_engine import ScanEngine, print_timing
+from SXD_grid import grid_order, PATTERNS, SERPENTINE, FLY, GridMap, MAPS, fit_centre, \
+    adaptive_levels, window_axis, pick_cells
+from SXD_model import DryRun, PVT_RAMP, DEFAULT_LATENCIES
+from SXD_log import RunLog
+from SXD_files import DirectoryIndex, step_files, frame_files, mirror_files
+from SXD_frames import FrameSummer
+from SXD_metrics import MetricsPool, FrameWatcher, SATURATION, flagged
+from SXD_trace import Tracer
+from SXD_shutter import ShutterCalibration, regime, sync_errors
+from SXD_efficiency import EfficiencyReport, scan_time, series_text
+from SXD_route import order_points, choose_nesting
+from SXD_plan import Axis, RotationRow, PlanSetup, ScanPoint, PlanError, \
+    PVT_1M, PVT_CCD, STEP_CCD, fly_grid_steps
+
+# widget background for cleared warnings, SystemButtonFace only exists on Windows
+if os.name == 'nt':
+    normal_bg = 'SystemButtonFace'
+else:
+    normal_bg = '#d9d9d9'
 
 
 # define classes
@@ -241,8 +272,6 @@ class Rotation:
         self.num_wide = IntVar()
         # file builder variable below
         self.rot_file_part = 'None'
-        # overwrite warning variable
-        self.warning = False
 
         # set initial variable values
         self.detPos.set('%.3f' % mDet.RBV)
@@ -431,7 +460,7 @@ class Rotation:
             grounded += 1
             self.entry_wStart.config(bg='red')
         if mW.within_limits(w_final):
-            self.label_wEnd.config(bg='SystemButtonFace')
+            self.label_wEnd.config(bg=normal_bg)
         else:
             grounded += 1
             self.label_wEnd.config(bg='red')
@@ -440,7 +469,7 @@ class Rotation:
             msize = self.stepSize.get()*10000
             quotient = divmod(msize, 100)
             if quotient[0] >= 10 and round(quotient[1], 5) == 0:
-                self.label_stepSize.config(bg='SystemButtonFace')
+                self.label_stepSize.config(bg=normal_bg)
             else:
                 grounded += 1
                 self.label_stepSize.config(bg='red')
@@ -469,563 +498,364 @@ class Rotation:
         # see if I can use this later
         return grounded
 
-    def overwrite_warn(self):
-        self.warning = tkMessageBox.askyesno(
-            'Overwrite Warning',
-            'File name already exists.  Do you want to overwrite?',
-            default='no')
-        return self.warning
-
     # Define data collection methods for stack and detector combos
-    def dc_1m_diffraction(self):
-        """carry out diffraction routine for one row
+    def dc_1m_diffraction(self, step, setup):
+        """carry out diffraction routine for one compiled step
 
         The primary characteristic of this routine is that a step scan
         will be done in a single pass, with the mcs clicking a channel
         for each step.
+        :param step: ScanStep from the plan compiler
+        :return: Struck clock seconds of the exposure, None if it timed out
         """
-        scan_types = [
-            ('wide', self.wide.get()),
-            ('steps', self.steps.get())]
-        for scan_type, checkbox in scan_types:
-            if not abort.get():
-                pass
+        # gather info to prep for move
+        omega = stage_motors[step.omega]
+        perm_velo = omega.VELO
+        if step.omega == 'SolT':
+            passive.put('0')
+        # make initial moves and prepare for collection
+        with tracer.span('prep move'):
+            require_move(plan_moves(step))
+        if step.omega == 'W':
+            mW.VELO = step.velo
+        # try to initialzize softglue here
+        # ###sg_config.put('name1', 'clear_all', wait=True)
+        # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
+        with tracer.span('softglue config'):
+            sg_config.put('name2', 'xps_master', wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            softglue.put('FI1_Signal', 'motor')
+        # initialize struck for dc_1M collection
+        with tracer.span('struck setup'):
+            mcs.stop()
+            # external mode, only fields that changed are sent
+            mcs_shadow.apply(STRUCK_EXTERNAL)
+        # mcs.put('LNEOutputPolarity', 1, wait=True)
+        # mcs.put('LNEOutputDelay', 0, wait=True)
+        # mcs.put('LNEOutputWidth', 1e-6, wait=True)
+        with tracer.span('detector setup'):
+            det_shadow.put('AcquirePeriod', step.acq_period)
+            det_shadow.put('AcquireTime', step.exp_time)
+            detector.FileName = step.file_name
+            det_shadow.put('TriggerMode', 2)
+            detector.FileNumber = step.image_no
+            det_shadow.put('NumImages', step.num_points)
+        # trajectory was uploaded with the plan
+        with tracer.span('xps setup'):
+            xps = xps_pool.session(xps_ip)
+            xps.MultipleAxesPVTPulseOutputSet('M', *step.pulse)
+        if step.direction < 0:
+            # metrics once the frames carry their final numbers
+            frame_watcher.hold(frame_files(step))
+        # Final actions plus data collection move
+        time_stamp = time.strftime('%d %b %Y %H:%M:%S',
+                                   time.localtime())
+        with tracer.span('arm'):
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            mcs.start()
+            detector.Acquire = 1
+        with tracer.span('pvt execution', file=step.first_file):
+            xps.execute(step.expected_time + 2*PVT_RAMP,
+                        'MultipleAxesPVTExecution', 'M', step.traj_name, 1)
+        # woken by the Acquire monitor, not by polling
+        with tracer.span('readout wait'):
+            if not wait_done(detector, 'Acquire', timeout=readout_timeout):
+                print 'Detector still acquiring, stopping it'
+                detector.Acquire = 0
+                if not wait_done(detector, 'Acquire', timeout=readout_timeout):
+                    raise ReadoutError(READOUT_TIMED_OUT % readout_timeout)
+        if step.direction < 0:
+            # frames came in descending omega, number them ascending
+            with tracer.span('frame remap'):
+                if not mirror_files(os.path.dirname(step.first_path), step):
+                    print 'Could not renumber ' + step.first_file + \
+                        ', frames are in descending omega'
+            frame_watcher.add(frame_files(step))
+        # positions at collection time, from the monitors
+        positions = motor_snapshot.take()
+        # recover
+        image_num = step.image_no + step.num_images
+        engine.gui(advance_image_no, image_num)
+        with tracer.span('recover'):
+            detector.FileNumber = image_num
+            det_shadow.put('TriggerMode', 0)
+            det_shadow.put('NumImages', 1)
+            omega.VELO = perm_velo
+        with tracer.span('scaler wait'):
+            scaler_done = wait_done(mcs, 'Acquiring', timeout=scaler_timeout)
+        if scaler_done:
+            ara = mcs.readmca(1)
+            if setup.stack == 'BMDHL':
+                counts = mcs.reanmca(2)
             else:
-                return
-            if checkbox:
-                if scan_type == 'wide':
-                    full_file_name = self.rot_file_part + 'w'
-                    num_points = self.num_wide.get()
-                else:
-                    full_file_name = self.rot_file_part + 's'
-                    num_points = self.nPTS.get()
-                # Ensure first file of series does not exist
-                if not prefix.name_flag.get():
-                    first_filename = full_file_name + '_' + prefix.imageNo.get() + '.tif'
-                else:
-                    first_filename = prefix.sampleName.get() + '_' + prefix.imageNo.get() + '.tif'
-                full_file_path = prefix.pathName.get() + first_filename
-                if not os.path.isfile(full_file_path):
-                    pass
-                else:
-                    self.overwrite_warn()
-                    if not self.warning:
-                        continue
-                    else:
-                        pass
-                # gather info to prep for move
-                perm_velo = mW.VELO
-                temp_velo = 1/self.tPerDeg.get()
-                if not extras.soller_flag.get():
-                    perm_velo = mW.VELO
-                    w_zero = self.wStart.get() - temp_velo*mW.ACCL*1.5
-                    w_final = self.wEnd.get() + temp_velo*mW.ACCL*1.5
-                else:
-                    passive.put('0')
-                    perm_velo = mSolT.VELO
-                    w_zero = self.wStart.get() - temp_velo*mSolT.ACCL*1.5
-                    w_final = self.wEnd.get() + temp_velo*mSolT.ACCL*1.5
-                acq_period = self.wRange.get()/num_points*self.tPerDeg.get()
-                if num_points != 1:
-                    exp_time = acq_period - .003
-                else:
-                    exp_time = acq_period
-                # make initial moves and prepare for collection
-                mDet.move(self.detPos.get(), wait=True)
-                if not extras.soller_flag.get():
-                    mW.move(w_zero, wait=True)
-                    mW.VELO = temp_velo
-                else:
-                    r = 62.700
-                    # ###GSECARS r = 35.430
-                    sol_x_zero = -r + r*cos(w_zero*pi/180)
-                    print str(sol_x_zero) + 'test'
-                    sol_y_zero = r*sin(w_zero*pi/180)
-                    mSolT.move(w_zero)
-                    mSolX.move(sol_x_zero)
-                    mSolY.move(sol_y_zero)
-                    mSolT.move(w_zero, wait=True)
-                    mSolX.move(sol_x_zero, wait=True)
-                    mSolY.move(sol_y_zero, wait=True)
-                # try to initialzize softglue here
-                # ###sg_config.put('name1', 'clear_all', wait=True)
-                # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
-                sg_config.put('name2', 'xps_master', wait=True)
-                sg_config.put('loadConfig2.PROC', 1, wait=True)
-                sg_config.put('loadConfig2.PROC', 1, wait=True)
-                softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                softglue.put('FI1_Signal', 'motor')
-                # initialize struck for dc_1M collection
-                mcs.stop()
-                mcs.ExternalMode()
-                mcs.put('InputMode', 3, wait=True)
-                mcs.put('OutputMode', 3, wait=True)
-                mcs.put('OutputPolarity', 0, wait=True)
-                mcs.put('LNEStretcherEnable', 0, wait=True)
-                # mcs.put('LNEOutputPolarity', 1, wait=True)
-                # mcs.put('LNEOutputDelay', 0, wait=True)
-                # mcs.put('LNEOutputWidth', 1e-6, wait=True)
-                mcs.NuseAll = 1
-                detector.AcquirePeriod = acq_period
-                detector.AcquireTime = exp_time
-                if not prefix.name_flag.get():
-                    detector.FileName = full_file_name
-                else:
-                    detector.FileName = prefix.sampleName.get()
-                detector.TriggerMode = 2
-                detector.FileNumber = int(prefix.imageNo.get())
-                detector.NumImages = num_points
-                # set up trajectory
-                if not extras.soller_flag.get():
-                    make_trajectory(zero=w_zero, min=self.wStart.get(), max=self.wEnd.get(), velo=temp_velo, motor=mW)
-                else:
-                    total_time = self.wRange.get()*self.tPerDeg.get()
-                    make_soller_trajectory(theta_zero=w_zero, theta_min=self.wStart.get(), theta_max=self.wEnd.get(),
-                                           num_points=self.nPTS.get(), time_total=total_time)
-                myxps = XPS_Q8_drivers.XPS()
-                socketId = myxps.TCP_ConnectToServer(xps_ip, 5001, 20)
-                single_pass = self.wRange.get()*self.tPerDeg.get()
-                if not extras.soller_flag.get():
-                    myxps.MultipleAxesPVTPulseOutputSet(socketId, 'M', 2, 3, single_pass)
-                else:
-                    last_element = 1 + self.nPTS.get()
-                    myxps.MultipleAxesPVTPulseOutputSet(socketId, 'M', 2, last_element, single_pass)
-                # Final actions plus data collection move
-                time_stamp = time.strftime('%d %b %Y %H:%M:%S',
-                                           time.localtime())
-                softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                mcs.start()
-                detector.Acquire = 1
-                if not extras.soller_flag.get():
-                    myxps.MultipleAxesPVTExecution(socketId, 'M', 'traj.trj', 1)
-                else:
-                    myxps.MultipleAxesPVTExecution(socketId, 'M', 'soller_traj.trj', 1)
-                myxps.TCP_CloseSocket(socketId)
-                while detector.Acquire:
-                    time.sleep(0.1)
-                # recover
-                image_num = detector.FileNumber + num_points - 1
-                string_image_num = str(image_num)
-                prefix.imageNo.set(string_image_num.zfill(3))
-                detector.FileNumber = int(image_num)
-                detector.TriggerMode = 0
-                detector.NumImages = 1
-                if not extras.soller_flag.get():
-                    mW.VELO = perm_velo
-                else:
-                    mSolT.VELO = perm_velo
-                if not mcs.Acquiring:
-                    ara = mcs.readmca(1)
-                    if config.stack_choice.get() == 'BMDHL':
-                        counts = mcs.reanmca(2)
-                    else:
-                        counts = mcs.readmca(4)
-                    if isinstance(ara, int):
-                        # print 'int'
-                        total_time = ara/50e6
-                    else:
-                        # print 'array'
-                        ara_bit = ara[0]
-                        total_time = ara_bit/50e6
-                    if isinstance(counts, int):
-                        # print 'int'
-                        counts_bit = counts
-                    else:
-                        # print 'array'
-                        counts_bit = counts[0]
-                    expected_time = self.tPerDeg.get()*self.wRange.get()
-                    time_error = total_time - expected_time
-                    cps = int(counts_bit / total_time)
-                    print total_time
-                    print expected_time
-                    print time_error
-                else:
-                    mcs.stop()
-                    # TODO Send warning to user (front panel)
-                # Open (or create) text file for writing
-                textfile_name = prefix.sampleName.get() + '_P' + \
-                    prefix.pressureNo.get() + '.txt'
-                textfile_path = prefix.pathName.get() + textfile_name
-                if not os.path.isfile(textfile_path):
-                    header_one = 'Data collection values for: ' + \
-                                 prefix.sampleName.get() + '_P' + \
-                                 prefix.pressureNo.get()
-                    header_two = 'Sample stack: ' + config.stack_choice.get() + \
-                                 ', Detector: ' + config.detector_choice.get()
-                    header_list = ['{:22}'.format('Timestamp'), '{:30}'.format('File Name'),
-                                   '{:>8}'.format('Cen X'), '{:>8}'.format('Cen Y'),
-                                   '{:>8}'.format('Sam Z'), '{:>8}'.format('Det. Y'),
-                                   '{:>8}'.format('Start'), '{:>8}'.format('End'),
-                                   '{:^8}'.format('Images'), '{:>8}'.format('Exp. time'),
-                                   '{:>10}'.format('CPS')]
-                    header_three = ' '.join(header_list)
-                    textfile = open(textfile_path, 'a')
-                    textfile.write(header_one + '\n' * 2)
-                    textfile.write(header_two + '\n' * 2)
-                    textfile.write(header_three + '\n' * 2)
-                else:
-                    textfile = open(textfile_path, 'a')
-                # Add line to text file and close
-                line_list = ['{:22}'.format(time_stamp), '{:30}'.format(first_filename),
-                             '{: 8.3f}'.format(mX.RBV), '{: 8.3f}'.format(mY.RBV),
-                             '{: 8.3f}'.format(mZ.RBV), '{: 8.3f}'.format(mDet.RBV),
-                             '{: 8.2f}'.format(self.wStart.get()), '{:8.2f}'.format(self.wEnd.get()),
-                             '{:^9}'.format(num_points), '{:8.3f}'.format(exp_time),
-                             '{:10}'.format(cps)]
-                text_line = ' '.join(line_list)
-                textfile.write(text_line + '\n')
-                textfile.close()
-
-    def dc_ccd_diffraction(self):
-        """carry out diffraction routine for one row"""
-        scan_types = [
-            ('wide', self.wide.get()),
-            ('steps', self.steps.get())]
-        for scan_type, checkbox in scan_types:
-            if checkbox:
-                if scan_type == 'wide':
-                    full_file_name = self.rot_file_part + 'w'
-                    num_points = self.num_wide.get()
-                else:
-                    full_file_name = self.rot_file_part + 's'
-                    num_points = self.nPTS.get()
-                # Next few lines are principle difference for IP and CCD
-                step_size = self.wRange.get()/num_points
-                for each in range(num_points):
-                    if not abort.get():
-                        pass
-                    else:
-                        return
-                    step_start = self.wStart.get() + each * step_size
-                    step_end = step_start + step_size
-                    # Ensure first file of series does not exist
-                    if not prefix.name_flag.get():
-                        first_filename = full_file_name + '_' + prefix.imageNo.get() + '.tif'
-                    else:
-                        first_filename = prefix.sampleName.get() + '_' + prefix.imageNo.get() + '.tif'
-                    full_file_path = prefix.pathName.get() + first_filename
-                    if not os.path.isfile(full_file_path):
-                        pass
-                    else:
-                        self.overwrite_warn()
-                        if not self.warning:
-                            continue
-                        else:
-                            pass
-                    # clear previous shutter info
-                    shutter.error_calc_clear()
-                    # gather info to prep for move
-                    perm_velo = mW.VELO
-                    temp_velo = 1/self.tPerDeg.get()
-                    w_zero = step_start - temp_velo*mW.ACCL*1.5
-                    w_final = step_end + temp_velo*mW.ACCL*1.5
-                    actual_exposure = step_size*self.tPerDeg.get()
-                    # Exp time and period arbitrary + 5 seconds
-                    acq_period = actual_exposure + 5
-                    exp_time = acq_period
-                    # make initial moves and prepare for collection
-                    mDet.move(self.detPos.get(), wait=True)
-                    mW.move(w_zero, wait=True)
-                    time.sleep(0.1)
-                    mW.VELO = temp_velo
-                    # try to initialize softglue here
-                    # ###sg_config.put('name1', 'clear_all', wait=True)
-                    # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
-                    sg_config.put('name2', 'xps_master', wait=True)
-                    sg_config.put('loadConfig2.PROC', 1, wait=True)
-                    sg_config.put('loadConfig2.PROC', 1, wait=True)
-                    softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    open_preset = 8000000*(0.5245 - shutter.open_delay.get())
-                    close_preset = 8000000*(0.5245 + actual_exposure - shutter.close_delay.get())
-                    softglue.put('DnCntr-3_PRESET', open_preset, wait=True)
-                    softglue.put('DnCntr-4_PRESET', close_preset, wait=True)
-                    softglue.put('FI1_Signal', 'motor', wait=True)
-                    softglue.put('FO19_Signal', 'gate_shutter', wait=True)
-                    # ###softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    # initialize struck for dc_ccd collection
-                    # modify this for 3801 scaler at 13BMC!!!!!
-                    mcs.stop()
-                    mcs.ExternalMode()
-                    mcs.put('InputMode', 3, wait=True)
-                    mcs.put('OutputMode', 3, wait=True)
-                    mcs.put('OutputPolarity', 0, wait=True)
-                    mcs.put('LNEStretcherEnable', 0, wait=True)
-                    # set for right number of channels
-                    # ###if scan_type == 'wide':
-                    # ###    if num_points == 1:
-                    # ###        mcs.NuseAll = self.nPTS.get()
-                    # ###    else:
-                    # ###        mcs.NuseAll = self.num_wide.get()
-                    # ###if scan_type == 'steps':
-                    # ###    mcs.NuseAll = 1
-                    # now we always just use one bin (for now)
-                    mcs.NuseAll = 1
-                    detector.ShutterMode = 0
-                    detector.AcquirePeriod = acq_period
-                    detector.AcquireTime = exp_time
-                    if not prefix.name_flag.get():
-                        detector.FileName = full_file_name
-                    else:
-                        detector.FileName = prefix.sampleName.get()
-                    detector.FileNumber = int(prefix.imageNo.get())
-                    # set up trajectory
-                    make_trajectory(zero=w_zero, min=step_start, max=step_end, velo=temp_velo, motor=mW)
-                    myxps = XPS_Q8_drivers.XPS()
-                    socketId = myxps.TCP_ConnectToServer(xps_ip, 5001, 20)
-                    myxps.MultipleAxesPVTPulseOutputSet(socketId, 'M', 2, 3, actual_exposure)
-                    # Final actions plus data collection move
-                    time_stamp = time.strftime('%d %b %Y %H:%M:%S',
-                                               time.localtime())
-                    softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    mcs.start()
-                    detector.Acquire = 1
-                    myxps.MultipleAxesPVTExecution(socketId, 'M', 'traj.trj', 1)
-                    myxps.TCP_CloseSocket(socketId)
-                    detector.Acquire = 0
-                    while detector.DetectorState_RBV:
-                        time.sleep(0.1)
-                    # recover
-                    image_num = str(detector.FileNumber)
-                    prefix.imageNo.set(image_num.zfill(3))
-                    time.sleep(0.1)
-                    detector.ShutterMode = 1
-                    mW.VELO = perm_velo
-                    if not mcs.Acquiring:
-                        ara = mcs.readmca(1)
-                        if config.stack_choice.get() == 'BMDHL':
-                            counts = mcs.reanmca(2)
-                        else:
-                            counts = mcs.readmca(4)
-                        if isinstance(ara, int):
-                            # print 'int'
-                            total_time = ara/50e6
-                        else:
-                            # print 'array'
-                            ara_bit = ara[0]
-                            total_time = ara_bit/50e6
-                        if isinstance(counts, int):
-                            # print 'int'
-                            counts_bit = counts
-                        else:
-                            # print 'array'
-                            counts_bit = counts[0]
-                        expected_time = self.tPerDeg.get()*step_size
-                        time_error = total_time - expected_time
-                        cps = int(counts_bit / total_time)
-                        print total_time
-                        print expected_time
-                        print time_error
-                    else:
-                        mcs.stop()
-                        total_time=0.001
-                    # get shutter sync info
-                    shutter.shutter_error_calc(motor_dwell=total_time)
-                    # Open (or create) text file for writing
-                    textfile_name = prefix.sampleName.get() + '_P' + \
-                        prefix.pressureNo.get() + '.txt'
-                    textfile_path = prefix.pathName.get() + textfile_name
-                    if not os.path.isfile(textfile_path):
-                        header_one = 'Data collection values for: ' + \
-                                     prefix.sampleName.get() + '_P' + \
-                                     prefix.pressureNo.get()
-                        header_two = 'Sample stack: ' + config.stack_choice.get() + \
-                                     ', Detector: ' + config.detector_choice.get()
-                        header_list = ['{:22}'.format('Timestamp'), '{:30}'.format('File Name'),
-                                       '{:>8}'.format('Cen X'), '{:>8}'.format('Cen Y'),
-                                       '{:>8}'.format('Sam Z'), '{:>8}'.format('Det. Y'),
-                                       '{:>8}'.format('Start'), '{:>8}'.format('End'),
-                                       '{:^8}'.format('Images'), '{:>8}'.format('Exp. time'),
-                                       '{:>10}'.format('CPS')]
-                        header_three = ' '.join(header_list)
-                        textfile = open(textfile_path, 'a')
-                        textfile.write(header_one + '\n' * 2)
-                        textfile.write(header_two + '\n' * 2)
-                        textfile.write(header_three + '\n' * 2)
-                    else:
-                        textfile = open(textfile_path, 'a')
-                    # Add line to text file and close
-                    line_list = ['{:22}'.format(time_stamp), '{:30}'.format(first_filename),
-                                 '{: 8.3f}'.format(mX.RBV), '{: 8.3f}'.format(mY.RBV),
-                                 '{: 8.3f}'.format(mZ.RBV), '{: 8.3f}'.format(mDet.RBV),
-                                 '{: 8.2f}'.format(step_start), '{:8.2f}'.format(step_end),
-                                 '{:^9}'.format(1), '{:8.3f}'.format(actual_exposure),
-                                 '{:10}'.format(cps)]
-                    text_line = ' '.join(line_list)
-                    textfile.write(text_line + '\n')
-                    textfile.close()
-
-    def step_ccd_diffraction(self):
-        """carry out diffraction routine for one row"""
-        scan_types = [
-            ('wide', self.wide.get()),
-            ('steps', self.steps.get())]
-        for scan_type, checkbox in scan_types:
-            if checkbox:
-                if scan_type == 'wide':
-                    full_file_name = self.rot_file_part + 'w'
-                    num_points = self.num_wide.get()
-                else:
-                    full_file_name = self.rot_file_part + 's'
-                    num_points = self.nPTS.get()
-                # Next few lines are principle difference for IP and CCD
-                step_size = self.wRange.get()/num_points
-                for each in range(num_points):
-                    if not abort.get():
-                        pass
-                    else:
-                        return
-                    step_start = self.wStart.get() + each * step_size
-                    step_end = step_start + step_size
-                    # Ensure first file of series does not exist
-                    if not prefix.name_flag.get():
-                        first_filename = full_file_name + '_' + prefix.imageNo.get() + '.tif'
-                    else:
-                        first_filename = prefix.sampleName.get() + '_' + prefix.imageNo.get() + '.tif'
-                    full_file_path = prefix.pathName.get() + first_filename
-                    if not os.path.isfile(full_file_path):
-                        pass
-                    else:
-                        self.overwrite_warn()
-                        if not self.warning:
-                            continue
-                        else:
-                            pass
-                    # clear previous shutter info
-                    shutter.error_calc_clear()
-                    # gather info to prep for move
-                    perm_velo = mW.VELO
-                    temp_velo = 1 / self.tPerDeg.get()
-                    ### stepper devel part 1 here ###
-                    resolution = abs(mW.MRES)
-                    micro_steps = step_size/resolution
-                    accl_steps = round((mW.VBAS + temp_velo)/2*mW.ACCL/resolution*1.25)
-                    accl_distance = accl_steps*resolution
-                    w_zero = step_start - accl_distance
-                    w_final = step_end + accl_distance
-                    accl_plus_fly_steps = (step_end - w_zero)/resolution
-                    ### stepper devel part 1 end ###
-                    actual_exposure = step_size*self.tPerDeg.get()
-                    # Exp time and period arbitrary + 5 seconds
-                    acq_period = actual_exposure + 5
-                    exp_time = acq_period
-                    # make initial moves and prepare for collection
-                    mDet.move(self.detPos.get(), wait=True)
-                    mW.move(w_zero, wait=True)
-                    time.sleep(0.1)
-                    mW.VELO = temp_velo
-                    # try to initialize softglue here
-                    # ###sg_config.put('name1', 'clear_all', wait=True)
-                    # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
-                    sg_config.put('name2', 'step_master', wait=True)
-                    sg_config.put('loadConfig2.PROC', 1, wait=True)
-                    sg_config.put('loadConfig2.PROC', 1, wait=True)
-                    softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    # stepper shutter control
-                    open_preset = accl_steps - (temp_velo/resolution*shutter.open_delay.get())
-                    close_preset = accl_plus_fly_steps - (temp_velo/resolution*shutter.close_delay.get())
-                    # ###open_preset = 8000000*(0.5245 - shutter.open_delay.get())
-                    # ###close_preset = 8000000*(0.5245 + actual_exposure - shutter.close_delay.get())
-                    softglue.put('DnCntr-1_PRESET', accl_steps, wait=True)
-                    softglue.put('DivByN-1_N', micro_steps, wait=True)
-                    softglue.put('DnCntr-3_PRESET', open_preset, wait=True)
-                    softglue.put('DnCntr-4_PRESET', close_preset, wait=True)
-                    softglue.put('FI6_Signal', 'motor', wait=True)
-                    softglue.put('FO19_Signal', 'gate_shutter', wait=True)
-                    # ###softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    # initialize struck for dc_ccd collection
-                    # modify this for 3801 scaler at 13BMC!!!!!
-                    mcs.stop()
-                    mcs.ExternalMode()
-                    mcs.put('InputMode', 3, wait=True)
-                    mcs.put('OutputMode', 3, wait=True)
-                    mcs.put('OutputPolarity', 0, wait=True)
-                    mcs.put('LNEStretcherEnable', 0, wait=True)
-                    # set for right number of channels
-                    # ###if scan_type == 'wide':
-                    # ###    if num_points == 1:
-                    # ###        mcs.NuseAll = self.nPTS.get()
-                    # ###    else:
-                    # ###        mcs.NuseAll = self.num_wide.get()
-                    # ###if scan_type == 'steps':
-                    # ###    mcs.NuseAll = 1
-                    # now we always just use one bin (for now)
-                    mcs.NuseAll = 1
-                    detector.ShutterMode = 0
-                    detector.AcquirePeriod = acq_period
-                    detector.AcquireTime = exp_time
-                    if not prefix.name_flag.get():
-                        detector.FileName = full_file_name
-                    else:
-                        detector.FileName = prefix.sampleName.get()
-                    detector.FileNumber = int(prefix.imageNo.get())
-                    # Final actions plus data collection move
-                    time_stamp = time.strftime('%d %b %Y %H:%M:%S',
-                                               time.localtime())
-                    softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
-                    mcs.start()
-                    detector.Acquire = 1
-                    mW.move(w_final, wait=True)
-                    detector.Acquire = 0
-                    while detector.DetectorState_RBV:
-                        time.sleep(0.1)
-                    # recover
-                    image_num = str(detector.FileNumber)
-                    prefix.imageNo.set(image_num.zfill(3))
-                    time.sleep(0.1)
-                    detector.ShutterMode = 1
-                    mW.VELO = perm_velo
-                    if not mcs.Acquiring:
-                        ara = mcs.readmca(1)
-                        if isinstance(ara, int):
-                            # print 'int'
-                            total_time = ara/50e6
-                        else:
-                            # print 'array'
-                            ara_bit = ara[0]
-                            total_time = ara_bit/50e6
-                        expected_time = self.tPerDeg.get()*step_size
-                        time_error = total_time - expected_time
-                        print total_time
-                        print expected_time
-                        print time_error
-                    else:
-                        mcs.stop()
-                        total_time = 0.001
-                    # get shutter sync info
-                    shutter.shutter_error_calc(motor_dwell=total_time)
-                    # Open (or create) text file for writing
-                    textfile_name = prefix.sampleName.get() + '_P' + \
-                        prefix.pressureNo.get() + '.txt'
-                    textfile_path = prefix.pathName.get() + textfile_name
-                    if not os.path.isfile(textfile_path):
-                        header_one = 'Data collection values for: ' + \
-                                     prefix.sampleName.get() + '_P' + \
-                                     prefix.pressureNo.get()
-                        header_two = 'Sample stack: ' + config.stack_choice.get() + \
-                                     ', Detector: ' + config.detector_choice.get()
-                        header_list = ['{:22}'.format('Timestamp'), '{:30}'.format('File Name'),
-                                       '{:>8}'.format('Cen X'), '{:>8}'.format('Cen Y'),
-                                       '{:>8}'.format('Sam Z'), '{:>8}'.format('Det. Y'),
-                                       '{:>8}'.format('Start'), '{:>8}'.format('End'),
-                                       '{:^8}'.format('Images'), '{:>8}'.format('Exp. time')]
-                        header_three = ' '.join(header_list)
-                        textfile = open(textfile_path, 'a')
-                        textfile.write(header_one + '\n' * 2)
-                        textfile.write(header_two + '\n' * 2)
-                        textfile.write(header_three + '\n' * 2)
-                    else:
-                        textfile = open(textfile_path, 'a')
-                    # Add line to text file and close
-                    line_list = ['{:22}'.format(time_stamp), '{:30}'.format(first_filename),
-                                 '{: 8.3f}'.format(mX.RBV), '{: 8.3f}'.format(mY.RBV),
-                                 '{: 8.3f}'.format(mZ.RBV), '{: 8.3f}'.format(mDet.RBV),
-                                 '{: 8.2f}'.format(step_start), '{:8.2f}'.format(step_end),
-                                 '{:^9}'.format(1), '{:8.3f}'.format(actual_exposure)]
-                    text_line = ' '.join(line_list)
-                    textfile.write(text_line + '\n')
-                    textfile.close()
-                    if config.detector_choice.get() == 'IP':
-                        time.sleep(10.0)
+                counts = mcs.readmca(4)
+            if isinstance(ara, int):
+                # print 'int'
+                total_time = ara/50e6
+            else:
+                # print 'array'
+                ara_bit = ara[0]
+                total_time = ara_bit/50e6
+            if isinstance(counts, int):
+                # print 'int'
+                counts_bit = counts
+            else:
+                # print 'array'
+                counts_bit = counts[0]
+            expected_time = step.expected_time
+            cps = int(counts_bit / total_time)
+            engine.timing(step.first_file, total_time, expected_time)
+            grid_map.add_step(step, cps)
+        else:
+            mcs.stop()
+            cps = 0
+            # TODO Send warning to user (front panel)
+        # Add record to the run log
+        with tracer.span('log write'):
+            run_log.write(step.log_path, scan_record(
+                time_stamp, step.first_file, step.w_start, step.w_end,
+                step.num_points, step.exp_time, cps, positions), log_headers(setup))
+            if step.synth:
+                # wide images summed from these frames, no sweep of their own
+                wide_name, wide_no, num_wide = step.synth
+                run_log.write(step.log_path, scan_record(
+                    time_stamp, wide_name + '_' + str(wide_no).zfill(3) + '.tif',
+                    step.w_start, step.w_end, num_wide, step.expected_time/num_wide,
+                    cps, positions), log_headers(setup))
+        if step.synth:
+            frame_summer.submit(os.path.dirname(step.first_path), step)
+        if scaler_done:
+            return total_time
+
+    def dc_ccd_diffraction(self, step, setup):
+        """carry out diffraction routine for one compiled step (one image)
+
+        :return: Struck clock seconds of the exposure, None if it timed out
+        """
+        # clear previous shutter info
+        engine.gui(shutter.error_calc_clear)
+        key, open_delay, close_delay = shutter_delays(step, setup)
+        # gather info to prep for move
+        perm_velo = mW.VELO
+        actual_exposure = step.expected_time
+        # make initial moves and prepare for collection
+        with tracer.span('prep move'):
+            require_move(plan_moves(step))
+            time.sleep(0.1)
+        mW.VELO = step.velo
+        # try to initialize softglue here
+        # ###sg_config.put('name1', 'clear_all', wait=True)
+        # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
+        with tracer.span('softglue config'):
+            sg_config.put('name2', 'xps_master', wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            open_preset = 8000000*(0.5245 - open_delay)
+            close_preset = 8000000*(0.5245 + actual_exposure - close_delay)
+            softglue.put('DnCntr-3_PRESET', open_preset, wait=True)
+            softglue.put('DnCntr-4_PRESET', close_preset, wait=True)
+            softglue.put('FI1_Signal', 'motor', wait=True)
+            softglue.put('FO19_Signal', 'gate_shutter', wait=True)
+        # ###softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+        # initialize struck for dc_ccd collection
+        # modify this for 3801 scaler at 13BMC!!!!!
+        with tracer.span('struck setup'):
+            mcs.stop()
+            mcs_shadow.apply(STRUCK_EXTERNAL)
+        # set for right number of channels
+        # ###if scan_type == 'wide':
+        # ###    if num_points == 1:
+        # ###        mcs.NuseAll = self.nPTS.get()
+        # ###    else:
+        # ###        mcs.NuseAll = self.num_wide.get()
+        # ###if scan_type == 'steps':
+        # ###    mcs.NuseAll = 1
+        # now we always just use one bin (for now), see STRUCK_EXTERNAL
+        with tracer.span('detector setup'):
+            det_shadow.put('ShutterMode', 0)
+            det_shadow.put('AcquirePeriod', step.acq_period)
+            det_shadow.put('AcquireTime', step.exp_time)
+            detector.FileName = step.file_name
+            detector.FileNumber = step.image_no
+        # trajectory was uploaded with the plan
+        with tracer.span('xps setup'):
+            xps = xps_pool.session(xps_ip)
+            xps.MultipleAxesPVTPulseOutputSet('M', *step.pulse)
+        # Final actions plus data collection move
+        time_stamp = time.strftime('%d %b %Y %H:%M:%S',
+                                   time.localtime())
+        with tracer.span('arm'):
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            mcs.start()
+            detector.Acquire = 1
+        with tracer.span('pvt execution', file=step.first_file):
+            xps.execute(step.expected_time + 2*PVT_RAMP,
+                        'MultipleAxesPVTExecution', 'M', step.traj_name, 1)
+        with tracer.span('readout wait'):
+            detector.Acquire = 0
+            if not wait_done(detector, 'DetectorState_RBV', timeout=readout_timeout):
+                # the next step would start while this one still reads out
+                raise ReadoutError(READOUT_TIMED_OUT % readout_timeout)
+        # positions at collection time, from the monitors
+        positions = motor_snapshot.take()
+        # recover
+        # sweeps run down in omega take their images from the top
+        engine.gui(advance_image_no, int(detector.FileNumber))
+        with tracer.span('recover'):
+            time.sleep(0.1)
+            det_shadow.put('ShutterMode', 1)
+            mW.VELO = perm_velo
+        with tracer.span('scaler wait'):
+            scaler_done = wait_done(mcs, 'Acquiring', timeout=scaler_timeout)
+        if scaler_done:
+            ara = mcs.readmca(1)
+            if setup.stack == 'BMDHL':
+                counts = mcs.reanmca(2)
+            else:
+                counts = mcs.readmca(4)
+            if isinstance(ara, int):
+                # print 'int'
+                total_time = ara/50e6
+            else:
+                # print 'array'
+                ara_bit = ara[0]
+                total_time = ara_bit/50e6
+            if isinstance(counts, int):
+                # print 'int'
+                counts_bit = counts
+            else:
+                # print 'array'
+                counts_bit = counts[0]
+            expected_time = step.expected_time
+            cps = int(counts_bit / total_time)
+            engine.timing(step.first_file, total_time, expected_time)
+            grid_map.add_step(step, cps)
+        else:
+            mcs.stop()
+            total_time = 0.001
+            cps = 0
+        # get shutter sync info, a timed out scaler is no calibration sample
+        shutter_sync(key, open_delay, close_delay, total_time, sample=scaler_done)
+        # Add record to the run log
+        with tracer.span('log write'):
+            run_log.write(step.log_path, scan_record(
+                time_stamp, step.first_file, step.w_start, step.w_end, 1,
+                actual_exposure, cps, positions), log_headers(setup))
+        if scaler_done:
+            return total_time
+
+    def step_ccd_diffraction(self, step, setup):
+        """carry out diffraction routine for one compiled step (one image)
+
+        :return: Struck clock seconds of the exposure, None if it timed out
+        """
+        # clear previous shutter info
+        engine.gui(shutter.error_calc_clear)
+        key, open_delay, close_delay = shutter_delays(step, setup)
+        # gather info to prep for move
+        perm_velo = mW.VELO
+        temp_velo = step.velo
+        resolution = abs(mW.MRES)
+        actual_exposure = step.expected_time
+        # make initial moves and prepare for collection
+        with tracer.span('prep move'):
+            require_move(plan_moves(step))
+            time.sleep(0.1)
+        mW.VELO = temp_velo
+        # try to initialize softglue here
+        # ###sg_config.put('name1', 'clear_all', wait=True)
+        # ###sg_config.put('loadConfig1.PROC', 1, wait=True)
+        with tracer.span('softglue config'):
+            sg_config.put('name2', 'step_master', wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            # stepper shutter control
+            open_preset = step.accl_steps - (temp_velo/resolution*open_delay)
+            close_preset = step.fly_steps - (temp_velo/resolution*close_delay)
+            # ###open_preset = 8000000*(0.5245 - shutter.open_delay.get())
+            # ###close_preset = 8000000*(0.5245 + actual_exposure - shutter.close_delay.get())
+            softglue.put('DnCntr-1_PRESET', step.accl_steps, wait=True)
+            softglue.put('DivByN-1_N', step.micro_steps, wait=True)
+            softglue.put('DnCntr-3_PRESET', open_preset, wait=True)
+            softglue.put('DnCntr-4_PRESET', close_preset, wait=True)
+            softglue.put('FI6_Signal', 'motor', wait=True)
+            softglue.put('FO19_Signal', 'gate_shutter', wait=True)
+        # ###softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+        # initialize struck for dc_ccd collection
+        # modify this for 3801 scaler at 13BMC!!!!!
+        with tracer.span('struck setup'):
+            mcs.stop()
+            mcs_shadow.apply(STRUCK_EXTERNAL)
+        # set for right number of channels
+        # ###if scan_type == 'wide':
+        # ###    if num_points == 1:
+        # ###        mcs.NuseAll = self.nPTS.get()
+        # ###    else:
+        # ###        mcs.NuseAll = self.num_wide.get()
+        # ###if scan_type == 'steps':
+        # ###    mcs.NuseAll = 1
+        # now we always just use one bin (for now), see STRUCK_EXTERNAL
+        with tracer.span('detector setup'):
+            det_shadow.put('ShutterMode', 0)
+            det_shadow.put('AcquirePeriod', step.acq_period)
+            det_shadow.put('AcquireTime', step.exp_time)
+            detector.FileName = step.file_name
+            detector.FileNumber = step.image_no
+        # Final actions plus data collection move
+        time_stamp = time.strftime('%d %b %Y %H:%M:%S',
+                                   time.localtime())
+        with tracer.span('arm'):
+            softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+            mcs.start()
+            detector.Acquire = 1
+        with tracer.span('exposure move', file=step.first_file):
+            mW.move(step.w_final, wait=True)
+        with tracer.span('readout wait'):
+            detector.Acquire = 0
+            if not wait_done(detector, 'DetectorState_RBV', timeout=readout_timeout):
+                # the next step would start while this one still reads out
+                raise ReadoutError(READOUT_TIMED_OUT % readout_timeout)
+        # positions at collection time, from the monitors
+        positions = motor_snapshot.take()
+        # recover
+        # sweeps run down in omega take their images from the top
+        engine.gui(advance_image_no, int(detector.FileNumber))
+        with tracer.span('recover'):
+            time.sleep(0.1)
+            det_shadow.put('ShutterMode', 1)
+            mW.VELO = perm_velo
+        with tracer.span('scaler wait'):
+            scaler_done = wait_done(mcs, 'Acquiring', timeout=scaler_timeout)
+        if scaler_done:
+            ara = mcs.readmca(1)
+            if isinstance(ara, int):
+                # print 'int'
+                total_time = ara/50e6
+            else:
+                # print 'array'
+                ara_bit = ara[0]
+                total_time = ara_bit/50e6
+            expected_time = step.expected_time
+            engine.timing(step.first_file, total_time, expected_time)
+        else:
+            mcs.stop()
+            total_time = 0.001
+        # get shutter sync info, a timed out scaler is no calibration sample
+        shutter_sync(key, open_delay, close_delay, total_time, sample=scaler_done)
+        # Add record to the run log
+        with tracer.span('log write'):
+            run_log.write(step.log_path, scan_record(
+                time_stamp, step.first_file, step.w_start, step.w_end, 1,
+                actual_exposure, positions=positions), log_headers(setup))
+        if setup.detector == 'IP':
+            with tracer.span('image plate wait'):
+                time.sleep(10.0)
+        if scaler_done:
+            return total_time
 
 
 class CrystalSpot:
@@ -1093,12 +923,8 @@ class CrystalSpot:
         moves to the (x, y, z) position of the relevant row
         :return: none
         """
-        mX.move(self.x.get())
-        mY.move(self.y.get())
-        mZ.move(self.z.get())
-        mX.move(self.x.get(), wait=True)
-        mY.move(self.y.get(), wait=True)
-        mZ.move(self.z.get(), wait=True)
+        if not move_group([(mX, self.x.get()), (mY, self.y.get()), (mZ, self.z.get())]):
+            tkMessageBox.showwarning('Move', 'Move to ' + self.pos + ' did not finish')
 
     def autofill_xyz(self, *args):
         if not self.collect.get():
@@ -1252,6 +1078,188 @@ class GridPoints:
             do.continuous_button.config(state=DISABLED)
 
 
+class GridPattern:
+    """
+    GridPattern selects how grid_scan walks the grid
+
+    raster rewinds Y at the start of every row, serpentine runs every other
+    row backwards, and fly sweeps Y through each row on an XPS trajectory
+    while the detector takes one still (at the current omega, detector at
+    the first collecting D row) per point.
+    """
+
+    def __init__(self, master):
+        """
+        :param master: frame for inserting widgets
+        """
+        self.frame = Frame(master)
+        self.frame.grid()
+
+        # define instance variables and set defaults
+        self.pattern = StringVar()
+        self.dwell = DoubleVar()
+        self.pattern.set(SERPENTINE)
+        self.dwell.set(0.1)
+        self.center_slot = StringVar()
+        self.center_after = IntVar()
+        self.collect_after = IntVar()
+        self.center_slot.set('C1')
+        self.adaptive = IntVar()
+        self.top_k = IntVar()
+        self.target = DoubleVar()
+        self.top_k.set(3)
+        self.target.set(0.002)
+
+        # make and place widgets
+        self.label_pattern = Label(self.frame, text='Grid pattern', width=16)
+        self.label_pattern.grid(row=0, column=0, padx=5, pady=5)
+        for column, pattern in enumerate(PATTERNS):
+            self.pattern_button = Radiobutton(self.frame, text=pattern,
+                                              variable=self.pattern,
+                                              value=pattern)
+            self.pattern_button.grid(row=0, column=column + 1, padx=5)
+        self.label_dwell = Label(self.frame, text='Fly dwell (s)')
+        self.label_dwell.grid(row=0, column=4, padx=5)
+        self.entry_dwell = Entry(self.frame, textvariable=self.dwell, width=8)
+        self.entry_dwell.grid(row=0, column=5, padx=5)
+        self.entry_dwell.bind('<FocusOut>', self.dwell_validate)
+        self.entry_dwell.bind('<Return>', self.dwell_validate)
+
+        # auto-center widgets
+        self.button_center = Button(self.frame, text='Auto-center into', command=self.auto_center)
+        self.button_center.grid(row=1, column=0, padx=5, pady=5)
+        self.menu_center_slot = OptionMenu(self.frame, self.center_slot,
+                                           *['C' + str(k) for k in range(1, 10)])
+        self.menu_center_slot.grid(row=1, column=1, padx=5)
+        self.check_center_after = Checkbutton(self.frame, text='after grid scan',
+                                              variable=self.center_after)
+        self.check_center_after.grid(row=1, column=2, columnspan=2, padx=5)
+        self.check_collect_after = Checkbutton(self.frame, text='then collect',
+                                               variable=self.collect_after)
+        self.check_collect_after.grid(row=1, column=4, columnspan=2, padx=5)
+
+        # adaptive grid widgets
+        self.check_adaptive = Checkbutton(self.frame, text='Adaptive', variable=self.adaptive)
+        self.check_adaptive.grid(row=2, column=0, padx=5, pady=5)
+        self.label_top_k = Label(self.frame, text='Top cells')
+        self.label_top_k.grid(row=2, column=1, padx=5)
+        self.entry_top_k = Entry(self.frame, textvariable=self.top_k, width=8)
+        self.entry_top_k.grid(row=2, column=2, padx=5)
+        self.entry_top_k.bind('<FocusOut>', self.top_k_validate)
+        self.entry_top_k.bind('<Return>', self.top_k_validate)
+        self.label_target = Label(self.frame, text='Target step (mm)')
+        self.label_target.grid(row=2, column=3, columnspan=2, padx=5)
+        self.entry_target = Entry(self.frame, textvariable=self.target, width=8)
+        self.entry_target.grid(row=2, column=5, padx=5)
+        self.entry_target.bind('<FocusOut>', self.target_validate)
+        self.entry_target.bind('<Return>', self.target_validate)
+
+    def dwell_validate(self, event):
+        try:
+            val = self.dwell.get()
+            isinstance(val, float)
+            if 0.01 <= val <= 60:
+                self.dwell.set('%.3f' % val)
+            else:
+                raise ValueError
+        except ValueError:
+            self.dwell.set(0.1)
+            invalid_entry()
+
+    def top_k_validate(self, event):
+        try:
+            val = self.top_k.get()
+            if not 1 <= val <= 10:
+                raise ValueError
+        except ValueError:
+            self.top_k.set(3)
+            invalid_entry()
+
+    def target_validate(self, event):
+        try:
+            val = self.target.get()
+            isinstance(val, float)
+            if 0.0001 <= val <= 1:
+                self.target.set('%.4f' % val)
+            else:
+                raise ValueError
+        except ValueError:
+            self.target.set(0.002)
+            invalid_entry()
+
+    def budget(self, plan):
+        """
+        passes of an adaptive grid and what they will cost
+
+        Refinement windows collect the same rows as the coarse grid, so
+        every point is priced at the modelled coarse grid average.
+        :param plan: ScanPlan of the coarse grid
+        :return: (list of SXD_grid.Level, report text), (None, None) if refused
+        """
+        if not plan.steps:
+            tkMessageBox.showwarning('Adaptive grid', 'Nothing to collect at each grid point')
+            return None, None
+        try:
+            levels = adaptive_levels(y_grid.num_steps.get(), z_grid.num_steps.get(),
+                                     y_grid.step_size.get(), z_grid.step_size.get(),
+                                     self.target.get(), self.top_k.get())
+        except ValueError as error:
+            tkMessageBox.showwarning('Adaptive grid', str(error))
+            return None, None
+        per_point = DryRun(plan_axes(), config.detector_choice.get()).run(plan).total() / \
+            levels[0].points
+        points = sum(level.points for level in levels)
+        lines = ['Level %d: %d points, steps Y %.4f Z %.4f mm' % (
+            number, level.points, level.y_step, level.z_step)
+            for number, level in enumerate(levels)]
+        lines.append('%d points at most, about %.1f min' % (points, points*per_point/60))
+        return levels, '\n'.join(lines)
+
+    def auto_center(self):
+        """
+        put the crystal found in the last grid map into the chosen C row
+
+        Y and Z come from the map shown in the grid map window, X is where
+        the stage is now.
+        :return: True if a position was set
+        """
+        kind = heat_map.kind.get()
+        centre = fit_centre(grid_map.image(kind), grid_map.y, grid_map.z)
+        if centre is None:
+            tkMessageBox.showwarning('Auto-center', 'No grid map to center on')
+            return False
+        for spot in xtal_list:
+            if spot.pos == self.center_slot.get():
+                break
+        spot.x.set('%.4f' % mX.RBV)
+        spot.y.set('%.4f' % centre.y)
+        spot.z.set('%.4f' % centre.z)
+        spot.collect.set(1)
+        if not spot.frame.winfo_ismapped():
+            spot.frame.grid()
+        print '%s centered on Y %.4f, Z %.4f (%s fit of %s, peak %g)' % (
+            spot.pos, centre.y, centre.z, centre.method, kind, centre.peak)
+        return True
+
+    def center_and_collect(self):
+        """
+        chained after a grid scan, see Actions.grid_scan
+        """
+        if self.auto_center() and self.collect_after.get():
+            do.start_exp()
+
+    def choice(self):
+        """
+        pattern to run, fly needs the PILATUS and Y in the XPS group
+        """
+        pattern = self.pattern.get()
+        if pattern == FLY:
+            if config.detector_choice.get() != '1M' or y_positioner is None:
+                print 'Fly scan not available here, using serpentine'
+                return SERPENTINE
+        return pattern
+
+
 class Actions:
     """
     Big buttons that initiate data collection
@@ -1265,8 +1273,11 @@ class Actions:
         self.frame.grid()
 
         # define variables
-        self.continuous = IntVar()
-        self.continuous.set(0)
+        self.dry_run = IntVar()
+        self.short_route = IntVar()
+        self.short_route.set(1)
+        self.alternate = IntVar()
+        self.synth_wide = IntVar()
 
         # make big font
         bigfont = tkFont.Font(size=10, weight='bold')
@@ -1291,6 +1302,18 @@ class Actions:
         self.quit_button = Button(self.frame, text='Quit', height=2, width=15,
                                   font=bigfont, command=quit_now)
         self.quit_button.grid(row=0, column=4, padx=5)
+        self.check_dry_run = Checkbutton(self.frame, text='Dry run (estimate only)',
+                                         variable=self.dry_run)
+        self.check_dry_run.grid(row=1, column=1, pady=5)
+        self.check_short_route = Checkbutton(self.frame, text='Shortest crystal route',
+                                             variable=self.short_route)
+        self.check_short_route.grid(row=1, column=2, pady=5)
+        self.check_alternate = Checkbutton(self.frame, text='Alternate sweep direction',
+                                           variable=self.alternate)
+        self.check_alternate.grid(row=1, column=3, columnspan=2, pady=5)
+        self.check_synth_wide = Checkbutton(self.frame, text='Sum wide from steps (1M)',
+                                            variable=self.synth_wide)
+        self.check_synth_wide.grid(row=2, column=3, columnspan=2, pady=5)
 
     def show_shutter_sync(self):
         shutter.popup.deiconify()
@@ -1303,211 +1326,322 @@ class Actions:
             print 'yes'
             extras.step_then_soller()
             return
-        prefix.image_no_validation()
-        # Ensure file path exists, halt execution if it does not
-        if os.path.exists(prefix.pathName.get()):
-            pass
-        else:
-            path_warn()
+        if not run_ready():
+            return
+        plan = plan_ready(self.crystal_points())
+        if plan is None:
             return
-        process_start()
-        # define recovery (or abort) values
+        if self.dry_run.get():
+            return dry_run(plan)
+        engine.start(self.run_start_exp, plan)
+
+    def crystal_points(self):
+        """
+        one plan point per checked crystal spot, in the order of least
+        stage travel when Shortest crystal route is checked
+        """
+        points = []
+        for sample in xtal_list:
+            if sample.collect.get():
+                file_part = prefix.sampleName.get() + '_P' + \
+                    prefix.pressureNo.get() + '_' + sample.pos
+                moves = (('X', float(sample.x.get())), ('Y', float(sample.y.get())),
+                         ('Z', float(sample.z.get())))
+                points.append(ScanPoint(file_part, 'Crystal spot ' + sample.pos, moves))
+        if self.short_route.get():
+            # file names keep their C labels whatever the visiting order
+            points, before, after = order_points(points, plan_axes())
+            print 'Crystal route: %.1f s of travel, %.1f s in label order' % (after, before)
+        return points
+
+    def run_start_exp(self, plan):
+        """
+        Worker thread part of start_exp
+        :param plan: ScanPlan compiled from the crystal spots
+        """
         abort.put(0)
-        mX_ipos = mX.RBV
-        mY_ipos = mY.RBV
-        mZ_ipos = mZ.RBV
-        mW_ipos = mW.RBV
-        if extras.soller_flag.get():
-            mSolX_ipos = mSolX.RBV
-            mSolY_ipos = mSolY.RBV
-            mSolT_ipos = mSolT.RBV
-        mDet_ipos = mDet.RBV
-        # Define list for iterating Cx
-        sample_rows = [
-            (xtal1, '_C1', xtal1.collect.get()),
-            (xtal2, '_C2', xtal2.collect.get()),
-            (xtal3, '_C3', xtal3.collect.get()),
-            (xtal4, '_C4', xtal4.collect.get()),
-            (xtal5, '_C5', xtal5.collect.get()),
-            (xtal6, '_C6', xtal6.collect.get()),
-            (xtal7, '_C7', xtal7.collect.get()),
-            (xtal8, '_C8', xtal8.collect.get()),
-            (xtal9, '_C9', xtal9.collect.get())]
-        for sample, c_filebit, xtal_collect in sample_rows:
-            if not abort.get():
-                pass
-            else:
-                break
-            if xtal_collect:
-                # move to Cx position for data collection
-                sample.move_to()
-                # Build partial file name for this Cx
-                sample.cs_file_part = prefix.sampleName.get() + '_P' + \
-                    prefix.pressureNo.get() + c_filebit
-                # Define list for iterating Dx
-                detector_rows = [
-                    (det1, '_D1', det1.collect.get()),
-                    (det2, '_D2', det2.collect.get()),
-                    (det3, '_D3', det3.collect.get()),
-                    (det4, '_D4', det4.collect.get()),
-                    (det5, '_D5', det5.collect.get()),
-                    (det6, '_D6', det6.collect.get()),
-                    (det7, '_D7', det7.collect.get()),
-                    (det8, '_D8', det8.collect.get()),
-                    (det9, '_D9', det9.collect.get())]
-                for det_n, d_filebit, det_collect in detector_rows:
-                    if not abort.get():
-                        pass
-                    else:
-                        break
-                    if det_collect:
-                        # Build partial file name for this Dx
-                        det_n.rot_file_part = sample.cs_file_part + d_filebit
-                        # Go to stack- and detector-appropriate routine
-                        if config.detector_choice.get() == '1M':
-                            det_n.dc_1m_diffraction()
-                        elif config.detector_choice.get() == 'CCD':
-                            if config.stack_choice.get() == 'BMDHL':
-                                det_n.step_ccd_diffraction()
-                            else:
-                                det_n.dc_ccd_diffraction()
-                        elif config.detector_choice.get() == 'IP':
-                            det_n.step_ccd_diffraction()
-        # return to initial positions (or resume continuous collection)
-        if not self.continuous.get():
-            mX.move(mX_ipos, wait=True)
-            mY.move(mY_ipos, wait=True)
-            mZ.move(mZ_ipos, wait=True)
-            mW.move(mW_ipos, wait=True)
-            if extras.soller_flag.get():
-                mSolX.move(mSolX_ipos)
-                mSolY.move(mSolY_ipos)
-                mSolT.move(mSolT_ipos)
-                mSolX.move(mSolX_ipos, wait=True)
-                mSolY.move(mSolY_ipos, wait=True)
-                mSolT.move(mSolT_ipos, wait=True)
-            mDet.move(mDet_ipos, wait=True)
-            softglue.put('FI1_Signal', '')
-            # for BMD comment out above and comment in below
-            # ### softglue.put('FI6_Signal', '')
-            softglue.put('FO19_Signal', '0', wait=True)
-            abort.put(0)
-            process_stop()
-            tkMessageBox.showinfo('Done', 'Data collection complete')
-        elif abort.get():
-            abort.put(0)
-            self.continuous.set(0)
-        else:
-            time.sleep(0.1)
+        motors = [mX, mY, mZ, mW, mDet]
+        if plan.setup.soller:
+            motors.extend([mSolX, mSolY, mSolT])
+        # for BMD restore FI6_Signal instead of FI1_Signal
+        with restoring(motors):
+            run_plan(plan)
+        return 'Data collection complete'
 
     def cont_exp(self):
-        # get initial values for continuous
-        mX_icpos = mX.RBV
-        mY_icpos = mY.RBV
-        mZ_icpos = mZ.RBV
-        mW_icpos = mW.RBV
-        mDet_icpos = mDet.RBV
-        self.continuous.set(1)
-        while self.continuous.get():
-            self.start_exp()
-            oldp = int(prefix.pressureNo.get())
-            newp = oldp + 1
-            prefix.pressureNo.set(newp)
-        mX.move(mX_icpos, wait=True)
-        mY.move(mY_icpos, wait=True)
-        mZ.move(mZ_icpos, wait=True)
-        mW.move(mW_icpos, wait=True)
-        mDet.move(mDet_icpos, wait=True)
-        softglue.put('FI1_Signal', '')
-        # temp bmd fix one lione below
-        softglue.put('FI6_Signal', '')
-        softglue.put('FO19_Signal', '0', wait=True)
-        process_stop()
-        tkMessageBox.showinfo('Done', 'Data collection complete')
+        if not run_ready():
+            return
+        points = self.crystal_points()
+        plan = plan_ready(points)
+        if plan is None:
+            return
+        if self.dry_run.get():
+            return dry_run(plan)
+        engine.start(self.run_cont_exp, plan, points, plan_rows())
+
+    def run_cont_exp(self, plan, points, rows):
+        """
+        Worker thread part of cont_exp, the crystal spots again at the next
+        pressure number until aborted
+        :param plan: ScanPlan compiled from the crystal spots
+        :param points: ScanPoints the plan was compiled from
+        :param rows: RotationRows the plan was compiled from
+        """
+        abort.put(0)
+        # temp bmd fix, FI6_Signal cleared as well
+        with restoring([mX, mY, mZ, mW, mDet], ('FI1_Signal', 'FI6_Signal')):
+            while plan is not None:
+                run_plan(plan)
+                aborted = abort.get()
+                # file names carry the pressure number
+                old_stem = file_stem(plan.setup)
+                setup = plan.setup._replace(pressure_no=str(int(plan.setup.pressure_no) + 1),
+                                            image_no=plan.next_image)
+                engine.gui(prefix.pressureNo.set, setup.pressure_no)
+                if aborted:
+                    abort.put(0)
+                    break
+                time.sleep(0.1)
+                points = [point._replace(
+                    file_part=file_stem(setup) + point.file_part[len(old_stem):])
+                    for point in points]
+                plan = compile_collection(points, rows, setup)
+                plan.check()
+                plan = settle_overwrites(plan, engine.ask)
+        return 'Data collection complete'
 
     def grid_scan(self):
         """
         Iterates data collection, file building, and routine for GUI checkboxes
         """
-        prefix.image_no_validation()
-        # Ensure file path exists, halt execution if it does not
-        if os.path.exists(prefix.pathName.get()):
-            pass
+        if not run_ready():
+            return
+        pattern = grid_pattern.choice()
+        adaptive = grid_pattern.adaptive.get()
+        if adaptive and pattern == FLY:
+            print 'Adaptive grids step from point to point, using serpentine'
+            pattern = SERPENTINE
+        y_values, z_values = self.grid_axes()
+        if pattern == FLY:
+            plan = plan_accepted(fly_plan(y_values, z_values))
         else:
-            path_warn()
+            plan = plan_ready(grid_points(y_values, z_values, pattern, plan_setup()))
+        if plan is None:
             return
-        process_start()
-        # define recovery (or abort) values
-        mX_ipos = mX.RBV
-        mY_ipos = mY.RBV
-        mZ_ipos = mZ.RBV
-        mW_ipos = mW.RBV
-        mDet_ipos = mDet.RBV
-        # Define grid for iteration (as opposed to Cx list)
-        for zsteps in range(z_grid.num_steps.get()):
-            if not abort.get():
-                pass
+        if self.dry_run.get() and pattern == FLY:
+            return dry_run(plan, fly=(y_grid.num_steps.get(), z_grid.num_steps.get(),
+                                      y_values[0], y_grid.step_size.get(), z_values[0],
+                                      z_grid.step_size.get(), grid_pattern.dwell.get()))
+        levels = None
+        if adaptive:
+            levels, budget = grid_pattern.budget(plan)
+            if levels is None:
+                process_stop()
+                return
+            print budget
+            if not self.dry_run.get() and not tkMessageBox.askokcancel('Adaptive grid', budget):
+                process_stop()
+                return
+        if self.dry_run.get():
+            return dry_run(plan)
+        grid_map_start(y_values, z_values, pattern, plan)
+        heat_map.show()
+        if grid_pattern.center_after.get():
+            after_run.append(grid_pattern.center_and_collect)
+        if levels:
+            engine.start(self.run_adaptive_grid, pattern, plan, levels,
+                         heat_map.kind.get(), grid_pattern.top_k.get(), plan_rows())
+        else:
+            engine.start(self.run_grid_scan, pattern, plan, y_values, z_values)
+
+    def grid_axes(self):
+        """
+        absolute Y and Z of the grid columns and rows, relative to now
+        """
+        axes = []
+        for grid, motor in ((y_grid, mY), (z_grid, mZ)):
+            if grid.num_steps.get() > 1:
+                axes.append([motor.RBV + grid.rel_min.get() + k*grid.step_size.get()
+                             for k in range(grid.num_steps.get())])
             else:
-                break
-            g_index = zsteps*z_grid.num_steps.get()
-            if z_grid.num_steps.get() > 1:
-                z_rel = z_grid.rel_min.get() + zsteps*z_grid.step_size.get()
-                z_abs = mZ_ipos + z_rel
-                mZ.move(z_abs, wait=True)
-            for ysteps in range(y_grid.num_steps.get()):
-                if not abort.get():
-                    pass
-                else:
+                # a single point is not moved to
+                axes.append([motor.RBV])
+        return axes
+
+    def run_grid_scan(self, pattern, plan, y_values, z_values):
+        """
+        Worker thread part of grid_scan
+        :param pattern: RASTER, SERPENTINE or FLY
+        :param plan: ScanPlan compiled from the grid, one step per row for FLY
+        :param y_values: Y of each grid column
+        :param z_values: Z of each grid row
+        """
+        with restoring([mX, mY, mZ, mW, mDet]):
+            if pattern == FLY:
+                if plan.steps:
+                    watch_frames(os.path.dirname(plan.steps[0].first_path),
+                                 plan.steps[0].log_path, plan.setup.detector)
+                    self.fly_grid(plan, y_values, z_values)
+                    finish_frames()
+            else:
+                run_plan(plan)
+            save_grid_map(plan.setup)
+            grid_map.stop()
+        return 'Data collection complete'
+
+    def run_adaptive_grid(self, pattern, plan, levels, kind, top_k, rows):
+        """
+        Worker thread part of an adaptive grid_scan
+
+        The coarse grid first, then at each level a small grid around
+        each of the best cells of the level before, collected with the
+        same per-point routines as grid_scan.
+        :param pattern: RASTER or SERPENTINE, for every window
+        :param plan: ScanPlan of the coarse grid
+        :param levels: SXD_grid.Level list from GridPattern.budget
+        :param kind: map the best cells are picked from, see MAPS
+        :param top_k: cells refined at each level
+        :param rows: RotationRows the coarse grid was compiled from
+        """
+        with restoring([mX, mY, mZ, mW, mDet]):
+            self.refine_grid(pattern, plan, levels, kind, top_k, rows)
+        return 'Data collection complete'
+
+    def refine_grid(self, pattern, plan, levels, kind, top_k, rows):
+        """
+        collect the coarse grid and the windows of every level, see
+        run_adaptive_grid
+        """
+        run_plan(plan)
+        save_grid_map(plan.setup)
+        candidates = grid_map.cells(kind)
+        best = (max(candidates) if candidates else None, grid_map.copy())
+        for number, (coarse, level) in enumerate(zip(levels, levels[1:]), 1):
+            centres = pick_cells(candidates, top_k, coarse.y_step, coarse.z_step)
+            candidates = []
+            for window, (value, y, z) in enumerate(centres, 1):
+                if abort.get():
                     break
-                g_index += 1
-                g_filebit = str(g_index)
-                # display current data point
-                total = str(z_grid.num_steps.get() * y_grid.num_steps.get())
-                working.current_index.set('Grid point ' + g_filebit + ' of ' + total)
-                if y_grid.num_steps.get() > 1:
-                    y_rel = y_grid.rel_min.get() + ysteps*y_grid.step_size.get()
-                    y_abs = mY_ipos + y_rel
-                    mY.move(y_abs, wait=True)
-                # Build partial file name for this Gx
-                g_file_part = prefix.sampleName.get() + '_P' + \
-                              prefix.pressureNo.get() + '_G' + g_filebit
-                # Define list for iterating Dx
-                detector_rows = [
-                    (det1, '_D1', det1.collect.get()),
-                    (det2, '_D2', det2.collect.get()),
-                    (det3, '_D3', det3.collect.get()),
-                    (det4, '_D4', det4.collect.get()),
-                    (det5, '_D5', det5.collect.get()),
-                    (det6, '_D6', det6.collect.get()),
-                    (det7, '_D7', det7.collect.get()),
-                    (det8, '_D8', det8.collect.get()),
-                    (det9, '_D9', det9.collect.get())]
-                for position, d_filebit, det_collect in detector_rows:
-                    if not abort.get():
-                        pass
-                    else:
-                        break
-                    if det_collect:
-                        # Build partial file name for this Dx
-                        position.rot_file_part = g_file_part + d_filebit
-                        # Go to stack- and detector-appropriate routine
-                        if config.detector_choice.get() == '1M':
-                            position.dc_1m_diffraction()
-                        elif config.detector_choice.get() == 'CCD':
-                            position.dc_ccd_diffraction()
-                        elif config.detector_choice.get() == 'IP':
-                            position.step_ccd_diffraction()
-        # return to initial positions (or resume continuous collection)
-        mX.move(mX_ipos, wait=True)
-        mY.move(mY_ipos, wait=True)
-        mZ.move(mZ_ipos, wait=True)
-        mW.move(mW_ipos, wait=True)
-        mDet.move(mDet_ipos, wait=True)
-        abort.put(0)
-        softglue.put('FI1_Signal', '')
-        softglue.put('FO19_Signal', '0', wait=True)
-        process_stop()
-        tkMessageBox.showinfo('Done', 'Data collection complete')
+                y_values = window_axis(y, level.y_step, level.ny)
+                z_values = window_axis(z, level.z_step, level.nz)
+                # numbered on from the last window collected
+                setup = plan.setup._replace(image_no=plan.next_image)
+                points = grid_points(y_values, z_values, pattern, setup,
+                                     'L%dW%dG' % (number, window),
+                                     'Level %d window %d point' % (number, window))
+                window_plan = compile_collection(points, rows, setup)
+                try:
+                    window_plan.check()
+                except PlanError as error:
+                    print 'Level %d window %d skipped\n%s' % (number, window, error)
+                    continue
+                window_plan = settle_overwrites(window_plan, engine.ask)
+                if window_plan is None:
+                    abort.put(1)
+                    break
+                plan = window_plan
+                grid_map_start(y_values, z_values, pattern, plan)
+                run_plan(plan)
+                save_grid_map(setup, '_L%dW%d' % (number, window))
+                cells = grid_map.cells(kind)
+                if cells and (best[0] is None or max(cells) > best[0]):
+                    best = (max(cells), grid_map.copy())
+                candidates.extend(cells)
+            if abort.get() or not candidates:
+                break
+        if best[0] is not None:
+            # leave the window with the best cell up, for auto-center
+            grid_map.restore(best[1])
+            print 'Best %s %g at Y %.4f, Z %.4f' % ((kind,) + best[0])
+        grid_map.stop()
+
+    def fly_grid(self, plan, y_values, z_values):
+        """
+        grid scan with Y flying through each row
+
+        Y runs one PVT trajectory per Z row (every other row backwards) and
+        the XPS pulses the detector and scaler once per grid point, so a
+        row costs one pass instead of a move, settle and readout per point.
+        :param plan: ScanPlan from fly_plan, one step per Z row
+        :param y_values: Y of each grid column
+        :param z_values: Z of each grid row
+        """
+        ny = len(y_values)
+        nz = len(z_values)
+        dwell = plan.steps[0].acq_period
+        for name, content in plan.trajectories():
+            with tracer.span('ftp upload', trajectory=name):
+                traj_store.publish(xps_ip, content)
+        with tracer.span('softglue config'):
+            sg_config.put('name2', 'xps_master', wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            sg_config.put('loadConfig2.PROC', 1, wait=True)
+            softglue.put('FI1_Signal', 'motor')
+        with tracer.span('struck setup'):
+            mcs.stop()
+            mcs_shadow.apply(STRUCK_EXTERNAL)
+            mcs_shadow.put('NuseAll', ny)
+        with tracer.span('detector setup'):
+            det_shadow.put('AcquirePeriod', dwell)
+            det_shadow.put('AcquireTime', plan.steps[0].exp_time)
+            det_shadow.put('TriggerMode', 3)
+            det_shadow.put('NumImages', ny)
+        with tracer.span('xps setup'):
+            xps = xps_pool.session(xps_ip)
+            # one pulse per point through the constant velocity element
+            xps.MultipleAxesPVTPulseOutputSet('M', *plan.steps[0].pulse)
+        for step in plan.steps:
+            if abort.get():
+                break
+            engine.progress(step.progress)
+            order = grid_order(ny, nz, FLY)[step.point*ny:(step.point + 1)*ny]
+            with tracer.span('prep move'):
+                require_move(plan_moves(step))
+            detector.FileName = step.file_name
+            detector.FileNumber = step.image_no
+            time_stamp = time.strftime('%d %b %Y %H:%M:%S', time.localtime())
+            with tracer.span('arm'):
+                softglue.put('BUFFER-1_IN_Signal', '1!', wait=True)
+                mcs.start()
+                detector.Acquire = 1
+            with tracer.span('pvt execution', file=step.first_file):
+                xps.execute(step.expected_time + 2*PVT_RAMP,
+                            'MultipleAxesPVTExecution', 'M', step.traj_name, 1)
+            with tracer.span('readout wait'):
+                if not wait_done(detector, 'Acquire', timeout=readout_timeout):
+                    print 'Detector still acquiring, stopping it'
+                    detector.Acquire = 0
+                    if not wait_done(detector, 'Acquire', timeout=readout_timeout):
+                        raise ReadoutError(READOUT_TIMED_OUT % readout_timeout)
+            file_index.add(frame_files(step))
+            engine.gui(advance_image_no, step.image_no + step.num_images)
+            positions = motor_snapshot.take()
+            # omega does not move in a fly grid
+            w_now = positions['w'][0]
+            clock = [dwell*50e6]*ny
+            counts = [0]*ny
+            with tracer.span('scaler wait'):
+                scaler_done = wait_done(mcs, 'Acquiring', timeout=scaler_timeout)
+            if scaler_done:
+                clock = list(mcs.readmca(1)[:ny])
+                counts = list(mcs.readmca(4)[:ny])
+            else:
+                mcs.stop()
+            # frames arrive in travel order, log them by grid point
+            for frame, (file_name, (g_index, each_z, ysteps)) in enumerate(
+                    zip(frame_files(step), order)):
+                cps = int(counts[frame]/(clock[frame]/50e6 or dwell))
+                if scaler_done:
+                    grid_map.add_counts((each_z, ysteps), cps)
+                with tracer.span('log write'):
+                    run_log.write(step.log_path, scan_record(
+                        time_stamp, file_name, w_now, w_now, 'G' + str(g_index),
+                        step.exp_time, cps, positions, y=y_values[ysteps], z=z_values[each_z]),
+                        log_headers(plan.setup))
+        # recover
+        det_shadow.put('TriggerMode', 0)
+        det_shadow.put('NumImages', 1)
+        mcs_shadow.put('NuseAll', 1)
 
 
 class Shutter:
@@ -1535,6 +1669,9 @@ class Shutter:
         self.close_error.set('')
         self.open_correction.set('')
         self.close_correction.set('')
+        self.auto_apply = IntVar()
+        self.calibration = StringVar()
+        self.key = None
 
         # define and place widgets
         self.head_delay = Label(self.frame, text='Shutter delay inputs')
@@ -1584,6 +1721,16 @@ class Shutter:
         self.button_make_correction = Button(self.frame, text='Apply Correction',
                                              command=self.modify_delay)
         self.button_make_correction.grid(row=7, rowspan=2, column=3, padx=10)
+        self.head_calibration = Label(self.frame, text='Calibration from recent scans')
+        self.head_calibration.grid(row=9, column=0, columnspan=4, pady=10)
+        self.check_auto_apply = Checkbutton(self.frame,
+                                            text='Apply calibrated delays between scans',
+                                            variable=self.auto_apply)
+        self.check_auto_apply.grid(row=10, column=0, columnspan=3, padx=5, sticky=W)
+        self.button_forget = Button(self.frame, text='Forget', command=self.forget_calibration)
+        self.button_forget.grid(row=10, column=3, padx=10)
+        self.label_calibration = Label(self.frame, textvariable=self.calibration, width=40)
+        self.label_calibration.grid(row=11, column=0, columnspan=4, padx=5, pady=5)
 
         # hide window on startup
         self.popup.withdraw()
@@ -1614,47 +1761,38 @@ class Shutter:
             self.close_delay.set('%.3f' % forced_min)
             invalid_entry()
 
-    def shutter_error_calc(self, motor_dwell):
-        # get 8MHz counts for each component
-        # motor_counts = softglue.get('UpCntr-1_COUNTS')
-        shutter_counts = softglue.get('UpCntr-3_COUNTS')
-        delta_counts = softglue.get('UpCntr-4_COUNTS')
-        # determine if shutter preceded motor
-        if softglue.get('DFF-4_OUT_BI'):
-            sign = -1
-        else:
-            sign = 1
-        # define endpoints w.r.t. tm_zero = 0
-        # tm_final = motor_counts
-        ts_zero = delta_counts*sign
-        ts_final = ts_zero + shutter_counts
-        # calculate errors and corrections in seconds
-        freq = 8000000
-        # motor_dwell = motor_time
-        shutter_dwell = shutter_counts/freq
-        open_error = ts_zero/freq
-        close_error = ts_final/freq - motor_dwell
-        open_correction = (self.open_delay.get() + open_error)
-        close_correction = (self.close_delay.get() + close_error)
-        if not shutter_counts == 0:
-            self.motor_dwell.set('%.3f' % motor_dwell)
-            self.shutter_dwell.set('%.3f' % shutter_dwell)
-            if open_error < 0:
-                op_message = '%.3f' % abs(open_error) + ' early'
-            else:
-                op_message = '%.3f' % open_error + ' late'
-            self.open_error.set(op_message)
-            if close_error < 0:
-                cl_message = '%.3f' % abs(close_error) + ' early'
-            else:
-                cl_message = '%.3f' % close_error + ' late'
-            self.close_error.set(cl_message)
-            self.open_correction.set('%.3f' % open_correction)
-            self.close_correction.set('%.3f' % close_correction)
-        else:
-            self.motor_dwell.set('%.3f' % motor_dwell)
+    def snapshot(self):
+        """
+        delays and auto-apply as a plan is compiled, see PlanSetup.shutter
+        """
+        return self.open_delay.get(), self.close_delay.get(), self.auto_apply.get()
+
+    def show_sync(self, motor_dwell, sync, key=None):
+        """
+        :param motor_dwell: seconds the motor gate was open
+        :param sync: SXD_shutter.ShutterSync of the scan, None if unknown
+        :param key: regime the scan was added to the calibration of
+        """
+        self.motor_dwell.set('%.3f' % motor_dwell)
+        if sync is None:
             self.open_error.set('Unknown')
             self.close_error.set('Unknown')
+            return
+        self.shutter_dwell.set('%.3f' % sync.shutter_dwell)
+        if sync.open_error < 0:
+            op_message = '%.3f' % abs(sync.open_error) + ' early'
+        else:
+            op_message = '%.3f' % sync.open_error + ' late'
+        self.open_error.set(op_message)
+        if sync.close_error < 0:
+            cl_message = '%.3f' % abs(sync.close_error) + ' early'
+        else:
+            cl_message = '%.3f' % sync.close_error + ' late'
+        self.close_error.set(cl_message)
+        self.open_correction.set('%.3f' % sync.open_delay)
+        self.close_correction.set('%.3f' % sync.close_delay)
+        if key is not None:
+            self.show_calibration(key)
 
     def error_calc_clear(self):
         self.motor_dwell.set('')
@@ -1673,6 +1811,34 @@ class Shutter:
         self.open_delay.set('%.3f' % self.open_correction.get())
         self.close_delay.set('%.3f' % self.close_correction.get())
 
+    def show_delays(self, key, open_delay, close_delay):
+        """
+        calibrated delays a scan ran with, shown in the delay entries
+        :param key: SXD_shutter.regime of the scan
+        """
+        # entries hold ms, smaller changes are noise
+        if abs(open_delay - self.open_delay.get()) >= 0.0005 or \
+                abs(close_delay - self.close_delay.get()) >= 0.0005:
+            print 'Shutter delays for %s: open %.3f, close %.3f' % (key, open_delay, close_delay)
+            self.open_delay.set('%.3f' % open_delay)
+            self.close_delay.set('%.3f' % close_delay)
+
+    def show_calibration(self, key):
+        self.key = key
+        estimate = shutter_cal.delays(key)
+        if estimate is None:
+            self.calibration.set('%s: %d of %d scans' % (
+                key, shutter_cal.count(key), shutter_cal.min_samples))
+        else:
+            self.calibration.set('%s: open %.3f, close %.3f (%d scans)' % (
+                (key,) + estimate + (shutter_cal.count(key),)))
+
+    def forget_calibration(self):
+        if self.key is None:
+            return
+        shutter_cal.forget(self.key)
+        self.show_calibration(self.key)
+
 
 class BusyWindow:
     def __init__(self, master):
@@ -1683,6 +1849,7 @@ class BusyWindow:
         self.frame.pack()
 
         self.current_index = StringVar()
+        self.last_frame = StringVar()
 
         self.label1 = Label(self.frame, text='Data collection in progress')
         self.label1.pack(pady=10)
@@ -1692,6 +1859,8 @@ class BusyWindow:
         self.label2.pack(pady=10)
         self.label3 = Label(self.frame, textvariable=self.current_index)
         self.label3.pack(pady=10)
+        self.label4 = Label(self.frame, textvariable=self.last_frame)
+        self.label4.pack(pady=5)
         # ###self.popup.configure(bg='white')
         # ###self.label1.configure(bg='white')
         # ###self.label2.configure(bg='white')
@@ -1699,6 +1868,73 @@ class BusyWindow:
         self.popup.withdraw()
 
 
+class HeatMap:
+    """
+    HeatMap draws the GridMap of the running grid scan, Z up and Y across
+    """
+
+    def __init__(self, master, size=300):
+        """
+        :param master: root window
+        :param size: canvas width and height in pixels
+        """
+        self.popup = Toplevel(master)
+        self.popup.title('Grid map')
+        self.size = size
+        self.drawn = None
+
+        self.frame = Frame(self.popup)
+        self.frame.pack()
+
+        self.kind = StringVar()
+        self.kind.set(MAPS[0])
+        self.best = StringVar()
+
+        self.canvas = Canvas(self.frame, width=size, height=size, bg=normal_bg)
+        self.canvas.grid(row=0, column=0, columnspan=len(MAPS), padx=10, pady=10)
+        for column, kind in enumerate(MAPS):
+            self.kind_button = Radiobutton(self.frame, text=kind, variable=self.kind,
+                                           value=kind, command=self.redraw)
+            self.kind_button.grid(row=1, column=column, padx=5)
+        self.label_best = Label(self.frame, textvariable=self.best)
+        self.label_best.grid(row=2, column=0, columnspan=len(MAPS), pady=5)
+
+        self.popup.withdraw()
+
+    def show(self):
+        self.drawn = None
+        self.popup.deiconify()
+
+    def refresh(self):
+        """
+        redraw if the map has changed, called from engine_poll
+        """
+        if self.drawn != grid_map.version and self.popup.winfo_viewable():
+            self.redraw()
+
+    def redraw(self):
+        self.drawn = grid_map.version
+        self.canvas.delete('all')
+        image = grid_map.image(self.kind.get())
+        nz, ny = image.shape
+        if not nz or not ny:
+            return
+        cell = min(self.size/ny, self.size/nz)
+        colours = grid_map.colours(self.kind.get())
+        for zsteps in range(nz):
+            # highest Z at the top
+            top = (nz - 1 - zsteps)*cell
+            for ysteps in range(ny):
+                self.canvas.create_rectangle(ysteps*cell, top, (ysteps + 1)*cell, top + cell,
+                                             fill=colours[zsteps][ysteps], outline='')
+        if numpy.isnan(image).all():
+            self.best.set('')
+            return
+        zsteps, ysteps = numpy.unravel_index(numpy.nanargmax(image), image.shape)
+        self.best.set('Highest %s at Y %.3f, Z %.3f' % (
+            self.kind.get(), grid_map.y[ysteps], grid_map.z[zsteps]))
+
+
 class Extra:
     def __init__(self, master):
         self.frame = Frame(master, padx=10, pady=5)
@@ -1881,80 +2117,48 @@ class Extra:
         """
         Iterates data collection, file building, and routine for GUI checkboxes
         """
-        prefix.image_no_validation()
-        # Ensure file path exists, halt execution if it does not
-        if os.path.exists(prefix.pathName.get()):
-            pass
-        else:
-            path_warn()
+        if not run_ready():
             return
-        process_start()
-        # define recovery (or abort) values
-        mSolX_ipos = mSolX.RBV
-        mSolY_ipos = mSolY.RBV
-        mSolT_ipos = mSolT.RBV
-        mW_ipos = mW.RBV
-        mDet_ipos = mDet.RBV
-        w_index = 0
-        # Define grid for iteration (as opposed to Cx list)
+        plan = plan_ready(self.omega_points())
+        if plan is None:
+            return
+        if do.dry_run.get():
+            return dry_run(plan)
+        engine.start(self.run_step_then_soller, plan)
+
+    def omega_points(self):
+        """
+        one plan point per omega step, relative to where omega is now
+        """
+        w_now = mW.RBV
+        total = str(self.num_steps.get())
+        points = []
         for wsteps in range(self.num_steps.get()):
-            if not abort.get():
-                pass
-            else:
-                break
-            w_index += 1
-            w_filebit = str(w_index)
-            # display current data point
-            total = str(self.num_steps.get())
-            working.current_index.set('Grid point ' + w_filebit + ' of ' + total)
+            w_filebit = str(wsteps + 1)
+            moves = ()
             if self.num_steps.get() > 1:
-                w_rel = self.rel_min.get() + wsteps * self.step_size.get()
-                w_abs = mW_ipos + w_rel
-                mW.move(w_abs, wait=True)
-            # Build partial file name for this Gx
-            w_file_part = prefix.sampleName.get() + '_P' + \
-                          prefix.pressureNo.get() + '_W' + w_filebit
-            # Define list for iterating Dx
-            detector_rows = [
-                (det1, '_D1', det1.collect.get()),
-                (det2, '_D2', det2.collect.get()),
-                (det3, '_D3', det3.collect.get()),
-                (det4, '_D4', det4.collect.get()),
-                (det5, '_D5', det5.collect.get()),
-                (det6, '_D6', det6.collect.get()),
-                (det7, '_D7', det7.collect.get()),
-                (det8, '_D8', det8.collect.get()),
-                (det9, '_D9', det9.collect.get())]
-            for position, d_filebit, det_collect in detector_rows:
-                if not abort.get():
-                    pass
-                else:
-                    break
-                if det_collect:
-                    # Build partial file name for this Dx
-                    position.rot_file_part = w_file_part + d_filebit
-                    # Go to stack- and detector-appropriate routine
-                    if config.detector_choice.get() == '1M':
-                        position.dc_1m_diffraction()
-                    elif config.detector_choice.get() == 'CCD':
-                        position.dc_ccd_diffraction()
-                    elif config.detector_choice.get() == 'IP':
-                        position.step_ccd_diffraction()
-        # return to initial positions (or resume continuous collection)
-        mSolX.move(mSolX_ipos)
-        mSolY.move(mSolY_ipos)
-        mSolT.move(mSolT_ipos)
-        mW.move(mW_ipos, wait=True)
-        mDet.move(mDet_ipos, wait=True)
-        abort.put(0)
-        softglue.put('FI1_Signal', '')
-        softglue.put('FO19_Signal', '0', wait=True)
-        process_stop()
-        tkMessageBox.showinfo('Done', 'Data collection complete')
+                moves = (('W', w_now + self.rel_min.get() + wsteps*self.step_size.get()),)
+            # Build partial file name for this Wx
+            file_part = prefix.sampleName.get() + '_P' + \
+                prefix.pressureNo.get() + '_W' + w_filebit
+            points.append(ScanPoint(file_part, 'Grid point ' + w_filebit + ' of ' + total, moves))
+        return points
+
+    def run_step_then_soller(self, plan):
+        """
+        Worker thread part of step_then_soller
+        :param plan: ScanPlan compiled from the omega steps
+        """
+        with restoring([mSolX, mSolY, mSolT, mW, mDet]):
+            run_plan(plan)
+        return 'Data collection complete'
 
 
 # define basic functions
 def quit_now():
+    xps_pool.close_all()
+    metrics_pool.close()
+    save_shutter_calibration()
     quit()
 
 
@@ -1975,13 +2179,408 @@ def limits_warn():
                              'Input was reset to default value')
 
 
+def run_ready():
+    """
+    checks done on the GUI thread before a collection job is started
+    :return: True if the job may start
+    """
+    if engine.busy():
+        return False
+    prefix.image_no_validation()
+    # Ensure file path exists, halt execution if it does not
+    if os.path.exists(prefix.pathName.get()):
+        pass
+    else:
+        path_warn()
+        return False
+    process_start()
+    tracer.begin()
+    efficiency.clear()
+    return True
+
+
+def axis_info(motor, vmax=None):
+    """
+    motor record fields the plan compiler needs, read once per plan
+    :param vmax: speed limit, the record's VMAX if not given
+    """
+    if vmax is None:
+        vmax = motor.get('VMAX')
+    return Axis(motor.get('LLM'), motor.get('HLM'), motor.get('VELO'),
+                motor.get('ACCL'), motor.get('VBAS'), vmax, motor.get('MRES'),
+                motor.get('DIR'), motor.get('RBV'))
+
+
+def plan_axes():
+    axes = {}
+    for name, motor in stage_motors.items():
+        if name == 'W':
+            axes[name] = axis_info(motor, mW_vmax)
+        else:
+            axes[name] = axis_info(motor)
+    return axes
+
+
+def plan_rows():
+    """
+    collecting D rows as plain values
+    """
+    rows = []
+    for index, each in enumerate(det_list):
+        if each.collect.get():
+            rows.append(RotationRow(
+                index, each.dnumber, each.detPos.get(), each.wStart.get(),
+                each.wRange.get(), each.nPTS.get(), each.tPerDeg.get(),
+                each.wide.get(), each.steps.get(), each.num_wide.get()))
+    return rows
+
+
+def plan_setup():
+    # Go to stack- and detector-appropriate routine
+    if config.detector_choice.get() == '1M':
+        routine = PVT_1M
+    elif config.detector_choice.get() == 'CCD' and not config.stack_choice.get() == 'BMDHL':
+        routine = PVT_CCD
+    elif config.detector_choice.get() in ('CCD', 'IP'):
+        routine = STEP_CCD
+    else:
+        routine = None
+    return PlanSetup(routine, prefix.sampleName.get(), prefix.pressureNo.get(),
+                     int(prefix.imageNo.get()), prefix.name_flag.get(),
+                     prefix.pathName.get(), extras.soller_flag.get(),
+                     pvt_width, w_positioner, do.alternate.get(), do.synth_wide.get(),
+                     config.stack_choice.get(), config.detector_choice.get(), shutter.snapshot())
+
+
+def file_stem(setup):
+    return setup.sample_name + '_P' + setup.pressure_no
+
+
+def compile_collection(points, rows=None, setup=None):
+    """
+    compile a list of ScanPoints, with points or detector rows as the
+    outer loop, whichever moves the stages less
+    :param rows: RotationRows, the GUI rows if not given
+    :param setup: PlanSetup, the GUI settings if not given
+    """
+    if rows is None:
+        rows = plan_rows()
+    if setup is None:
+        setup = plan_setup()
+    with tracer.span('compile'):
+        plan, nesting, seconds = choose_nesting(points, rows, setup, plan_axes())
+    if seconds:
+        print 'Loop order: ' + nesting + ', ' + ', '.join(
+            '%s %.1f s' % (name, seconds[name]) for name in sorted(seconds)) + ' of moves'
+    return plan
+
+
+def grid_points(y_values, z_values, pattern, setup, label='G', progress='Grid point'):
+    """
+    one plan point per grid point
+    :param y_values: absolute Y of each column
+    :param z_values: absolute Z of each row
+    :param setup: PlanSetup the file names are taken from
+    :param label: file name part before the grid index
+    :param progress: busy window text before 'n of N'
+    """
+    ny = len(y_values)
+    nz = len(z_values)
+    points = []
+    for g_index, zsteps, ysteps in grid_order(ny, nz, pattern):
+        moves = []
+        if nz > 1:
+            moves.append(('Z', z_values[zsteps]))
+        if ny > 1:
+            moves.append(('Y', y_values[ysteps]))
+        # Build partial file name for this Gx
+        file_part = file_stem(setup) + '_' + label + str(g_index)
+        points.append(ScanPoint(file_part, progress + ' ' + str(g_index) + ' of ' + str(nz*ny),
+                                tuple(moves)))
+    return points
+
+
+def grid_map_start(y_values, z_values, pattern, plan):
+    """
+    point the live map at the grid about to be collected
+    """
+    ny = len(y_values)
+    grid_map.start(ny, len(z_values), y_values, z_values)
+    # plan points follow grid_order, see grid_points
+    cells = [(zsteps, ysteps) for g_index, zsteps, ysteps
+             in grid_order(ny, len(z_values), pattern)]
+    if pattern == FLY:
+        # one step per row, frames in travel order
+        for step in plan.steps:
+            for name, cell in zip(frame_files(step), cells[step.point*ny:(step.point + 1)*ny]):
+                grid_map.expect_files([name], cell)
+        return
+    for point, cell in enumerate(cells):
+        grid_map.expect_point(point, cell)
+    for step in plan.steps:
+        grid_map.expect_files(frame_files(step), cells[step.point])
+
+
+def fly_plan(y_values, z_values):
+    """
+    fly grid rows as plan steps, so they are limit and overwrite checked
+    like any other scan
+    """
+    # one still per point with the detector at the first collecting row
+    position = det1
+    for each in det_list:
+        if each.collect.get():
+            position = each
+            break
+    return fly_grid_steps(plan_setup(), plan_axes(), len(y_values), y_values[0],
+                          y_grid.step_size.get(), z_values, grid_pattern.dwell.get(),
+                          position.detPos.get(), y_positioner)
+
+
+def save_grid_map(setup, tag=''):
+    """
+    :param setup: PlanSetup of the grid, for the path and file name
+    :param tag: added to the file name, e.g. the window of an adaptive grid
+    """
+    map_path = setup.path + file_stem(setup) + '_gridmap' + tag + \
+        time.strftime('_%Y%m%d_%H%M%S.npz')
+    try:
+        grid_map.save(map_path)
+    except IOError as error:
+        print 'Grid map not saved: ' + str(error)
+
+
+def plan_ready(points):
+    """
+    compile a plan on the GUI thread and refuse it if any step is unsafe
+    :return: ScanPlan, or None if it was rejected
+    """
+    return plan_accepted(compile_collection(points))
+
+
+def plan_accepted(plan):
+    """
+    refuse a compiled plan if any step is unsafe, and settle overwrites
+    with the operator
+    :return: ScanPlan, or None if it was rejected
+    """
+    try:
+        plan.check()
+    except PlanError as error:
+        process_stop()
+        tkMessageBox.showwarning('Limits Violation',
+                                 'Plan rejected before any move\n' + str(error))
+        return None
+    if do.dry_run.get():
+        return plan
+    plan = settle_overwrites(plan, tkMessageBox.askyesnocancel)
+    if plan is None:
+        process_stop()
+    return plan
+
+
+def settle_overwrites(plan, ask):
+    """
+    resolve every file a plan would overwrite with one question, up front
+    :param ask: function(title, message) answering True to overwrite,
+        False to skip those steps, None to cancel
+    :return: ScanPlan without any skipped steps, or None if cancelled
+    """
+    file_index.use(plan.setup.path)
+    conflicts = file_index.conflicts(plan)
+    if not conflicts:
+        return plan
+    shown = [plan.steps[index].first_file for index in conflicts[:5]]
+    if len(conflicts) > 5:
+        shown.append('... %d more' % (len(conflicts) - 5))
+    answer = ask('Overwrite Warning',
+                 '%d scan(s) would overwrite existing files:\n%s\n\n'
+                 'Yes to overwrite them, No to skip them.' %
+                 (len(conflicts), '\n'.join(shown)))
+    if answer is None:
+        return None
+    if answer:
+        return plan
+    return plan.without(conflicts)
+
+
+def dry_run(plan, fly=None):
+    """
+    model a plan against the motor records instead of running it
+    :param fly: arguments for DryRun.fly_grid when grid_scan flies
+    """
+    known = set()
+    for names in traj_store.known.values():
+        known |= names
+    model = DryRun(plan_axes(), config.detector_choice.get(), known=known)
+    if fly is None:
+        model.run(plan)
+    else:
+        model.fly_grid(*fly)
+    process_stop()
+    report = model.report()
+    print report
+    tkMessageBox.showinfo('Dry run', report)
+
+
+def advance_image_no(image_no):
+    """
+    GUI thread: raise the next image number, never lower it
+    """
+    try:
+        if int(prefix.imageNo.get()) >= image_no:
+            return
+    except ValueError:
+        pass
+    prefix.imageNo.set(str(image_no).zfill(3))
+
+
+def shutter_delays(step, setup):
+    """
+    delays for one scan, the calibrated ones of its regime if
+    Apply calibrated delays was checked when the plan was compiled
+    :return: (SXD_shutter.regime of the scan, open delay, close delay)
+    """
+    open_delay, close_delay, auto_apply = setup.shutter
+    key = regime(setup.stack, step.routine, step.expected_time)
+    estimate = shutter_cal.delays(key)
+    if auto_apply and estimate is not None:
+        open_delay, close_delay = estimate
+        engine.gui(shutter.show_delays, key, open_delay, close_delay)
+    engine.gui(shutter.show_calibration, key)
+    return key, open_delay, close_delay
+
+
+def shutter_sync(key, open_delay, close_delay, motor_dwell, sample=True):
+    """
+    shutter timing of the last scan from the SoftGlue counters
+    :param sample: False if the scaler timed out, so motor_dwell is a guess
+        and the scan is no calibration sample
+    """
+    sync = sync_errors(softglue.get('UpCntr-3_COUNTS'), softglue.get('UpCntr-4_COUNTS'),
+                       softglue.get('DFF-4_OUT_BI'), motor_dwell, open_delay, close_delay)
+    if sync is not None and sample:
+        shutter_cal.add(key, sync.open_delay, sync.close_delay)
+    else:
+        key = None
+    engine.gui(shutter.show_sync, motor_dwell, sync, key)
+
+
+def save_shutter_calibration():
+    try:
+        shutter_cal.save()
+    except EnvironmentError as error:
+        print 'Shutter calibration not saved: ' + str(error)
+
+
+@contextmanager
+def restoring(motors, signals=('FI1_Signal',)):
+    """
+    put motors back where they are now and disarm SoftGlue once the block
+    is done, also when it stops on an error
+    :param motors: motors to restore
+    :param signals: SoftGlue inputs to clear
+    :raise MoveError: if the block ran through but a motor did not get back
+    """
+    # define recovery (or abort) values
+    restore = [(motor, motor.RBV) for motor in motors]
+    try:
+        yield
+    except Exception:
+        if not restore_positions(restore, signals):
+            # the error of the run is the one reported
+            print RESTORE_FAILED
+        raise
+    if not restore_positions(restore, signals):
+        raise MoveError(RESTORE_FAILED)
+
+
+def restore_positions(restore, signals):
+    """
+    :param restore: (motor, start position) pairs
+    :return: True if every motor got back
+    """
+    with tracer.span('restore move'):
+        restored = move_group(restore)
+    for signal in signals:
+        softglue.put(signal, '')
+    softglue.put('FO19_Signal', '0', wait=True)
+    abort.put(0)
+    return restored
+
+
+def plan_moves(step):
+    return [(stage_motors[name], position) for name, position in step.moves]
+
+
+def run_plan(plan):
+    """
+    carry out a compiled plan on the worker thread
+
+    Reports compile time and the time spent outside exposures (moves,
+    setup, readout) separately.
+    """
+    for name, content in plan.trajectories():
+        with tracer.span('ftp upload', trajectory=name):
+            traj_store.publish(xps_ip, content)
+    if plan.steps:
+        watch_frames(os.path.dirname(plan.steps[0].first_path), plan.steps[0].log_path,
+                     plan.setup.detector)
+    overhead = 0.0
+    for step in plan.steps:
+        if abort.get():
+            break
+        engine.progress(step.progress)
+        mark = tracer.mark()
+        t0 = time.time()
+        row = det_list[step.row]
+        if step.routine == PVT_1M:
+            beam_on = row.dc_1m_diffraction(step, plan.setup)
+        elif step.routine == PVT_CCD:
+            beam_on = row.dc_ccd_diffraction(step, plan.setup)
+        else:
+            beam_on = row.step_ccd_diffraction(step, plan.setup)
+        wall = time.time() - t0
+        overhead += wall - step.expected_time
+        file_index.add(step_files(step))
+        if step.log_path not in efficiency:
+            efficiency[step.log_path] = EfficiencyReport('P' + plan.setup.pressure_no)
+        efficiency[step.log_path].add(scan_time(
+            step.first_file, wall, beam_on, step.expected_time, tracer.totals(since=mark)))
+    with tracer.span('wide synthesis'):
+        for first_file, problem in frame_summer.wait():
+            print 'Wide images from ' + first_file + ' not written: ' + problem
+    finish_frames()
+    save_shutter_calibration()
+    engine.timing('Plan compile', plan.compile_time)
+    engine.timing('Scan overhead', overhead)
+
+
+def watch_frames(folder, log_path, detector_choice):
+    """
+    quality numbers for every frame as it lands
+    """
+    metrics_pool.start()
+    frame_watcher.watch(folder, SATURATION.get(detector_choice, 65535), log_path)
+
+
+def finish_frames():
+    """
+    wait for the metrics of the last frames
+    """
+    with tracer.span('frame metrics'):
+        frame_watcher.stop()
+        metrics_pool.wait()
+
+
 def process_start():
         do.start_exp_button.config(state=DISABLED)
         do.continuous_button.config(state=DISABLED)
         do.grid_scan_button.config(state=DISABLED)
         xtop = root.winfo_x() + root.winfo_width() / 2 - 150
-        ytop = root.winfo_y() + root.winfo_height() / 2 - 60
-        working.popup.geometry('300x120+%d+%d' % (xtop, ytop))
+        ytop = root.winfo_y() + root.winfo_height() / 2 - 75
+        working.popup.geometry('300x150+%d+%d' % (xtop, ytop))
+        working.last_frame.set('')
         working.popup.deiconify()
 
 
@@ -1990,6 +2589,150 @@ def process_stop():
         do.continuous_button.config(state=NORMAL)
         do.grid_scan_button.config(state=NORMAL)
         hide_working()
+        # summarize configuration puts avoided during this run
+        print mcs_shadow.report('Struck')
+        print det_shadow.report('Detector')
+        mcs_shadow.reset_stats()
+        det_shadow.reset_stats()
+
+
+def save_reports():
+    """
+    write the run's Chrome trace and efficiency reports next to the logs
+    """
+    tracer.end()
+    path = prefix.pathName.get() + prefix.sampleName.get() + '_P' + \
+        prefix.pressureNo.get() + time.strftime('_trace_%Y%m%d_%H%M%S.json')
+    try:
+        tracer.save(path)
+        for log_path, report in efficiency.items():
+            report.save(os.path.splitext(log_path)[0] + '_efficiency.txt')
+        if len(efficiency) > 1:
+            # continuous series, one line per pressure point
+            series_path = prefix.pathName.get() + prefix.sampleName.get() + \
+                time.strftime('_series_efficiency_%Y%m%d_%H%M%S.txt')
+            with open(series_path, 'w') as series:
+                series.write(series_text(efficiency.values()))
+    except IOError as error:
+        print 'Reports not saved: ' + str(error)
+    print tracer.summary()
+    if efficiency:
+        print series_text(efficiency.values())
+
+
+def report_metrics(log_path, metrics):
+    """
+    log one frame's quality numbers and pass them on to the GUI (any thread)
+    """
+    if isinstance(metrics, basestring):
+        engine.frame(metrics)
+        return
+    grid_map.add_frame(metrics.file, metrics.total)
+    problem = flagged(metrics)
+    record = {'timestamp': time.strftime('%d %b %Y %H:%M:%S', time.localtime()),
+              'file': metrics.file, 'max': metrics.max,
+              'saturated': 100*metrics.saturated, 'total': metrics.total,
+              'spots': metrics.spots}
+    if problem:
+        record['problem'] = problem
+    metrics_log.write(os.path.splitext(log_path)[0] + '_frames.txt', record,
+                      ['Frame metrics for: ' + os.path.basename(log_path)])
+    engine.frame(metrics, problem)
+
+
+def show_frame(payload):
+    metrics, problem = payload
+    if isinstance(metrics, basestring):
+        print metrics
+        return
+    text = '%s: max %d, %d spots' % (metrics.file, metrics.max, metrics.spots)
+    if problem:
+        text += ', ' + problem
+        print 'Check ' + text
+    working.last_frame.set(text)
+
+
+def run_finished(message):
+    run_log.close()
+    metrics_log.close()
+    save_reports()
+    process_stop()
+    chained = list(after_run)
+    del after_run[:]
+    if chained:
+        # e.g. auto-center, then collect, without a dialog in between
+        print message
+        for action in chained:
+            # once the worker thread is gone, so a new job may start
+            root.after(100, action)
+    elif message:
+        tkMessageBox.showinfo('Done', message)
+
+
+def run_failed(text):
+    print text
+    run_log.close()
+    frame_watcher.stop()
+    metrics_log.close()
+    grid_map.stop()
+    del after_run[:]
+    save_reports()
+    abort.put(0)
+    process_stop()
+    tkMessageBox.showerror('Data collection error', text.strip().splitlines()[-1])
+
+
+def ask_operator(question):
+    title, message = question
+    engine.answer(tkMessageBox.askyesno(title, message, default='no'))
+
+
+def run_gui_call(payload):
+    function, args = payload
+    function(*args)
+
+
+def engine_poll():
+    """
+    deliver scan engine events on the Tk thread, rescheduled with after()
+    """
+    heat_map.refresh()
+    engine.drain({
+        'progress': working.current_index.set,
+        'timing': print_timing,
+        'ask': ask_operator,
+        'frame': show_frame,
+        'done': run_finished,
+        'error': run_failed,
+        'gui': run_gui_call})
+    root.after(100, engine_poll)
+
+
+def log_headers(setup):
+    return ['Data collection values for: ' + file_stem(setup),
+            'Sample stack: ' + setup.stack + ', Detector: ' + setup.detector]
+
+
+def scan_record(time_stamp, file_name, start, end, images, exp_time, cps=None,
+                positions=None, **overrides):
+    """
+    one run log record
+    :param positions: motor_snapshot taken at collection time, taken now
+                      if not given
+    :param overrides: x, y, z or det to log instead of the snapshot value
+    """
+    if positions is None:
+        positions = motor_snapshot.take()
+    record = {'timestamp': time_stamp, 'file': file_name,
+              'start': start, 'end': end, 'images': images, 'exp_time': exp_time,
+              'positions': dict((label, {'value': value, 'time': stamp})
+                                for label, (value, stamp) in positions.items())}
+    for label in ('x', 'y', 'z', 'det'):
+        record[label] = positions[label][0]
+    record.update(overrides)
+    if cps is not None:
+        record['cps'] = cps
+    return record
 
 
 def hide_shutter():
@@ -2000,6 +2743,10 @@ def hide_working():
     working.popup.withdraw()
 
 
+def hide_heat_map():
+    heat_map.popup.withdraw()
+
+
 def path_put(**kwargs):
     prefix.detPath.set(detector.get('FilePath_RBV', as_string=True))
     # test User directory autofill Feb 2016
@@ -2019,153 +2766,35 @@ def path_put(**kwargs):
         windows_path = os.path.normpath(user_directory) + '\\'
         prefix.pathName.set(windows_path)
         # prefix.path_name_validation()
+    elif sim is not None:
+        # simulated detector writes straight to a local folder
+        windows_path = os.path.join(result, '')
+        prefix.pathName.set(windows_path)
     else:
         windows_path = 'path error'
     if not os.path.exists(windows_path):
         prefix.label_user_dir.config(bg='red')
     else:
-        prefix.label_user_dir.config(bg='SystemButtonFace')
+        prefix.label_user_dir.config(bg=normal_bg)
 
 
 def xps_initialize():
     if not config.stack_choice.get() == 'BMDHL':
-        myxps = XPS_Q8_drivers.XPS()
-        socketId = myxps.TCP_ConnectToServer(xps_ip, 5001, 20)
-        activated = myxps.EventExtendedGet(socketId, 0)
+        xps = xps_pool.session(xps_ip)
+        activated = xps.EventExtendedGet(0)
         if activated == [-83, 'EventExtendedGet(0,char *,char *)']:
-            myxps.EventExtendedConfigurationTriggerSet(socketId, ('Always', 'M.PVT.TrajectoryStart'), ('0', '0'), ('0', '0'), ('0', '0'), ('0', '0'))
-            myxps.EventExtendedConfigurationActionSet(socketId, ['GPIO3.DO.DOSet'], '1', '1', '0', '0')
-            myxps.EventExtendedStart(socketId)
-            myxps.EventExtendedConfigurationTriggerSet(socketId, ('Always', 'M.PVT.TrajectoryEnd'), ('0', '0'), ('0', '0'), ('0', '0'), ('0', '0'))
-            myxps.EventExtendedConfigurationActionSet(socketId, ['GPIO3.DO.DOSet'], '1', '0', '0', '0')
-            myxps.EventExtendedStart(socketId)
-            activated = myxps.EventExtendedGet(socketId, 0)
+            xps.EventExtendedConfigurationTriggerSet(('Always', 'M.PVT.TrajectoryStart'), ('0', '0'), ('0', '0'), ('0', '0'), ('0', '0'))
+            xps.EventExtendedConfigurationActionSet(['GPIO3.DO.DOSet'], '1', '1', '0', '0')
+            xps.EventExtendedStart()
+            xps.EventExtendedConfigurationTriggerSet(('Always', 'M.PVT.TrajectoryEnd'), ('0', '0'), ('0', '0'), ('0', '0'), ('0', '0'))
+            xps.EventExtendedConfigurationActionSet(['GPIO3.DO.DOSet'], '1', '0', '0', '0')
+            xps.EventExtendedStart()
+            activated = xps.EventExtendedGet(0)
             print activated
-            activated = myxps.EventExtendedGet(socketId, 1)
+            activated = xps.EventExtendedGet(1)
             print activated
         else:
             print 'XPS already initialized'
-        myxps.TCP_CloseSocket(socketId)
-
-
-def make_trajectory(zero, min, max, velo, motor):
-    if config.stack_choice.get() == 'LH':
-        line_a = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_b = ['0', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_c = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0']
-    elif config.stack_choice.get() == 'GPSS':
-        line_a = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_b = ['0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_c = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-    else:
-        line_a = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_b = ['0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-        line_c = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-    if motor.get('DIR') == 0:
-        sign = 1
-    else:
-        sign = -1
-    delta_xac = sign*(min - zero)
-    delta_xb = sign*(max - min)
-    velo_ab = sign*velo
-    delta_tb = delta_xb/velo_ab
-    if config.stack_choice.get() == 'GPHP':
-        line_a[5] = str(delta_xac)
-        line_a[6] = str(velo_ab)
-        line_b[0] = str(delta_tb)
-        line_b[5] = str(delta_xb)
-        line_b[6] = str(velo_ab)
-        line_c[5] = str(delta_xac)
-    else:
-        line_a[7] = str(delta_xac)
-        line_a[8] = str(velo_ab)
-        line_b[0] = str(delta_tb)
-        line_b[7] = str(delta_xb)
-        line_b[8] = str(velo_ab)
-        line_c[7] = str(delta_xac)
-    line_a = ','.join(line_a)
-    line_b = ','.join(line_b)
-    line_c = ','.join(line_c)
-    complete_file = (line_a + '\n' + line_b + '\n' + line_c + '\n')
-    print complete_file
-    traj_file = open('traj.trj', 'w')
-    traj_file.write(complete_file)
-    traj_file.close()
-    session = ftplib.FTP(xps_ip, user='Administrator', passwd='Administrator')
-    session.cwd('Public/Trajectories/')
-    traj_file = open('traj.trj')
-    session.storlines('STOR traj.trj', traj_file)
-    traj_file.close()
-    session.quit()
-
-
-def make_soller_trajectory(theta_zero, theta_min, theta_max, num_points, time_total):
-    # theta_range has to be negative, so min-max instead of max-min
-    theta_range = theta_max - theta_min
-    # r is offset
-    r = 62.700
-    # ###GSECARS r = 34.430
-    delta_time = time_total/(num_points - 1)
-    print delta_time
-    delta_theta = theta_range/(num_points - 1)
-    v_theta = theta_range/time_total
-    x_zero = r + r*cos(theta_zero*pi/180)
-    y_zero = r*sin(theta_zero*pi/180)
-    print x_zero, y_zero, theta_zero
-    delta_sx_zero = r * (cos(theta_min * pi / 180) - cos(theta_zero * pi / 180))
-    delta_sy_zero = r * (sin(theta_min * pi / 180) - sin(theta_zero * pi / 180))
-    vx_out_zero = -r*sin(theta_min*pi/180)*v_theta*pi/180
-    vy_out_zero = r*cos(theta_min*pi/180)*v_theta*pi/180
-    delta_theta_zero = v_theta*.25*1.5
-    ramp_line = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-    ramp_line[11] = '%.5f' % -delta_sx_zero
-    ramp_line[12] = '%.5f' % -vx_out_zero
-    ramp_line[13] = '%.5f' % -delta_sy_zero
-    ramp_line[14] = '%.5f' % -vy_out_zero
-    ramp_line[15] = '%.5f' % -delta_theta_zero
-    ramp_line[16] = '%.5f' % -v_theta
-    temp_line = ','.join(ramp_line)
-    complete_file = temp_line + '\n'
-    run_line = ['0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
-    run_line[0] = '%.5f' % delta_time
-    run_line[15] = '%.5f' % -delta_theta
-    run_line[16] = '%.5f' % -v_theta
-    for each in range(num_points - 1):
-        theta_i = theta_min + (delta_theta*each)
-        theta_f = theta_i + delta_theta
-        delta_sx = r*(cos(theta_f*pi/180)-cos(theta_i*pi/180))
-        delta_sy = r*(sin(theta_f*pi/180)-sin(theta_i*pi/180))
-        vx_out = -r*sin(theta_f*pi/180)*v_theta*pi/180
-        vy_out = r*cos(theta_f*pi/180)*v_theta*pi/180
-        run_line[11] = '%.5f' % -delta_sx
-        run_line[12] = '%.5f' % -vx_out
-        run_line[13] = '%.5f' % -delta_sy
-        run_line[14] = '%.5f' % -vy_out
-        temp_line = ','.join(run_line)
-        complete_file += temp_line + '\n'
-    theta_max = theta_min + theta_range
-    theta_final = theta_max + v_theta*0.375
-    delta_theta_final = delta_theta_zero
-    delta_sx_final = r * (cos(theta_final * pi / 180) - cos(theta_max * pi / 180))
-    delta_sy_final = r * (sin(theta_final * pi / 180) - sin(theta_max * pi / 180))
-    ramp_line[11] = '%.5f' % -delta_sx_final
-    ramp_line[12] = '0.00000'
-    ramp_line[13] = '%.5f' % -delta_sy_final
-    ramp_line[14] = '0.00000'
-    ramp_line[15] = '%.5f' % -delta_theta_final
-    ramp_line[16] = '0.00000'
-    temp_line = ','.join(ramp_line)
-    complete_file += temp_line + '\n'
-    print complete_file
-    traj_file = open('soller_traj.trj', 'w')
-    traj_file.write(complete_file)
-    traj_file.close()
-    session = ftplib.FTP('164.54.164.24', user='Administrator', passwd='Administrator')
-    session.cwd('Public/Trajectories/')
-    traj_file = open('soller_traj.trj')
-    session.storlines('STOR soller_traj.trj', traj_file)
-    traj_file.close()
-    session.quit()
 
 
 '''
@@ -2178,6 +2807,36 @@ root.withdraw()
 config = ExpConfigure(root)
 root.wait_window(config.popup)
 
+# one persistent socket per XPS controller, shared by all routines
+if sim is None:
+    xps_pool = XPSPool()
+else:
+    xps_pool = XPSPool(port=sim.xps_port)
+# data collection runs on the engine's worker thread
+engine = ScanEngine()
+# trajectories named by content, uploaded once per controller
+if sim is None:
+    traj_store = TrajectoryStore()
+else:
+    traj_store = TrajectoryStore(ftp=sim.ftp)
+# one open log per pressure point, flushed every few scans
+run_log = RunLog()
+# listing of the user folder for overwrite checks
+file_index = DirectoryIndex()
+frame_summer = FrameSummer()
+metrics_log = RunLog()
+metrics_pool = MetricsPool(report_metrics)
+grid_map = GridMap()
+# GUI thread actions to run once the current job has finished
+after_run = []
+frame_watcher = FrameWatcher(metrics_pool)
+shutter_cal = ShutterCalibration()
+shutter_cal.load()
+# phase timings of the current run, saved as a Chrome trace
+tracer = Tracer()
+# beam-on efficiency of the current run, by run log (pressure point)
+efficiency = OrderedDict()
+
 '''
 With choices made, define relevant epics devices
 '''
@@ -2200,6 +2859,13 @@ softglue_args = ['FI1_Signal', 'FI2_Signal', 'FI3_Signal', 'FI4_Signal',
 
 sg_config_args = ['name1', 'name2', 'loadConfig1.PROC', 'loadConfig2.PROC']
 
+# XPS group M layout: positioners in the group and the place of omega
+# and Y in it (None when Y is not an XPS positioner), custom
+# configuration files may override these
+pvt_width = 5
+w_positioner = 4
+y_positioner = None
+
 # option to load and read custom configuration
 if config.use_file.get():
     user_config = tkFileDialog.askopenfile(
@@ -2219,6 +2885,9 @@ elif config.stack_choice.get() == 'GPHP':
     abort = PV('16IDB:Unidig1Bo1')
     mW_vmax = 10.0
     xps_ip = '164.54.164.24'
+    pvt_width = 5
+    w_positioner = 3
+    y_positioner = 2
 
 elif config.stack_choice.get() == 'GPHL':
     mX = Motor('16HEXGP:m1')
@@ -2232,6 +2901,8 @@ elif config.stack_choice.get() == 'GPHL':
     abort = PV('16IDB:Unidig1Bo1')
     mW_vmax = 10.0
     xps_ip = '164.54.164.24'
+    pvt_width = 5
+    w_positioner = 4
 
 elif config.stack_choice.get() == 'GPSS':
     mX = Motor('XPSGP:m1')
@@ -2252,6 +2923,9 @@ elif config.stack_choice.get() == 'GPSS':
     mW_vmax = 10.0
     mSotT_vmax = 10.0
     xps_ip = '164.54.164.24'
+    pvt_width = 8
+    w_positioner = 4
+    y_positioner = 2
 
 elif config.stack_choice.get() == 'LH':
     pass
@@ -2266,6 +2940,9 @@ elif config.stack_choice.get() == 'LH':
     abort = PV('16IDB:Unidig1Bo1')
     mW_vmax = 10.0
     xps_ip = '164.54.164.104'
+    pvt_width = 4
+    w_positioner = 4
+    y_positioner = 2
 
 elif config.stack_choice.get() == 'BMDHP':
     pass
@@ -2292,6 +2969,24 @@ elif config.stack_choice.get() == 'BMDHL':
 else:
     pass
 
+if sim is not None:
+    # every controller is the fake XPS, which carries group M along
+    xps_ip = sim.xps_ip
+    sim.group({w_positioner: mW, y_positioner: mY})
+
+# plan axis names for the motors above
+stage_motors = {'X': mX, 'Y': mY, 'Z': mZ, 'W': mW, 'Det': mDet}
+if 'mSolT' in globals():
+    stage_motors.update(SolX=mSolX, SolY=mSolY, SolT=mSolT)
+
+# readbacks logged with every scan, kept current by CA monitors; custom
+# configuration files may add to snapshot_pvs before this point
+if 'snapshot_pvs' not in globals():
+    snapshot_pvs = {}
+snapshot_pvs.update(dict((name.lower(), motor.PV('RBV'))
+                         for name, motor in stage_motors.items()))
+motor_snapshot = Snapshot(snapshot_pvs)
+
 # create detector device
 detector_args = ['ShutterMode', 'ShutterControl', 'AcquireTime',
                  'AcquirePeriod', 'NumImages', 'TriggerMode',
@@ -2317,6 +3012,17 @@ else:
     pass
 
 detector.add_callback('FilePath_RBV', callback=path_put)
+
+# seconds to wait for the detector and scaler to report completion, the
+# detector well above its slowest readout (100 s for the image plate)
+readout_timeout = max(60.0, 3*DEFAULT_LATENCIES.readout.get(config.detector_choice.get(), 100.0))
+READOUT_TIMED_OUT = 'Detector readout not finished after %g s'
+RESTORE_FAILED = 'Stages not back at their start positions, check them before the next run'
+scaler_timeout = 1.0
+
+# remember configuration already sent to the scaler and detector
+mcs_shadow = ShadowCache(mcs, [attr for attr, value in STRUCK_EXTERNAL])
+det_shadow = ShadowCache(detector, DETECTOR_SETUP)
 # frames for displaying groups of objects
 frameFiles = Frame(root)
 frameFiles.grid(row=0, column=0, sticky='w', padx=40, pady=15)
@@ -2354,9 +3060,11 @@ xtal8 = CrystalSpot(frameCrystalSpot, label='C8')
 xtal9 = CrystalSpot(frameCrystalSpot, label='C9')
 y_grid = GridPoints(frameGridPoints, label='Cen Y (horizontal)')
 z_grid = GridPoints(frameGridPoints, label='Sam Z (vertical)')
+grid_pattern = GridPattern(frameGridPoints)
 do = Actions(frameControl)
 shutter = Shutter(root)
 working = BusyWindow(root)
+heat_map = HeatMap(root)
 
 det_list = [det1, det2, det3, det4, det5,
             det6, det7, det8, det9]
@@ -2369,7 +3077,9 @@ for each in xtal_list[3:9]:
 
 shutter.popup.protocol('WM_DELETE_WINDOW', hide_shutter)
 working.popup.protocol('WM_DELETE_WINDOW', hide_working)
+heat_map.popup.protocol('WM_DELETE_WINDOW', hide_heat_map)
 path_put()
 xps_initialize()
+engine_poll()
 root.deiconify()
 root.mainloop()
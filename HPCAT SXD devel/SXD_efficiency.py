@@ -0,0 +1,186 @@
+__author__ = 'j.smith'
+
+'''
+Beam-on efficiency of a run, from the Struck clock and wall time
+
+The Struck clock channel says how long each scan really exposed; the
+wall time of the scan and the tracer phases say where the rest went.
+One EfficiencyReport covers one pressure point and is written next to
+its run log; series_text() sums up a continuous (cont_exp) series.
+'''
+
+from collections import namedtuple
+from SXD_trace import EXPOSURE_PHASES
+
+# tracer phases by overhead group, anything untraced ends up in other
+PHASE_GROUPS = {
+    'prep move': 'move',
+    'restore move': 'move',
+    'softglue config': 'setup',
+    'struck setup': 'setup',
+    'detector setup': 'setup',
+    'xps setup': 'setup',
+    'arm': 'setup',
+    'recover': 'setup',
+    'readout wait': 'readout',
+    'frame remap': 'readout',
+    'wide synthesis': 'readout',
+    'frame metrics': 'readout',
+    'scaler wait': 'readout',
+    'image plate wait': 'readout',
+    'log write': 'log'}
+
+GROUPS = ['move', 'setup', 'ramp', 'readout', 'log', 'other']
+
+# wall, beam on, expected and GROUPS, all in seconds
+ScanTime = namedtuple('ScanTime', ['file', 'wall', 'beam_on', 'expected', 'measured'] + GROUPS)
+
+
+def scan_time(file_name, wall, beam_on, expected, phases):
+    """
+    split the wall time of one scan into beam on and overhead groups
+    :param file_name: first file of the scan
+    :param wall: seconds from start to end of the scan
+    :param beam_on: Struck clock seconds, None if the scaler timed out
+    :param expected: seconds the plan expected to expose
+    :param phases: Tracer.totals() for the scan
+    :return: ScanTime
+    """
+    measured = beam_on is not None
+    if not measured:
+        beam_on = expected
+    groups = dict((group, 0.0) for group in GROUPS)
+    exposure = 0.0
+    for name, (count, seconds) in phases.items():
+        if name in EXPOSURE_PHASES:
+            exposure += seconds
+        elif name in PHASE_GROUPS:
+            groups[PHASE_GROUPS[name]] += seconds
+    # the trajectory or stepper move minus the gate is acceleration
+    groups['ramp'] = max(exposure - beam_on, 0.0)
+    groups['other'] = max(wall - beam_on - sum(groups.values()), 0.0)
+    return ScanTime(file_name, wall, beam_on, expected, measured, **groups)
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    middle = len(values)//2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle])/2.0
+
+
+class EfficiencyReport:
+    """
+    EfficiencyReport collects the ScanTimes of one pressure point
+    """
+
+    def __init__(self, label):
+        """
+        :param label: pressure point, e.g. 'P3'
+        :return: instance of EfficiencyReport
+        """
+        self.label = label
+        self.scans = []
+
+    def add(self, scan):
+        self.scans.append(scan)
+
+    def wall(self):
+        return sum(scan.wall for scan in self.scans)
+
+    def beam_on(self):
+        return sum(scan.beam_on for scan in self.scans)
+
+    def fraction(self):
+        wall = self.wall()
+        if not wall:
+            return 0.0
+        return self.beam_on()/wall
+
+    def group(self, group):
+        return sum(getattr(scan, group) for scan in self.scans)
+
+    def outliers(self, factor=1.5, tolerance=0.05):
+        """
+        scans that lost much more time than usual, or whose gate was off
+        :param factor: dead time above factor times the median is an outlier
+        :param tolerance: relative difference allowed between gate and plan
+        :return: list of (ScanTime, reason)
+        """
+        typical = median([scan.wall - scan.beam_on for scan in self.scans])
+        found = []
+        for scan in self.scans:
+            dead = scan.wall - scan.beam_on
+            if not scan.measured:
+                found.append((scan, 'scaler timed out'))
+            elif scan.expected and abs(scan.beam_on - scan.expected) > tolerance*scan.expected:
+                found.append((scan, 'gate %.3f s, expected %.3f s' % (scan.beam_on, scan.expected)))
+            elif typical and dead > factor*typical:
+                found.append((scan, 'dead time %.2f s, typical %.2f s' % (dead, typical)))
+        return found
+
+    def text(self):
+        """
+        :return: report for the run log folder
+        """
+        wall = self.wall()
+        lines = ['Efficiency for %s: %d scans' % (self.label, len(self.scans)),
+                 'Wall time %.1f s, beam on %.1f s (%.1f %%)' % (
+                     wall, self.beam_on(), 100*self.fraction()),
+                 '']
+        lines.append('%-10s %10s %8s' % ('Overhead', 'Total (s)', 'Wall %'))
+        for group in GROUPS:
+            seconds = self.group(group)
+            lines.append('%-10s %10.2f %8.1f' % (group, seconds, 100*seconds/wall if wall else 0.0))
+        lines.append('')
+        lines.append('%-30s %8s %8s %8s %8s' % ('Scan', 'Wall', 'Beam on', 'Ramp', 'Dead %'))
+        for scan in self.scans:
+            lines.append('%-30s %8.2f %8.3f %8.2f %8.1f' % (
+                scan.file, scan.wall, scan.beam_on, scan.ramp,
+                100*(scan.wall - scan.beam_on)/scan.wall if scan.wall else 0.0))
+        outliers = self.outliers()
+        if outliers:
+            lines.append('')
+            lines.append('Outliers')
+            for scan, reason in outliers:
+                lines.append('%-30s %s' % (scan.file, reason))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        with open(path, 'w') as report:
+            report.write(self.text())
+
+
+def series_text(reports):
+    """
+    one line per pressure point of a continuous series
+    :param reports: EfficiencyReports in collection order
+    """
+    lines = ['%-8s %6s %10s %10s %8s %8s %8s' % (
+        'Point', 'Scans', 'Wall (s)', 'Beam (s)', 'Beam %', 'Ramp %', 'Outliers')]
+    for report in reports:
+        wall = report.wall()
+        lines.append('%-8s %6d %10.1f %10.1f %8.1f %8.1f %8d' % (
+            report.label, len(report.scans), wall, report.beam_on(),
+            100*report.fraction(), 100*report.group('ramp')/wall if wall else 0.0,
+            len(report.outliers())))
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    # made up scans: 1 s exposures with a slow one and a short gate
+    report = EfficiencyReport('P1')
+    for index in range(10):
+        wall, beam_on = 2.4, 0.998
+        if index == 3:
+            wall = 6.0
+        if index == 7:
+            beam_on = 0.8
+        phases = {'prep move': (1, 0.3), 'softglue config': (1, 0.05),
+                  'pvt execution': (1, 2.05), 'readout wait': (1, 0.01)}
+        report.add(scan_time('test_P1_C1_D1s_%03d' % (index + 1), wall, beam_on, 1.0, phases))
+    print report.text()
+    print series_text([report])
@@ -0,0 +1,160 @@
+__author__ = 'j.smith'
+
+'''
+Runs data collection on a worker thread, away from the Tk mainloop
+
+Nothing in here touches Tkinter, so collection jobs can be driven (and
+timed) with no display at all.
+'''
+
+import Queue
+import threading
+import time
+import traceback
+
+
+class ScanEngine:
+    """
+    ScanEngine runs one collection job at a time on a worker thread
+
+    Jobs only talk back through the events queue, as (kind, payload):
+        ('progress', text)
+        ('timing', (label, seconds, expected_seconds or None))
+        ('ask', (title, message))   a yes/no question, see ask()
+        ('frame', (metrics or error text, problem or None))
+        ('gui', (function, args))   run function(*args) on the GUI thread
+        ('done', whatever the job returned)
+        ('error', formatted traceback)
+    The GUI empties the queue from Tk's after() loop, a headless caller
+    from wait().
+    """
+
+    def __init__(self, interactive=True):
+        """
+        :param interactive: False answers every question with its default
+        :return: instance of ScanEngine
+        """
+        self.events = Queue.Queue()
+        self.answers = Queue.Queue()
+        self.interactive = interactive
+        self.thread = None
+        self.started = None
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, job, *args):
+        """
+        run job(*args) on a new worker thread
+        """
+        if self.busy():
+            raise RuntimeError('Data collection already running')
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.work, args=(job,) + args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self, job, *args):
+        try:
+            result = job(*args)
+        except Exception:
+            self.events.put(('error', traceback.format_exc()))
+        else:
+            self.timing('Run', time.time() - self.started)
+            self.events.put(('done', result))
+
+    # called from the worker thread
+    def progress(self, text):
+        self.events.put(('progress', text))
+
+    def timing(self, label, seconds, expected=None):
+        self.events.put(('timing', (label, seconds, expected)))
+
+    def frame(self, metrics, problem=None):
+        """
+        quality numbers of a frame, from any thread
+        """
+        self.events.put(('frame', (metrics, problem)))
+
+    def gui(self, function, *args):
+        """
+        have the GUI thread call function(*args), e.g. to set a Tk variable
+        """
+        self.events.put(('gui', (function, args)))
+
+    def ask(self, title, message, default=False):
+        """
+        yes/no question for the operator, blocks the worker until answered
+        """
+        if not self.interactive:
+            return default
+        self.events.put(('ask', (title, message)))
+        return self.answers.get()
+
+    # called from the GUI (or headless) thread
+    def answer(self, value):
+        self.answers.put(value)
+
+    def drain(self, handlers):
+        """
+        hand every queued event to handlers[kind](payload)
+        :param handlers: dict of kind: callable, missing kinds are dropped
+        """
+        while True:
+            try:
+                kind, payload = self.events.get_nowait()
+            except Queue.Empty:
+                return
+            handler = handlers.get(kind)
+            if handler is not None:
+                handler(payload)
+
+    def wait(self, handlers, interval=0.05):
+        """
+        block until the running job finishes, draining events meanwhile
+        """
+        while self.busy():
+            self.drain(handlers)
+            time.sleep(interval)
+        self.drain(handlers)
+
+
+def print_timing(payload):
+    label, seconds, expected = payload
+    if expected is None:
+        print '%s: %.3f s' % (label, seconds)
+    else:
+        print '%s: %.3f s (expected %.3f, error %.3f)' % (label, seconds, expected, seconds - expected)
+
+
+def print_progress(text):
+    print text
+
+
+def run_headless(job, args=(), engine=None):
+    """
+    run a job without a display, printing what the GUI would show
+    :param job: callable to run on the worker thread
+    :param args: arguments for job
+    :param engine: ScanEngine the job reports to, a non-interactive one
+                   is made if not given
+    :return: whatever the job returned
+    """
+    if engine is None:
+        engine = ScanEngine(interactive=False)
+    outcome = {}
+
+    def show_error(text):
+        print text
+        outcome['error'] = text
+
+    handlers = {
+        'progress': print_progress,
+        'timing': print_timing,
+        'done': lambda result: outcome.update(result=result),
+        'error': show_error}
+    engine.start(job, *args)
+    engine.wait(handlers)
+    if 'error' in outcome:
+        raise RuntimeError('Data collection failed')
+    return outcome.get('result')
@@ -0,0 +1,375 @@
+__author__ = 'j.smith'
+
+'''
+Helpers that cut down on channel access traffic during data collection
+'''
+
+import threading
+import time
+
+# Struck setup for external (motor driven) channel advance, in the order
+# epics.devices.Struck.ExternalMode and the collection routines used to
+# send it
+STRUCK_EXTERNAL = [
+    ('ChannelAdvance', 1),
+    ('Prescale', 1),
+    ('InputMode', 3),
+    ('OutputMode', 3),
+    ('OutputPolarity', 0),
+    ('LNEStretcherEnable', 0),
+    ('NuseAll', 1)]
+
+# detector fields that are set before every scan but rarely change
+DETECTOR_SETUP = ['ShutterMode', 'TriggerMode', 'AcquirePeriod',
+                  'AcquireTime', 'NumImages']
+
+
+def same_value(a, b):
+    """
+    compare a requested value with a cached or monitored one
+    :return: True if writing b over a would change nothing
+    """
+    try:
+        return abs(float(a) - float(b)) <= 1e-9*max(1.0, abs(float(a)))
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+
+class ShadowCache:
+    """
+    ShadowCache is a write-through cache in front of one epics Device
+
+    Each put is remembered once it has been sent (and, for wait=True,
+    completed).  A later put of the same value is dropped.  A CA monitor
+    on every cached field forgets the entry as soon as the IOC reports a
+    different value, e.g. when someone changes it from a MEDM screen, so
+    the next put goes through again.
+    """
+
+    def __init__(self, device, attrs):
+        """
+        :param device: epics Device (Struck, areaDetector cam, ...)
+        :param attrs: field names to cache
+        :return: instance of ShadowCache
+        """
+        self.device = device
+        self.attrs = list(attrs)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.skipped = 0
+        self.put_time = 0.0
+        for attr in self.attrs:
+            device.add_callback(attr, self.monitor, field=attr)
+
+    def monitor(self, value=None, field=None, **kws):
+        with self.lock:
+            if field in self.values and not same_value(self.values[field], value):
+                del self.values[field]
+
+    def put(self, attr, value, wait=False):
+        """
+        send value unless the IOC already holds it
+        :return: True if a put was actually sent
+        """
+        with self.lock:
+            if attr in self.values and same_value(self.values[attr], value):
+                self.skipped += 1
+                return False
+        t0 = time.time()
+        self.device.put(attr, value, wait=wait)
+        elapsed = time.time() - t0
+        with self.lock:
+            self.puts += 1
+            self.put_time += elapsed
+            if attr in self.attrs:
+                self.values[attr] = value
+        return True
+
+    def apply(self, settings, wait=True):
+        """
+        put a list of (attr, value) pairs in order
+        """
+        for attr, value in settings:
+            self.put(attr, value, wait=wait)
+
+    def invalidate(self, attr=None):
+        with self.lock:
+            if attr is None:
+                self.values = {}
+            else:
+                self.values.pop(attr, None)
+
+    def reset_stats(self):
+        with self.lock:
+            self.puts = 0
+            self.skipped = 0
+            self.put_time = 0.0
+
+    def saved_time(self):
+        """
+        estimate of wall time saved, using the mean time of puts sent
+        """
+        if not self.puts:
+            return 0.0
+        return self.skipped*self.put_time/self.puts
+
+    def report(self, name):
+        return '%s: %d puts sent, %d skipped, ~%.3f s saved' % (
+            name, self.puts, self.skipped, self.saved_time())
+
+
+def is_zero(value):
+    return not value
+
+
+def wait_for(pv, done=is_zero, timeout=None):
+    """
+    block until a monitored PV satisfies done(value)
+
+    The monitor sets a threading.Event the moment the IOC posts the final
+    value, instead of finding out up to 100 ms later by polling.
+    :param pv: epics PV (e.g. detector.PV('Acquire'), motor.PV('DMOV'))
+    :param done: test applied to each new value
+    :param timeout: seconds to wait, None waits forever
+    :return: True if done, False if timed out
+    """
+    reached = threading.Event()
+    wake = threading.Event()
+
+    def check(value=None, **kws):
+        if done(value):
+            reached.set()
+            wake.set()
+
+    # Event.wait(timeout) in Python 2 polls in naps of up to 50 ms, so a
+    # timer ends the wait instead and the monitor wakes it immediately
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, wake.set)
+        timer.daemon = True
+        timer.start()
+    index = pv.add_callback(check)
+    try:
+        # it may already be there before the first monitor arrives
+        check(pv.get())
+        wake.wait()
+    finally:
+        pv.remove_callback(index)
+        if timer is not None:
+            timer.cancel()
+    return reached.is_set()
+
+
+def wait_done(device, attr, done=is_zero, timeout=None):
+    """
+    wait_for on a field of an epics Device, Struck or Motor
+    """
+    return wait_for(device.PV(attr), done, timeout)
+
+
+def motor_done(motor, timeout=None):
+    """
+    wait for a motor's done-moving flag
+    """
+    return wait_done(motor, 'DMOV', done=bool, timeout=timeout)
+
+
+class MoveWatch:
+    """
+    MoveWatch follows one motor through a move using its DMOV monitor
+
+    The monitor is attached before the move is started, so the
+    DMOV 1 -> 0 -> 1 cycle cannot be missed however fast the IOC is.
+    """
+
+    def __init__(self, motor, target, wake):
+        """
+        :param motor: epics Motor
+        :param target: position to move to
+        :param wake: Event set whenever any watched motor finishes
+        """
+        self.motor = motor
+        self.target = float(target)
+        self.wake = wake
+        self.moving = threading.Event()
+        self.done = threading.Event()
+        self.refused = False
+        self.pv = motor.PV('DMOV')
+        self.index = self.pv.add_callback(self.dmov)
+
+    def dmov(self, value=None, **kws):
+        if not value:
+            self.moving.set()
+        elif self.moving.is_set():
+            self.finish()
+
+    def finish(self):
+        self.done.set()
+        self.wake.set()
+
+    def start(self):
+        result = self.motor.move(self.target)
+        if result is not None and result < 0:
+            # refused (limits, bad value), nothing is going to move
+            print 'Move of ' + self.pv.pvname + ' refused: ' + str(result)
+            self.refused = True
+            self.finish()
+        elif not self.moving.is_set() and self.pv.get():
+            # already at the target, the record has nothing to do
+            tolerance = max(abs(self.motor.get('RDBD') or 0), abs(self.motor.get('MRES') or 0))
+            if abs(self.motor.get('RBV') - self.target) <= tolerance:
+                self.finish()
+
+    def release(self):
+        self.pv.remove_callback(self.index)
+
+
+def move_group(moves, after=None, timeout=300.0):
+    """
+    move several motors at once and wait for all of them together
+
+    Independent axes start together, so the group takes as long as the
+    slowest axis rather than the sum of all of them.
+    :param moves: list of (motor, target) pairs
+    :param after: optional dict of motor: [motors that must finish before
+                  it may start], for collision-safe ordering
+    :param timeout: seconds allowed for the whole group
+    :return: True if every motor finished in time and none was refused
+    """
+    after = after or {}
+    wake = threading.Event()
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        wake.set()
+
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    timer.start()
+    group = set(motor for motor, target in moves)
+    waiting = list(moves)
+    running = []
+    finished = set()
+    watches = []
+    try:
+        while True:
+            wake.clear()
+            for watch in list(running):
+                if watch.done.is_set():
+                    running.remove(watch)
+                    finished.add(watch.motor)
+            if not waiting and not running:
+                return not any(watch.refused for watch in watches)
+            if expired.is_set():
+                return False
+            # an axis may start once everything it waits for is done
+            ready = [(motor, target) for motor, target in waiting
+                     if all(first in finished or first not in group
+                            for first in after.get(motor, ()))]
+            if ready:
+                for motor, target in ready:
+                    watch = MoveWatch(motor, target, wake)
+                    watches.append(watch)
+                    running.append(watch)
+                    watch.start()
+                waiting = [move for move in waiting if move not in ready]
+                continue
+            if not running:
+                raise ValueError('Circular move ordering')
+            wake.wait()
+    finally:
+        timer.cancel()
+        for watch in watches:
+            watch.release()
+
+
+class MoveError(RuntimeError):
+    pass
+
+
+class ReadoutError(RuntimeError):
+    pass
+
+
+def require_move(moves, after=None, timeout=300.0):
+    """
+    move_group for collection, where carrying on at the wrong place is
+    worse than stopping
+    :raise MoveError: if any motor timed out or refused its move
+    """
+    if not move_group(moves, after, timeout):
+        raise MoveError('Move did not finish: ' + ', '.join(
+            '%s to %g' % (motor.PV('DMOV').pvname[:-len('.DMOV')], float(target))
+            for motor, target in moves))
+
+
+class Snapshot:
+    """
+    Snapshot keeps the latest monitored value of a set of PVs
+
+    Every value arrives by CA monitor together with its IOC timestamp, so
+    taking a snapshot costs no network traffic at all and every value in
+    it says when it was true.
+    """
+
+    def __init__(self, pvs):
+        """
+        :param pvs: dict of label: epics PV, e.g. {'x': mX.PV('RBV')}
+        :return: instance of Snapshot
+        """
+        self.pvs = dict(pvs)
+        self.values = {}
+        self.lock = threading.Lock()
+        for label, pv in self.pvs.items():
+            pv.add_callback(self.monitor, label=label)
+            # until the first monitor arrives
+            self.monitor(value=pv.get(), label=label,
+                         timestamp=getattr(pv, 'timestamp', None))
+
+    def monitor(self, value=None, timestamp=None, label=None, **kws):
+        with self.lock:
+            self.values[label] = (value, timestamp or time.time())
+
+    def take(self):
+        """
+        :return: dict of label: (value, timestamp)
+        """
+        with self.lock:
+            return dict(self.values)
+
+
+def benchmark(frames=50, exposure=0.05):
+    """
+    dead time between end of acquisition and the routine noticing it,
+    100 ms polling versus a monitor, against the simulated IOC in SXD_sim
+    :param frames: number of simulated frames
+    :param exposure: seconds each simulated frame acquires
+    :return: dict of mean dead time per frame in seconds
+    """
+    from SXD_sim import SimDevice
+    detector = SimDevice('SIM:cam1:', ['Acquire'])
+    results = {}
+    for method in ('poll', 'monitor'):
+        lag = 0.0
+        for each in range(frames):
+            detector.Acquire = 1
+            ends = time.time() + exposure
+            timer = threading.Timer(exposure, detector.put, ('Acquire', 0))
+            timer.start()
+            if method == 'poll':
+                while detector.Acquire:
+                    time.sleep(0.1)
+            else:
+                wait_done(detector, 'Acquire', timeout=10.0)
+            lag += time.time() - ends
+            timer.join()
+        results[method] = lag/frames
+    return results
+
+
+if __name__ == '__main__':
+    lags = benchmark()
+    print 'polling dead time per frame: %.1f ms' % (lags['poll']*1000)
+    print 'monitor dead time per frame: %.1f ms' % (lags['monitor']*1000)
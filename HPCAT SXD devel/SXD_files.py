@@ -0,0 +1,184 @@
+__author__ = 'j.smith'
+
+'''
+Directory index of the user folder, for overwrite checks
+
+The user folder sits on a mapped network drive, where every stat is a
+round trip.  The index lists the folder once, learns about the files a
+run writes as it writes them, and only lists the folder again after
+rescan seconds, so checking a whole plan for overwrites costs one
+listing instead of one stat per image.
+
+mirror_files() renumbers the frames of a sweep run down in omega.
+'''
+
+import os
+import threading
+import time
+
+
+def frame_files(step):
+    """
+    names of the frames the detector writes for a ScanStep
+    """
+    return [step.file_name + '_' + str(number).zfill(3) + '.tif'
+            for number in range(step.image_no, step.image_no + step.num_images)]
+
+
+def step_files(step):
+    """
+    names of the image files a ScanStep writes, wide images summed from it included
+    """
+    names = frame_files(step)
+    synth = getattr(step, 'synth', None)
+    if synth:
+        wide_name, wide_no, num_wide = synth
+        names.extend(wide_name + '_' + str(number).zfill(3) + '.tif'
+                     for number in range(wide_no, wide_no + num_wide))
+    return names
+
+
+def wait_files(folder, names, timeout=5.0):
+    """
+    wait for files the detector may still be writing, one listing per try
+    :return: True if they are all there
+    """
+    wanted = set(os.path.normcase(name) for name in names)
+    t0 = time.time()
+    while True:
+        try:
+            present = set(os.path.normcase(name) for name in os.listdir(folder))
+        except OSError:
+            present = set()
+        if wanted <= present:
+            return True
+        if time.time() - t0 > timeout:
+            return False
+        time.sleep(0.1)
+
+
+def mirror_files(folder, step, timeout=5.0):
+    """
+    renumber the files of a sweep run down in omega
+
+    The detector numbers frames in the order it takes them, so a sweep
+    from w_end to w_start writes the highest angle first.  Swapping the
+    names end for end puts the numbers back in ascending omega.
+    :param folder: folder the detector writes to
+    :param step: ScanStep with direction -1
+    :param timeout: seconds to wait for the last files to be written
+    :return: True if every file was found and renamed
+    """
+    names = frame_files(step)
+    if not wait_files(folder, names, timeout):
+        return False
+    paths = [os.path.join(folder, name) for name in names]
+    for path in paths:
+        os.rename(path, path + '.mirror')
+    for path, target in zip(paths, reversed(paths)):
+        os.rename(path + '.mirror', target)
+    return True
+
+
+class DirectoryIndex:
+    """
+    DirectoryIndex is a cached listing of one folder
+    """
+
+    def __init__(self, rescan=60.0, lister=os.listdir):
+        """
+        :param rescan: seconds before a listing is considered stale
+        :param lister: os.listdir replacement, for testing
+        :return: instance of DirectoryIndex
+        """
+        self.rescan = rescan
+        self.lister = lister
+        self.path = None
+        self.names = set()
+        self.listed = 0.0
+        self.listings = 0
+        self.lock = threading.Lock()
+
+    def use(self, path):
+        """
+        point the index at a folder, listing it if it is a new one
+        """
+        with self.lock:
+            if path != self.path:
+                self.path = path
+                self.list_now()
+
+    def list_now(self):
+        try:
+            names = self.lister(self.path)
+        except OSError:
+            names = []
+        self.names = set(os.path.normcase(name) for name in names)
+        self.listed = time.time()
+        self.listings += 1
+
+    def refresh(self):
+        with self.lock:
+            self.list_now()
+
+    def exists(self, name):
+        with self.lock:
+            if time.time() - self.listed > self.rescan:
+                self.list_now()
+            return os.path.normcase(name) in self.names
+
+    def add(self, names):
+        """
+        record files the run has written itself
+        """
+        with self.lock:
+            self.names.update(os.path.normcase(name) for name in names)
+
+    def conflicts(self, plan):
+        """
+        :return: indices of plan steps that would overwrite existing files
+        """
+        return [index for index, step in enumerate(plan.steps)
+                if any(self.exists(name) for name in step_files(step))]
+
+
+def benchmark(steps=400, stat=0.010, listing=0.050):
+    """
+    overwrite checks for a CCD plan, one stat per image versus the index
+    :param steps: one image per step, as in a CCD step scan
+    :param stat: seconds per stat on the share
+    :param listing: seconds per listing of the folder
+    :return: dict of seconds for the whole plan
+    """
+    import tempfile
+    from collections import namedtuple
+    folder = tempfile.mkdtemp()
+    Step = namedtuple('Step', ['file_name', 'image_no', 'num_images'])
+    plan_steps = [Step('test_P1_C1_D1s', number, 1) for number in range(1, steps + 1)]
+    for step in plan_steps[:steps//10]:
+        open(os.path.join(folder, step_files(step)[0]), 'w').close()
+
+    def slow_isfile(path):
+        time.sleep(stat)
+        return os.path.isfile(path)
+
+    def slow_listdir(path):
+        time.sleep(listing)
+        return os.listdir(path)
+
+    t0 = time.time()
+    found_stat = sum(1 for step in plan_steps
+                     if slow_isfile(os.path.join(folder, step_files(step)[0])))
+    per_image = time.time() - t0
+    index = DirectoryIndex(lister=slow_listdir)
+    t0 = time.time()
+    index.use(folder)
+    found_index = sum(1 for step in plan_steps if index.exists(step_files(step)[0]))
+    indexed = time.time() - t0
+    assert found_stat == found_index
+    return {'stat per image': per_image, 'index': indexed}
+
+
+if __name__ == '__main__':
+    for name, seconds in sorted(benchmark().items()):
+        print '%-15s %8.1f ms for 400 images' % (name, seconds*1000)
@@ -0,0 +1,250 @@
+__author__ = 'j.smith'
+
+'''
+Wide images summed from step frames, instead of a second sweep
+
+A Pilatus adds no readout noise, so the sum of consecutive fine-sliced
+frames is as good as one long exposure over the same range.  Frames are
+memory-mapped one at a time and added into the memory-mapped data of
+the output TIFF, so a wide image never needs more memory than the page
+cache the OS lends it.  Summing runs on a worker thread, off the
+collection thread.
+
+Only uncompressed, single strip TIFFs are read (what the Pilatus and
+the simulated detector write).
+'''
+
+import os
+import Queue
+import struct
+import threading
+import numpy
+from SXD_files import frame_files, wait_files
+
+# TIFF tags used here
+WIDTH, LENGTH, BITS, COMPRESSION, STRIP_OFFSETS, STRIP_COUNTS, SAMPLE_FORMAT = (
+    256, 257, 258, 259, 273, 279, 339)
+
+# (bits per sample, sample format): numpy type, format 1 unsigned, 2 signed
+TIFF_TYPES = {(8, 1): 'u1', (16, 1): 'u2', (32, 1): 'u4', (16, 2): 'i2', (32, 2): 'i4'}
+FORMATS = dict((numpy.dtype(kind).str[1:], key) for key, kind in TIFF_TYPES.items())
+
+# Pilatus marks module gaps with -1 and bad pixels with -2
+INT32_MAX = 2**31 - 1
+
+
+class FrameError(ValueError):
+    pass
+
+
+def tiff_layout(path):
+    """
+    :return: (numpy dtype, (rows, cols), data offset) of an uncompressed TIFF
+    """
+    with open(path, 'rb') as tiff:
+        head = tiff.read(8)
+        if head[:2] == 'II':
+            order = '<'
+        elif head[:2] == 'MM':
+            order = '>'
+        else:
+            raise FrameError('%s is not a TIFF' % path)
+        ifd_offset = struct.unpack(order + 'I', head[4:8])[0]
+        tiff.seek(ifd_offset)
+        count = struct.unpack(order + 'H', tiff.read(2))[0]
+        tags = {}
+        for each in range(count):
+            tag, kind, number, value = struct.unpack(order + 'HHI4s', tiff.read(12))
+            if number != 1:
+                # several strips, not written by either detector
+                tags[tag] = None
+            elif kind == 3:
+                tags[tag] = struct.unpack(order + 'H', value[:2])[0]
+            else:
+                tags[tag] = struct.unpack(order + 'I', value)[0]
+    if tags.get(COMPRESSION, 1) != 1 or tags.get(STRIP_OFFSETS) is None:
+        raise FrameError('%s is compressed or in several strips' % path)
+    kind = TIFF_TYPES.get((tags.get(BITS), tags.get(SAMPLE_FORMAT, 1)))
+    if kind is None:
+        raise FrameError('%s has an unsupported pixel type' % path)
+    return numpy.dtype(order + kind), (tags[LENGTH], tags[WIDTH]), tags[STRIP_OFFSETS]
+
+
+def read_frame(path):
+    """
+    :return: read-only memmap of the pixels of an uncompressed TIFF
+    """
+    dtype, shape, offset = tiff_layout(path)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def tiff_header(shape, dtype):
+    """
+    little-endian header and IFD for one strip of pixels following it
+    :param shape: (rows, cols)
+    :param dtype: numpy dtype of the pixels
+    :return: header bytes, the pixels start right after them
+    """
+    rows, cols = shape
+    dtype = numpy.dtype(dtype)
+    bits, sample_format = FORMATS[dtype.str[1:]]
+    size = rows*cols*dtype.itemsize
+    # (tag, type, value), type 3 is SHORT and 4 is LONG
+    entries = [(WIDTH, 3, cols), (LENGTH, 3, rows), (BITS, 3, bits), (COMPRESSION, 3, 1),
+               (262, 3, 1), (STRIP_OFFSETS, 4, 0), (277, 3, 1), (278, 3, rows),
+               (STRIP_COUNTS, 4, size), (SAMPLE_FORMAT, 3, sample_format)]
+    offset = 8 + 2 + 12*len(entries) + 4
+    ifd = struct.pack('<H', len(entries))
+    for tag, kind, value in entries:
+        if tag == STRIP_OFFSETS:
+            value = offset
+        if kind == 3:
+            ifd += struct.pack('<HHIHH', tag, kind, 1, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, kind, 1, value)
+    return struct.pack('<2sHI', 'II', 42, 8) + ifd + struct.pack('<I', 0)
+
+
+def tiff_bytes(image, dtype='<u2'):
+    """
+    uncompressed greyscale TIFF, one strip
+    :param image: 2D array
+    :param dtype: pixel type written
+    :return: file content
+    """
+    image = numpy.asarray(image, dtype=numpy.dtype(dtype).newbyteorder('<'))
+    return tiff_header(image.shape, image.dtype) + image.tostring()
+
+
+def sum_frames(paths, out_path):
+    """
+    add frames into a new 32 bit TIFF, one frame in memory at a time
+
+    Pixels negative in any frame (Pilatus gaps and bad pixels) keep the
+    value of the first frame, the rest saturate at the int32 maximum.
+    :param paths: frames of the same shape, in any order
+    :param out_path: TIFF to write
+    :return: shape of the image written
+    """
+    first = read_frame(paths[0])
+    header = tiff_header(first.shape, '<i4')
+    # written under a temporary name, so nobody reads a half-summed image
+    part_path = out_path + '.part'
+    with open(part_path, 'wb') as out:
+        out.write(header)
+        out.truncate(len(header) + first.size*4)
+    total = numpy.memmap(part_path, dtype='<i4', mode='r+', offset=len(header), shape=first.shape)
+    # int64 rows would double the memory, so clip as we go instead
+    masked = numpy.zeros(first.shape, dtype=bool)
+    for path in paths:
+        frame = read_frame(path)
+        if frame.shape != first.shape:
+            raise FrameError('%s is %s, expected %s' % (path, frame.shape, first.shape))
+        if frame.dtype.kind == 'i':
+            numpy.logical_or(masked, frame < 0, out=masked)
+            headroom = INT32_MAX - total
+            numpy.add(total, numpy.minimum(numpy.maximum(frame, 0), headroom), out=total)
+        else:
+            headroom = (INT32_MAX - total).astype(numpy.uint32)
+            numpy.add(total, numpy.minimum(frame, headroom), out=total, casting='unsafe')
+        del frame
+    if masked.any():
+        total[masked] = first[masked]
+    total.flush()
+    del total
+    if os.path.exists(out_path):
+        # Windows will not rename over an existing file
+        os.remove(out_path)
+    os.rename(part_path, out_path)
+    return first.shape
+
+
+def wide_groups(step):
+    """
+    step frames to sum for each wide image of a ScanStep with synth set
+    :return: list of (wide file name, [step file names])
+    """
+    wide_name, wide_no, num_wide = step.synth
+    frames = frame_files(step)
+    group = len(frames)//num_wide
+    return [(wide_name + '_' + str(wide_no + k).zfill(3) + '.tif', frames[k*group:(k + 1)*group])
+            for k in range(num_wide)]
+
+
+class FrameSummer:
+    """
+    FrameSummer synthesizes wide images on a worker thread
+    """
+
+    def __init__(self, timeout=5.0):
+        """
+        :param timeout: seconds to wait for the last frames of a step
+        :return: instance of FrameSummer
+        """
+        self.timeout = timeout
+        self.jobs = Queue.Queue()
+        self.done = []
+        self.errors = []
+        self.thread = threading.Thread(target=self.work, name='frame summer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, folder, step):
+        """
+        queue the wide images of a step once its sweep has finished
+        :param folder: folder holding the step frames
+        :param step: ScanStep with synth set
+        """
+        self.jobs.put((folder, step))
+
+    def work(self):
+        while True:
+            folder, step = self.jobs.get()
+            try:
+                if not wait_files(folder, frame_files(step), self.timeout):
+                    raise FrameError('frames missing')
+                for wide, frames in wide_groups(step):
+                    sum_frames([os.path.join(folder, name) for name in frames],
+                               os.path.join(folder, wide))
+                    self.done.append(wide)
+            except (EnvironmentError, FrameError) as error:
+                self.errors.append((step.first_file, str(error)))
+            finally:
+                self.jobs.task_done()
+
+    def wait(self):
+        """
+        block until every queued wide image is written
+        :return: list of (first step file, problem) since the last wait
+        """
+        self.jobs.join()
+        errors, self.errors = self.errors, []
+        return errors
+
+
+if __name__ == '__main__':
+    # ten 1M-sized frames summed into two wide images
+    import tempfile
+    import time
+    from collections import namedtuple
+    folder = tempfile.mkdtemp()
+    Step = namedtuple('Step', ['file_name', 'image_no', 'num_images', 'first_file', 'synth'])
+    step = Step('test_P1_C1_D1s', 3, 10, 'test_P1_C1_D1s_003.tif', ('test_P1_C1_D1w', 1, 2))
+    shape = (1043, 981)
+    frames = []
+    for number in range(step.image_no, step.image_no + step.num_images):
+        frame = numpy.random.poisson(5.0, shape).astype('<i4')
+        frame[:, 487:494] = -1
+        frames.append(frame)
+        with open(os.path.join(folder, 'test_P1_C1_D1s_%03d.tif' % number), 'wb') as out:
+            out.write(tiff_bytes(frame, '<i4'))
+    summer = FrameSummer()
+    t0 = time.time()
+    summer.submit(folder, step)
+    assert not summer.wait()
+    print 'two wide images from ten %dx%d frames in %.0f ms' % (
+        shape[0], shape[1], (time.time() - t0)*1000)
+    wide = read_frame(os.path.join(folder, 'test_P1_C1_D1w_001.tif'))
+    expected = numpy.sum(frames[:5], axis=0)
+    expected[:, 487:494] = -1
+    assert (wide == expected).all()
@@ -0,0 +1,365 @@
+__author__ = 'j.smith'
+
+'''
+Point ordering for grid scans, and the map a grid scan fills in
+
+GridMap holds a Z by Y array of ion chamber counts and one of frame
+intensities, filled in from the collection thread and the frame metrics
+as the scan goes, drawn live by the GUI and saved as .npz at the end.
+fit_centre() finds the crystal in a finished map, and adaptive_levels()
+with pick_cells() plan coarse-to-fine grids around the best cells.
+'''
+
+import math
+import threading
+from collections import namedtuple
+import numpy
+
+RASTER = 'raster'
+SERPENTINE = 'serpentine'
+FLY = 'fly'
+PATTERNS = [RASTER, SERPENTINE, FLY]
+
+
+def grid_order(ny, nz, pattern=RASTER):
+    """
+    order in which grid points are visited
+    :param ny: number of Y (horizontal) points per row
+    :param nz: number of Z (vertical) rows
+    :param pattern: RASTER rewinds Y at the start of every row, SERPENTINE
+                    and FLY run every other row backwards
+    :return: list of (grid index, z step, y step), grid index always counts
+             in raster order from 1 so file names keep their meaning
+    """
+    order = []
+    for zsteps in range(nz):
+        ysteps_row = range(ny)
+        if pattern != RASTER and zsteps % 2:
+            ysteps_row.reverse()
+        for ysteps in ysteps_row:
+            order.append((zsteps*ny + ysteps + 1, zsteps, ysteps))
+    return order
+
+
+def row_travel(ny, nz, y_step, pattern=RASTER):
+    """
+    total Y travel for a grid, used to compare patterns
+    """
+    order = grid_order(ny, nz, pattern)
+    travel = 0.0
+    for (g0, z0, y0), (g1, z1, y1) in zip(order, order[1:]):
+        travel += abs(y1 - y0)*y_step
+    return travel
+
+
+# colour stops of the heat map, black through red and yellow to white
+HEAT_STOPS = [(0.0, (0, 0, 0)), (0.4, (200, 0, 0)), (0.8, (255, 220, 0)), (1.0, (255, 255, 255))]
+MAPS = ['counts', 'intensity']
+
+
+def heat_colour(fraction):
+    """
+    :param fraction: 0 to 1, None for a cell not measured yet
+    :return: Tk colour string
+    """
+    if fraction is None:
+        return '#404060'
+    fraction = min(max(fraction, 0.0), 1.0)
+    for (f0, c0), (f1, c1) in zip(HEAT_STOPS, HEAT_STOPS[1:]):
+        if fraction <= f1:
+            t = (fraction - f0)/(f1 - f0)
+            return '#%02x%02x%02x' % tuple(int(a + t*(b - a)) for a, b in zip(c0, c1))
+    return '#ffffff'
+
+
+class GridMap:
+    """
+    GridMap collects counts and frame intensities per grid cell
+    """
+
+    def __init__(self):
+        """
+        :return: instance of GridMap, empty until start()
+        """
+        self.lock = threading.Lock()
+        self.version = 0
+        self.start(0, 0, [], [])
+
+    def start(self, ny, nz, y_values, z_values):
+        """
+        forget the last grid and set up a new one
+        :param y_values: absolute Y of each column
+        :param z_values: absolute Z of each row
+        """
+        with self.lock:
+            self.y = numpy.array(y_values, dtype=float)
+            self.z = numpy.array(z_values, dtype=float)
+            self.counts = numpy.zeros((nz, ny))
+            self.scans = numpy.zeros((nz, ny), dtype=int)
+            self.intensity = numpy.zeros((nz, ny))
+            self.frames = numpy.zeros((nz, ny), dtype=int)
+            self.points = {}
+            self.files = {}
+            self.version += 1
+
+    def stop(self):
+        """
+        stop taking values, the map itself is kept for show and save
+        """
+        with self.lock:
+            self.points = {}
+            self.files = {}
+
+    def expect_point(self, point, cell):
+        """
+        :param point: index of the ScanPoint (ScanStep.point)
+        :param cell: (z step, y step)
+        """
+        with self.lock:
+            self.points[point] = cell
+
+    def expect_files(self, names, cell):
+        with self.lock:
+            for name in names:
+                self.files[name] = cell
+
+    def add_counts(self, cell, cps):
+        """
+        one scaler reading, cells hold the mean of theirs
+        """
+        if cell is None or cps is None:
+            return
+        with self.lock:
+            self.counts[cell] += cps
+            self.scans[cell] += 1
+            self.version += 1
+
+    def add_step(self, step, cps):
+        """
+        scaler reading of a ScanStep, ignored unless it is a grid point
+        """
+        with self.lock:
+            cell = self.points.get(step.point)
+        self.add_counts(cell, cps)
+
+    def add_frame(self, name, total):
+        """
+        integrated intensity of a frame, cells hold the sum of theirs
+        :return: the cell, None if the frame is not part of the grid
+        """
+        with self.lock:
+            cell = self.files.get(name)
+            if cell is not None:
+                self.intensity[cell] += total
+                self.frames[cell] += 1
+                self.version += 1
+            return cell
+
+    def image(self, kind='counts'):
+        """
+        :param kind: 'counts' or 'intensity'
+        :return: Z by Y array, NaN where nothing has been measured
+        """
+        with self.lock:
+            if kind == 'counts':
+                values, numbers = self.counts/numpy.maximum(self.scans, 1), self.scans
+            else:
+                values, numbers = self.intensity.copy(), self.frames
+            return numpy.where(numbers > 0, values, numpy.nan)
+
+    def colours(self, kind='counts'):
+        """
+        :return: rows of Tk colours, scaled from the lowest to the highest value
+        """
+        image = self.image(kind)
+        measured = image[~numpy.isnan(image)]
+        low = measured.min() if measured.size else 0.0
+        span = (measured.max() - low) if measured.size else 0.0
+        return [[heat_colour(None if numpy.isnan(value) else
+                             ((value - low)/span if span else 1.0)) for value in row]
+                for row in image]
+
+    def cells(self, kind='counts'):
+        """
+        :return: list of (value, y, z) for every measured cell
+        """
+        image = self.image(kind)
+        return [(float(image[zi, yi]), float(self.y[yi]), float(self.z[zi]))
+                for zi, yi in zip(*numpy.nonzero(~numpy.isnan(image)))]
+
+    def copy(self):
+        """
+        :return: detached GridMap holding the same values
+        """
+        other = GridMap()
+        with self.lock:
+            for name in ('y', 'z', 'counts', 'scans', 'intensity', 'frames'):
+                setattr(other, name, getattr(self, name).copy())
+        return other
+
+    def restore(self, other):
+        """
+        show the values of a copy() again, e.g. the best window of a run
+        """
+        with self.lock:
+            for name in ('y', 'z', 'counts', 'scans', 'intensity', 'frames'):
+                setattr(self, name, getattr(other, name).copy())
+            self.version += 1
+
+    def save(self, path):
+        """
+        write both maps and their axes as a compressed .npz
+        """
+        numpy.savez_compressed(path, counts=self.image('counts'),
+                               intensity=self.image('intensity'), y=self.y, z=self.z)
+
+
+# where fit_centre put the crystal, method is 'gaussian' or 'centroid'
+Centre = namedtuple('Centre', ['y', 'z', 'method', 'peak'])
+
+
+def gaussian_offset(low, mid, high):
+    """
+    sub-step offset of a Gaussian through three neighbouring samples
+    :return: offset from the middle sample in steps, None if they do not peak
+    """
+    if min(low, mid, high) <= 0:
+        return None
+    a, b, c = math.log(low), math.log(mid), math.log(high)
+    curvature = a - 2*b + c
+    if curvature >= 0:
+        return None
+    offset = (a - c)/(2*curvature)
+    if abs(offset) > 1:
+        return None
+    return offset
+
+
+def axis_position(values, index):
+    """
+    position of a fractional index along evenly spaced values
+    """
+    if len(values) < 2:
+        return float(values[0])
+    return float(values[0] + index*(values[1] - values[0]))
+
+
+def fit_centre(image, y_values, z_values):
+    """
+    crystal position from a grid map
+
+    A Gaussian through the brightest cell and its neighbours, along Y and
+    along Z, gives the centre between grid points.  Where that does not
+    fit (edge of the grid, flat or noisy neighbours) the centroid of the
+    cells above half height is used instead.
+    :param image: Z by Y array, NaN for cells not measured
+    :param y_values: Y of each column
+    :param z_values: Z of each row
+    :return: Centre, None if nothing was measured
+    """
+    image = numpy.asarray(image, dtype=float)
+    measured = ~numpy.isnan(image)
+    if not measured.any():
+        return None
+    background = numpy.median(image[measured])
+    signal = numpy.where(measured, image - background, 0.0)
+    zi, yi = numpy.unravel_index(numpy.argmax(signal), signal.shape)
+    peak = float(image[zi, yi])
+    nz, ny = signal.shape
+    offsets = []
+    for index, size, line in ((yi, ny, signal[zi, :]), (zi, nz, signal[:, yi])):
+        if size == 1:
+            offsets.append(0.0)
+        elif 0 < index < size - 1:
+            offsets.append(gaussian_offset(line[index - 1], line[index], line[index + 1]))
+        else:
+            offsets.append(None)
+    if None not in offsets:
+        return Centre(axis_position(y_values, yi + offsets[0]),
+                      axis_position(z_values, zi + offsets[1]), 'gaussian', peak)
+    weights = numpy.where(signal >= signal[zi, yi]/2.0, signal, 0.0)
+    total = weights.sum()
+    if total <= 0:
+        return Centre(axis_position(y_values, yi), axis_position(z_values, zi), 'centroid', peak)
+    z_index = (weights.sum(axis=1)*numpy.arange(nz)).sum()/total
+    y_index = (weights.sum(axis=0)*numpy.arange(ny)).sum()/total
+    return Centre(axis_position(y_values, y_index), axis_position(z_values, z_index),
+                  'centroid', peak)
+
+
+# one pass of an adaptive grid: points collected, step sizes, window shape
+Level = namedtuple('Level', ['points', 'y_step', 'z_step', 'ny', 'nz'])
+
+
+def adaptive_levels(ny, nz, y_step, z_step, target, top_k=3, fine=5):
+    """
+    passes of an adaptive grid, the coarse grid first
+
+    Each refinement samples fine points per axis across one step of the
+    level before either side of each of its top_k cells, so steps shrink
+    by (fine - 1)/2 a level until every scanned axis is at target or finer.
+    :param ny: Y points of the coarse grid
+    :param nz: Z points of the coarse grid
+    :param target: step size to stop at
+    :param top_k: cells refined at each level
+    :param fine: points per axis of a refinement window, odd and above 3
+    :return: list of Level
+    """
+    if fine < 5 or target <= 0:
+        raise ValueError('refinement would not converge')
+    shrink = (fine - 1)/2.0
+    wy = fine if ny > 1 else 1
+    wz = fine if nz > 1 else 1
+    levels = [Level(ny*nz, y_step, z_step, ny, nz)]
+    while True:
+        last = levels[-1]
+        steps = [abs(step) for step, n in ((last.y_step, ny), (last.z_step, nz)) if n > 1]
+        if not steps or max(steps) <= target*1.0001:
+            return levels
+        levels.append(Level(top_k*wy*wz, last.y_step/shrink, last.z_step/shrink, wy, wz))
+
+
+def window_axis(centre, step, n):
+    """
+    n positions step apart, centred on centre
+    """
+    return [centre + (k - (n - 1)/2.0)*step for k in range(n)]
+
+
+def pick_cells(cells, count, y_step, z_step):
+    """
+    brightest cells, none within a step of a brighter one already picked
+    :param cells: list of (value, y, z), e.g. from GridMap.cells()
+    :return: up to count of them, brightest first
+    """
+    picked = []
+    for value, y, z in sorted(cells, reverse=True):
+        if len(picked) == count:
+            break
+        if any(abs(y - py) <= abs(y_step)*1.01 and abs(z - pz) <= abs(z_step)*1.01
+               for pv, py, pz in picked):
+            continue
+        picked.append((value, y, z))
+    return picked
+
+
+if __name__ == '__main__':
+    for n in (11, 21, 51):
+        print '%dx%d grid, Y travel in steps: raster %d, serpentine %d' % (
+            n, n, row_travel(n, n, 1.0), row_travel(n, n, 1.0, SERPENTINE))
+    # a crystal between grid points, found from an 11x11 counts map
+    import time
+    y = numpy.linspace(-0.05, 0.05, 11)
+    z = numpy.linspace(-0.05, 0.05, 11)
+    image = 1000*numpy.exp(-((y[None, :] - 0.0123)**2 + (z[:, None] + 0.0211)**2)/(2*0.012**2)) + 50
+    image = numpy.random.poisson(image).astype(float)
+    t0 = time.time()
+    centre = fit_centre(image, y, z)
+    print 'crystal at Y 0.0123, Z -0.0211, %s fit Y %.4f, Z %.4f in %.2f ms' % (
+        centre.method, centre.y, centre.z, (time.time() - t0)*1000)
+    # 20 um crystal somewhere in a 200 um chamber, down to 2 um steps
+    levels = adaptive_levels(11, 11, 0.02, 0.02, 0.002)
+    uniform = (int(round(0.2/0.002)) + 1)**2
+    print 'adaptive grid: %s points (%d in all), uniform 2 um grid %d points' % (
+        ' + '.join(str(level.points) for level in levels),
+        sum(level.points for level in levels), uniform)
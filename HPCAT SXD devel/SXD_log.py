@@ -0,0 +1,239 @@
+__author__ = 'j.smith'
+
+'''
+Buffered run log, one open handle per pressure point
+
+Each pressure point gets the familiar fixed-width _P<n>.txt file plus a
+machine-readable _P<n>.jsonl next to it.  Files are opened (and their
+headers written) once, records are buffered and flushed by count or by
+age, and fsync is optional, so a scan no longer pays a stat, an open
+and a close on the network share.
+'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+# (record key, column heading, heading format, value format)
+TEXT_COLUMNS = [
+    ('timestamp', 'Timestamp', '{:22}', '{:22}'),
+    ('file', 'File Name', '{:30}', '{:30}'),
+    ('x', 'Cen X', '{:>8}', '{: 8.3f}'),
+    ('y', 'Cen Y', '{:>8}', '{: 8.3f}'),
+    ('z', 'Sam Z', '{:>8}', '{: 8.3f}'),
+    ('det', 'Det. Y', '{:>8}', '{: 8.3f}'),
+    ('start', 'Start', '{:>8}', '{: 8.2f}'),
+    ('end', 'End', '{:>8}', '{:8.2f}'),
+    ('images', 'Images', '{:^8}', '{:^9}'),
+    ('exp_time', 'Exp. time', '{:>8}', '{:8.3f}'),
+    ('cps', 'CPS', '{:>10}', '{:10}'),
+    # frame metrics log (_frames.txt)
+    ('max', 'Max', '{:>8}', '{:8}'),
+    ('saturated', 'Sat. %', '{:>8}', '{:8.3f}'),
+    ('total', 'Total', '{:>12}', '{:12}'),
+    ('spots', 'Spots', '{:>6}', '{:6}')]
+
+
+def text_header(record):
+    return ' '.join(heading_format.format(heading)
+                    for key, heading, heading_format, value_format in TEXT_COLUMNS
+                    if key in record)
+
+
+def text_line(record):
+    return ' '.join(value_format.format(record[key])
+                    for key, heading, heading_format, value_format in TEXT_COLUMNS
+                    if key in record)
+
+
+class LogFiles:
+    """
+    LogFiles holds the open text and JSONL handles of one pressure point
+    """
+
+    def __init__(self, path, headers, first, opener=open, exists=os.path.isfile):
+        """
+        :param path: text log path, the JSONL path swaps .txt for .jsonl
+        :param headers: lines written above the column headings of a new file
+        :param first: first record, decides which columns the headings show
+        """
+        self.path = path
+        self.json_path = os.path.splitext(path)[0] + '.jsonl'
+        new = not exists(path)
+        self.text = opener(path, 'a')
+        self.json = opener(self.json_path, 'a')
+        if new:
+            for line in headers:
+                self.text.write(line + '\n' * 2)
+            self.text.write(text_header(first) + '\n' * 2)
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def write(self, record):
+        self.text.write(text_line(record) + '\n')
+        self.json.write(json.dumps(record, sort_keys=True) + '\n')
+        self.pending += 1
+
+    def flush(self, fsync=False):
+        for handle in (self.text, self.json):
+            handle.flush()
+            if fsync:
+                os.fsync(handle.fileno())
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def close(self, fsync=True):
+        self.flush(fsync)
+        self.text.close()
+        self.json.close()
+
+
+class RunLog:
+    """
+    RunLog buffers scan records and writes them to per pressure point logs
+
+    Records are flushed once flush_records have piled up or the oldest
+    unflushed one is flush_seconds old, and always when the pressure point
+    changes or the run ends.  fsync=True also forces them to disk on every
+    flush; closing always does.
+    """
+
+    def __init__(self, flush_records=10, flush_seconds=5.0, fsync=False,
+                 opener=open, exists=os.path.isfile):
+        """
+        :param flush_records: flush after this many records
+        :param flush_seconds: flush when the last flush is this old
+        :param fsync: fsync on every flush, not only on close
+        :param opener: open() replacement, for testing
+        :param exists: os.path.isfile replacement, for testing
+        :return: instance of RunLog
+        """
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self.opener = opener
+        self.exists = exists
+        self.files = None
+        self.lock = threading.Lock()
+
+    def write(self, path, record, headers=()):
+        """
+        add one scan record
+        :param path: text log of the pressure point
+        :param record: dict of TEXT_COLUMNS keys (and any extra fields)
+        :param headers: title lines, only used when the log is created
+        """
+        with self.lock:
+            if self.files is not None and self.files.path != path:
+                # next pressure point, the old one is finished
+                self.files.close()
+                self.files = None
+            if self.files is None:
+                self.files = LogFiles(path, headers, record, self.opener, self.exists)
+            self.files.write(record)
+            if self.files.pending >= self.flush_records or \
+                    time.time() - self.files.last_flush >= self.flush_seconds:
+                self.files.flush(self.fsync)
+
+    def flush(self):
+        with self.lock:
+            if self.files is not None:
+                self.files.flush(self.fsync)
+
+    def close(self):
+        with self.lock:
+            if self.files is not None:
+                self.files.close()
+                self.files = None
+
+
+class SlowFiles:
+    """
+    open and isfile with network share latencies added, for benchmarks
+    """
+
+    def __init__(self, stat=0.010, open_close=0.015, flush=0.005):
+        self.stat = stat
+        self.open_close = open_close
+        self.flush_delay = flush
+
+    def isfile(self, path):
+        time.sleep(self.stat)
+        return os.path.isfile(path)
+
+    def open(self, path, mode='r'):
+        time.sleep(self.open_close)
+        return SlowFile(open(path, mode), self)
+
+
+class SlowFile:
+    def __init__(self, handle, files):
+        self.handle = handle
+        self.files = files
+
+    def write(self, text):
+        self.handle.write(text)
+
+    def flush(self):
+        time.sleep(self.files.flush_delay)
+        self.handle.flush()
+
+    def fileno(self):
+        return self.handle.fileno()
+
+    def close(self):
+        time.sleep(self.files.open_close)
+        self.handle.close()
+
+
+def example_record(index):
+    return {'timestamp': time.strftime('%d %b %Y %H:%M:%S', time.localtime()),
+            'file': 'test_P1_C1_D1s_%03d.tif' % index, 'x': 0.1, 'y': -0.2,
+            'z': 0.3, 'det': 150.0, 'start': -10.0, 'end': 10.0, 'images': 20,
+            'exp_time': 0.997, 'cps': 123456}
+
+
+def benchmark(scans=200, slow=None, folder=None):
+    """
+    log cost per scan, reopening the text file every scan versus RunLog
+    :param scans: number of scan records
+    :param slow: SlowFiles latencies, default emulates a network share
+    :param folder: directory to write in, a temporary one if not given
+    :return: dict of mean seconds per scan
+    """
+    slow = slow or SlowFiles()
+    folder = folder or tempfile.mkdtemp()
+    headers = ['Data collection values for: test_P1']
+    results = {}
+    # old way, stat + open + write + close for every scan
+    path = os.path.join(folder, 'legacy_P1.txt')
+    t0 = time.time()
+    for index in range(scans):
+        record = example_record(index)
+        if not slow.isfile(path):
+            textfile = slow.open(path, 'a')
+            textfile.write(headers[0] + '\n' * 2)
+            textfile.write(text_header(record) + '\n' * 2)
+        else:
+            textfile = slow.open(path, 'a')
+        textfile.write(text_line(record) + '\n')
+        textfile.close()
+    results['reopen'] = (time.time() - t0)/scans
+    for name, fsync in (('buffered', False), ('buffered+fsync', True)):
+        log = RunLog(fsync=fsync, opener=slow.open, exists=slow.isfile)
+        path = os.path.join(folder, name + '_P1.txt')
+        t0 = time.time()
+        for index in range(scans):
+            log.write(path, example_record(index), headers)
+        log.close()
+        results[name] = (time.time() - t0)/scans
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    folder = sys.argv[1] if len(sys.argv) > 1 else None
+    for name, seconds in sorted(benchmark(folder=folder).items()):
+        print '%-15s %7.2f ms per scan' % (name, seconds*1000)
@@ -0,0 +1,343 @@
+__author__ = 'j.smith'
+
+'''
+Quality numbers for each frame as it lands in the user folder
+
+FrameWatcher lists the detector folder every interval seconds and hands
+each new _NNN.tif, once its size has settled, to a MetricsPool.  The
+pool runs this module as worker processes (python SXD_metrics.py serve),
+one frame per request over stdin/stdout, so the arithmetic never holds
+the GIL of the collection thread.  Plain subprocesses rather than
+multiprocessing, which would re-run the GUI script in every child on
+Windows.
+
+The metrics are deliberately rough: maximum counts, saturated fraction,
+integrated intensity and a count of local maxima well above background.
+'''
+
+import json
+import os
+import Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+import numpy
+from SXD_frames import read_frame
+
+# counts at which a pixel no longer counts linearly, by detector choice
+SATURATION = {'1M': 1048500, 'CCD': 65535, 'IP': 65535, 'PE': 65535}
+
+# a spot pixel is this many background sigmas above the median
+SPOT_SIGMA = 10.0
+
+# frames worth a second look
+SATURATED_LIMIT = 0.0005
+
+FRAME_PATTERN = re.compile(r'_\d{3,}\.tif$', re.IGNORECASE)
+
+FrameMetrics = namedtuple('FrameMetrics', ['file', 'max', 'saturated', 'total', 'spots', 'seconds'])
+
+
+def count_spots(frame, valid, sigma=SPOT_SIGMA):
+    """
+    local maxima (3 x 3) above median + sigma*sqrt(median + 1)
+    """
+    background = float(numpy.median(frame[valid])) if valid.any() else 0.0
+    threshold = background + sigma*(background + 1)**0.5
+    centre = frame[1:-1, 1:-1]
+    peak = (centre > threshold) & valid[1:-1, 1:-1]
+    rows, cols = frame.shape
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr or dc:
+                neighbour = frame[1 + dr:rows - 1 + dr, 1 + dc:cols - 1 + dc]
+                # ties go to the first pixel of a flat top
+                if dr < 0 or (dr == 0 and dc < 0):
+                    peak &= centre > neighbour
+                else:
+                    peak &= centre >= neighbour
+    return int(peak.sum())
+
+
+def frame_metrics(path, saturation=SATURATION['1M']):
+    """
+    :param path: uncompressed TIFF
+    :param saturation: counts at which a pixel is saturated
+    :return: FrameMetrics
+    """
+    t0 = time.time()
+    frame = read_frame(path)
+    # Pilatus gaps and bad pixels are negative
+    valid = frame >= 0
+    pixels = int(valid.sum())
+    if pixels:
+        peak = int(frame[valid].max())
+        saturated = float((frame >= saturation).sum())/pixels
+        total = int(frame.sum(dtype=numpy.int64) - frame[~valid].sum(dtype=numpy.int64))
+    else:
+        peak, saturated, total = 0, 0.0, 0
+    spots = count_spots(frame, valid)
+    del frame
+    return FrameMetrics(os.path.basename(path), peak, saturated, total, spots, time.time() - t0)
+
+
+def flagged(metrics):
+    """
+    :return: reason to look at a frame, None if it looks fine
+    """
+    if metrics.saturated > SATURATED_LIMIT:
+        return '%.2f %% saturated' % (100*metrics.saturated)
+    if metrics.spots == 0:
+        return 'no spots'
+    return None
+
+
+def serve(requests=sys.stdin, replies=sys.stdout):
+    """
+    worker loop: 'path<TAB>saturation' in, one JSON line out per frame
+    """
+    for line in iter(requests.readline, ''):
+        path, saturation = line.rstrip('\n').split('\t')
+        try:
+            reply = {'metrics': frame_metrics(path, float(saturation))._asdict()}
+        except Exception as error:
+            reply = {'error': '%s: %s' % (os.path.basename(path), error)}
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+
+class MetricsPool:
+    """
+    MetricsPool spreads frames over a few worker processes
+
+    The workers start with the first start() or submit(), not with the
+    pool, and close() shuts them down again.
+    """
+
+    def __init__(self, report, workers=2, python=sys.executable):
+        """
+        :param report: called from a feeder thread as report(tag, FrameMetrics or error text)
+        :param workers: number of worker processes
+        :param python: interpreter for the workers
+        :return: instance of MetricsPool
+        """
+        self.report = report
+        self.count = workers
+        self.python = python
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def start(self):
+        """
+        start the worker processes, if they are not running yet
+        """
+        with self.lock:
+            if self.workers:
+                return
+            script = os.path.abspath(__file__)
+            if script.endswith(('.pyc', '.pyo')):
+                script = script[:-1]
+            for each in range(self.count):
+                worker = subprocess.Popen([self.python, '-u', script, 'serve'],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                feeder = threading.Thread(target=self.feed, args=(worker,),
+                                          name='frame metrics %d' % each)
+                feeder.daemon = True
+                feeder.start()
+                self.workers.append(worker)
+
+    def submit(self, path, saturation, tag=None):
+        """
+        :param tag: handed back with the result, e.g. the run log path
+        """
+        self.start()
+        self.jobs.put((path, saturation, tag))
+
+    def feed(self, worker):
+        while True:
+            path, saturation, tag = self.jobs.get()
+            try:
+                if path is None:
+                    return
+                worker.stdin.write('%s\t%r\n' % (path, saturation))
+                worker.stdin.flush()
+                reply = json.loads(worker.stdout.readline())
+                if 'metrics' in reply:
+                    self.report(tag, FrameMetrics(**reply['metrics']))
+                else:
+                    self.report(tag, reply['error'])
+            except (EnvironmentError, ValueError) as error:
+                self.report(tag, 'metrics worker failed: %s' % error)
+            finally:
+                self.jobs.task_done()
+
+    def wait(self):
+        """
+        block until every submitted frame has been reported
+        """
+        self.jobs.join()
+
+    def close(self, timeout=2.0):
+        """
+        stop the workers, killing any still busy after timeout seconds
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.jobs.put((None, None, None))
+        deadline = time.time() + timeout
+        for worker in workers:
+            try:
+                worker.stdin.close()
+            except EnvironmentError:
+                pass
+            while worker.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if worker.poll() is None:
+                worker.terminate()
+                worker.wait()
+
+
+class FrameWatcher:
+    """
+    FrameWatcher feeds new frames of one folder to a MetricsPool
+    """
+
+    def __init__(self, pool, interval=0.5, lister=os.listdir, size=os.path.getsize):
+        """
+        :param pool: MetricsPool
+        :param interval: seconds between listings of the folder
+        :param lister: os.listdir replacement, for testing
+        :param size: os.path.getsize replacement, for testing
+        :return: instance of FrameWatcher
+        """
+        self.pool = pool
+        self.interval = interval
+        self.lister = lister
+        self.size = size
+        self.lock = threading.Lock()
+        self.folder = None
+        self.saturation = None
+        self.tag = None
+        self.seen = set()
+        self.sizes = {}
+        self.thread = None
+        self.running = threading.Event()
+
+    def watch(self, folder, saturation, tag=None):
+        """
+        start watching, frames already in the folder are left alone
+        :param tag: handed to the pool with every frame
+        """
+        self.stop()
+        self.folder = folder
+        self.saturation = saturation
+        self.tag = tag
+        self.seen = set(self.listing())
+        self.sizes = {}
+        self.running.set()
+        self.thread = threading.Thread(target=self.work, name='frame watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listing(self):
+        try:
+            return [name for name in self.lister(self.folder) if FRAME_PATTERN.search(name)]
+        except OSError:
+            return []
+
+    def hold(self, names):
+        """
+        leave files alone until add() hands them over, e.g. until renamed
+        """
+        with self.lock:
+            self.seen.update(names)
+
+    def add(self, names):
+        """
+        submit files now, whether or not the listing has shown them
+        """
+        if self.folder is None:
+            return
+        with self.lock:
+            self.seen.update(names)
+        for name in names:
+            self.pool.submit(os.path.join(self.folder, name), self.saturation, self.tag)
+
+    def poll(self):
+        """
+        submit new frames whose size is the same as at the last listing
+        """
+        for name in self.listing():
+            with self.lock:
+                if name in self.seen:
+                    continue
+            try:
+                size = self.size(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            if size and self.sizes.get(name) == size:
+                with self.lock:
+                    if name in self.seen:
+                        continue
+                    self.seen.add(name)
+                del self.sizes[name]
+                self.pool.submit(os.path.join(self.folder, name), self.saturation, self.tag)
+            else:
+                self.sizes[name] = size
+
+    def work(self):
+        while self.running.is_set():
+            self.poll()
+            time.sleep(self.interval)
+
+    def stop(self):
+        """
+        stop watching, after two last listings so the final frames settle
+        """
+        if self.thread is None:
+            return
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        self.poll()
+        time.sleep(self.interval)
+        self.poll()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['serve']:
+        serve()
+        sys.exit(0)
+    # frames written while the watcher runs, metrics from two workers
+    import tempfile
+    from SXD_frames import tiff_bytes
+    folder = tempfile.mkdtemp()
+    results = []
+    pool = MetricsPool(lambda tag, metrics: results.append(metrics))
+    watcher = FrameWatcher(pool, interval=0.1)
+    watcher.watch(folder, SATURATION['1M'])
+    shape = (1043, 981)
+    for number in range(1, 11):
+        frame = numpy.random.poisson(5.0, shape).astype('<i4')
+        frame[:, 487:494] = -1
+        for each in range(number*3):
+            row, col = numpy.random.randint(2, shape[0] - 2), numpy.random.randint(2, 480)
+            frame[row, col] += 1000
+        with open(os.path.join(folder, 'test_P1_C1_D1s_%03d.tif' % number), 'wb') as out:
+            out.write(tiff_bytes(frame, '<i4'))
+        time.sleep(0.2)
+    t_last = time.time()
+    watcher.stop()
+    pool.wait()
+    print '%d frames reported, the last %.2f s after it was written' % (
+        len(results), time.time() - t_last)
+    for metrics in sorted(results):
+        print '%s max %7d  saturated %.4f  total %10d  spots %3d  %4.0f ms' % (
+            metrics.file, metrics.max, metrics.saturated, metrics.total, metrics.spots,
+            metrics.seconds*1000)
+    pool.close()
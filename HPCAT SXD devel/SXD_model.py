@@ -0,0 +1,211 @@
+__author__ = 'j.smith'
+
+'''
+Kinematic model of a collection run, for dry runs
+
+A compiled ScanPlan is played against motor ramps and fixed latencies
+instead of hardware, giving the wall time a run will take and where it
+goes, so beam time can be budgeted and plan variants compared before
+anything moves.
+'''
+
+from collections import namedtuple, OrderedDict
+from SXD_plan import PVT_1M, PVT_CCD, STEP_CCD
+
+# where the time of a run goes, in report order
+PHASES = ['upload', 'move', 'setup', 'ramp', 'exposure', 'readout', 'settle', 'restore']
+
+# seconds spent on each kind of overhead
+Latencies = namedtuple('Latencies', [
+    'ca_put',       # one channel access put with wait=True
+    'xps_call',     # one command on an open XPS session
+    'ftp_upload',   # one trajectory sent to an XPS by FTP
+    'readout'])     # dict of detector choice: seconds to read out one step
+
+DEFAULT_LATENCIES = Latencies(
+    ca_put=0.002,
+    xps_call=0.01,
+    ftp_upload=0.3,
+    readout={'1M': 0.05, 'CCD': 3.0, 'IP': 100.0, 'PE': 0.5})
+
+# puts and XPS calls each routine makes between its moves and the exposure
+SETUP_PUTS = {PVT_1M: 14, PVT_CCD: 20, STEP_CCD: 24}
+SETUP_XPS_CALLS = {PVT_1M: 2, PVT_CCD: 2, STEP_CCD: 0}
+
+# PVT ramps either side of the constant velocity element (line_trajectory)
+PVT_RAMP = 0.525
+# fixed sleeps in the CCD routines, plus the image plate scan wait
+CCD_SLEEPS = 0.2
+IP_WAIT = 10.0
+
+
+def trapezoid_time(distance, velo, accl, vbas=0.0):
+    """
+    seconds for a motor record move with a linear ramp
+    :param distance: length of the move
+    :param velo: slew speed (VELO)
+    :param accl: seconds to ramp from VBAS to VELO (ACCL)
+    :param vbas: base speed (VBAS)
+    """
+    distance = abs(distance)
+    if distance == 0:
+        return 0.0
+    if velo <= vbas or accl <= 0:
+        return distance/velo
+    ramp = (vbas + velo)/2*accl
+    if distance >= 2*ramp:
+        return 2*accl + (distance - 2*ramp)/velo
+    # never reaches full speed
+    a = (velo - vbas)/accl
+    t_half = (-vbas + (vbas**2 + a*distance)**0.5)/a
+    return 2*t_half
+
+
+class DryRun:
+    """
+    DryRun plays ScanSteps against a kinematic model of the stages
+    """
+
+    def __init__(self, axes, detector='1M', latencies=DEFAULT_LATENCIES, known=()):
+        """
+        :param axes: dict of axis name: SXD_plan.Axis, rbv is the start position
+        :param detector: detector choice ('1M', 'CCD', 'IP', 'PE')
+        :param latencies: Latencies to charge
+        :param known: trajectory names the controllers already hold
+        :return: instance of DryRun
+        """
+        self.axes = axes
+        self.detector = detector
+        self.latencies = latencies
+        self.known = set(known)
+        self.start = dict((name, axis.rbv) for name, axis in axes.items())
+        self.positions = dict(self.start)
+        self.phases = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.steps = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def move(self, moves, phase='move'):
+        """
+        moves made together (move_group) last as long as the slowest axis
+        """
+        longest = 0.0
+        for name, position in moves:
+            axis = self.axes[name]
+            seconds = trapezoid_time(position - self.positions[name], axis.velo, axis.accl, axis.vbas)
+            longest = max(longest, seconds)
+            self.positions[name] = position
+        self.add(phase, longest + len(moves)*self.latencies.ca_put)
+
+    def upload(self, names):
+        for name in names:
+            if name not in self.known:
+                self.known.add(name)
+                self.add('upload', self.latencies.ftp_upload)
+
+    def step(self, step):
+        latencies = self.latencies
+        self.steps += 1
+        self.move(step.moves)
+        self.add('setup', SETUP_PUTS[step.routine]*latencies.ca_put +
+                 SETUP_XPS_CALLS[step.routine]*latencies.xps_call)
+        self.add('exposure', step.expected_time)
+        if step.routine == STEP_CCD:
+            # the motor record itself ramps into and out of the exposure
+            axis = self.axes[step.omega]
+            sweep = trapezoid_time(step.w_final - step.w_zero, step.velo, axis.accl, axis.vbas)
+            self.add('ramp', max(0.0, sweep - step.expected_time))
+        else:
+            self.add('ramp', 2*PVT_RAMP)
+        self.positions[step.omega] = step.w_final
+        self.add('readout', latencies.readout.get(self.detector, 0.0))
+        if step.routine != PVT_1M:
+            self.add('settle', CCD_SLEEPS)
+        if self.detector == 'IP':
+            self.add('settle', IP_WAIT)
+
+    def restore(self):
+        moved = [(name, position) for name, position in self.start.items()
+                 if self.positions[name] != position]
+        self.move(moved, phase='restore')
+
+    def run(self, plan):
+        """
+        model a whole plan, including uploads and the return to start
+        :return: self, for chaining into report()
+        """
+        self.upload(name for name, content in plan.trajectories())
+        for step in plan.steps:
+            self.step(step)
+        self.restore()
+        return self
+
+    def fly_grid(self, ny, nz, y_first, y_step, z_first, z_step, dwell):
+        """
+        model grid_scan in fly mode, one PVT pass of Y per Z row
+        :param y_first: Y of the first point in each row
+        :param z_first: Z of the first row
+        """
+        self.add('setup', 12*self.latencies.ca_put + self.latencies.xps_call)
+        edge = y_first - y_step/2
+        ramp = y_step/dwell*PVT_RAMP/2
+        for row in range(nz):
+            self.steps += 1
+            if row % 2:
+                y_zero, y_end = edge + ny*y_step + ramp, edge - ramp
+            else:
+                y_zero, y_end = edge - ramp, edge + ny*y_step + ramp
+            self.move([('Z', z_first + row*z_step), ('Y', y_zero)])
+            # one trajectory per direction
+            if row < 2:
+                self.add('upload', self.latencies.ftp_upload)
+            self.add('setup', 6*self.latencies.ca_put + self.latencies.xps_call)
+            self.add('ramp', 2*PVT_RAMP)
+            self.add('exposure', ny*dwell)
+            self.add('readout', self.latencies.readout.get(self.detector, 0.0))
+            self.positions['Y'] = y_end
+        self.restore()
+        return self
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def dead_fraction(self):
+        total = self.total()
+        if not total:
+            return 0.0
+        return 1 - self.phases['exposure']/total
+
+    def report(self):
+        """
+        :return: text with predicted wall time, dead time and phase breakdown
+        """
+        total = self.total()
+        lines = ['Predicted wall time: %.1f s (%d steps)' % (total, self.steps),
+                 'Dead time: %.1f %%' % (100*self.dead_fraction())]
+        for phase, seconds in self.phases.items():
+            lines.append('%-9s %12.0f ms' % (phase, seconds*1000))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # compare grid plan variants without hardware
+    from SXD_plan import Axis, RotationRow, PlanSetup, ScanPoint, compile_plan
+    from SXD_grid import grid_order, RASTER, SERPENTINE
+    axes = {}
+    for name in ('X', 'Y', 'Z', 'Det'):
+        axes[name] = Axis(-100.0, 100.0, 0.5, 0.2, 0.0, 10.0, 0.0001, 0, 0.0)
+    axes['W'] = Axis(-180.0, 180.0, 10.0, 0.2, 0.0, 10.0, 0.0001, 0, 0.0)
+    rows = [RotationRow(0, 'D1', 0.0, -1.0, 2.0, 1, 0.1, 1, 0, 1)]
+    setup = PlanSetup(PVT_1M, 'test', '1', 1, 0, '', 0, 5, 4, 0, 0, 'GPHP', '1M', None)
+    n = 11
+    for pattern in (RASTER, SERPENTINE):
+        points = [ScanPoint('test_P1_G%d' % g, '', (('Z', z*0.01), ('Y', y*0.01)))
+                  for g, z, y in grid_order(n, n, pattern)]
+        plan = compile_plan(points, rows, setup, axes)
+        print '%dx%d %s grid, 1M' % (n, n, pattern)
+        print DryRun(axes).run(plan).report()
+        print
+    print '%dx%d fly grid, 0.1 s dwell' % (n, n)
+    print DryRun(axes).fly_grid(n, n, 0.0, 0.01, 0.0, 0.01, 0.1).report()
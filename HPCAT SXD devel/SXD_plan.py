@@ -0,0 +1,503 @@
+__author__ = 'j.smith'
+
+'''
+Turns the collection settings into a fixed list of scan steps
+
+Everything a step needs (positions, file names, detector settings,
+trajectories and limit checks) is worked out here, before anything
+moves, so the collection loop only has to carry the steps out.  Nothing
+in here reads Tkinter variables or talks to hardware; the GUI hands in
+plain values.
+'''
+
+import time
+from collections import namedtuple
+from math import cos, sin, pi
+from SXD_trajectory import TrajectoryStore, SOLLER_RADIUS, line_trajectory, soller_trajectory
+
+# routines a step can be carried out with
+PVT_1M = '1M'
+PVT_CCD = 'ccd'
+STEP_CCD = 'step'
+# grid_scan fly rows, Y swept on a trajectory with the PILATUS pulsed per point
+FLY_1M = 'fly'
+
+# motor record fields a plan depends on, read once per plan
+Axis = namedtuple('Axis', ['llm', 'hlm', 'velo', 'accl', 'vbas', 'vmax', 'mres', 'dir', 'rbv'])
+
+# one collecting Dx row of the GUI
+RotationRow = namedtuple('RotationRow', [
+    'index', 'label', 'det_pos', 'w_start', 'w_range', 'n_pts',
+    't_per_deg', 'wide', 'steps', 'num_wide'])
+
+# settings shared by every step of a plan, shutter is (open delay,
+# close delay, apply calibrated delays) as set when the plan was compiled
+PlanSetup = namedtuple('PlanSetup', [
+    'routine', 'sample_name', 'pressure_no', 'image_no', 'name_flag',
+    'path', 'soller', 'pvt_width', 'w_positioner', 'alternate', 'synth_wide',
+    'stack', 'detector', 'shutter'])
+
+# one sample position: file name part, progress text and stage moves
+ScanPoint = namedtuple('ScanPoint', ['file_part', 'progress', 'moves'])
+
+ScanStep = namedtuple('ScanStep', [
+    'progress',         # text for the busy window
+    'point',            # index of the ScanPoint, None outside compile_plan
+    'row',              # index of the Dx row
+    'routine',          # PVT_1M, PVT_CCD or STEP_CCD
+    'moves',            # ((axis name, position), ...) made together first
+    'omega',            # axis name rotated during the exposure
+    'det_pos', 'w_zero', 'w_start', 'w_end', 'w_final', 'velo',
+    'direction',        # 1 sweeps w_start to w_end, -1 w_end to w_start
+    'file_name',        # detector FileName
+    'first_file',       # first file written, for logging and overwrite checks
+    'first_path',
+    'log_path',
+    'image_no',         # detector FileNumber
+    'num_images',       # files written, the next step starts this many later
+    'num_points',       # detector NumImages
+    'acq_period', 'exp_time', 'expected_time',
+    'trajectory',       # PVT file content, None for stepper scans
+    'traj_name',
+    'pulse',            # (first element, last element, period) for the XPS
+    'accl_steps', 'micro_steps', 'fly_steps',   # stepper (STEP_CCD) counts
+    'synth',            # (wide FileName, first number, count) summed from the frames
+    'limits'])          # tuple of limit problems, empty if the step is safe
+
+
+class PlanError(ValueError):
+    pass
+
+
+class ScanPlan:
+    """
+    ScanPlan holds the compiled steps of one collection run
+    """
+
+    def __init__(self, steps, compile_time, setup=None, next_image=None):
+        """
+        :param steps: ScanSteps in the order they are carried out
+        :param compile_time: seconds spent compiling
+        :param setup: PlanSetup the steps were compiled with
+        :param next_image: first image number after the plan
+        :return: instance of ScanPlan
+        """
+        self.steps = tuple(steps)
+        self.compile_time = compile_time
+        self.setup = setup
+        self.next_image = next_image
+
+    def __len__(self):
+        return len(self.steps)
+
+    def violations(self):
+        """
+        :return: list of (first file, problem) for every limit problem
+        """
+        return [(step.first_file, problem) for step in self.steps
+                for problem in step.limits]
+
+    def check(self):
+        """
+        raise PlanError unless every step is within limits
+        """
+        problems = self.violations()
+        if problems:
+            shown = ['%s: %s' % problem for problem in problems[:5]]
+            if len(problems) > 5:
+                shown.append('... %d more' % (len(problems) - 5))
+            raise PlanError('\n'.join(shown))
+
+    def trajectories(self):
+        """
+        :return: list of (name, content) for each distinct trajectory
+        """
+        seen = {}
+        for step in self.steps:
+            if step.trajectory is not None and step.traj_name not in seen:
+                seen[step.traj_name] = step.trajectory
+        return [(name, seen[name]) for name in sorted(seen)]
+
+    def expected_time(self):
+        return sum(step.expected_time for step in self.steps)
+
+    def without(self, skipped):
+        """
+        drop steps, handing their moves on to the next step kept
+        :param skipped: indices of the steps to drop
+        :return: new ScanPlan
+        """
+        skipped = set(skipped)
+        steps = []
+        carried = []
+        for index, step in enumerate(self.steps):
+            if index in skipped:
+                carried.extend(step.moves)
+                continue
+            if carried:
+                own = set(name for name, position in step.moves)
+                moves = [(name, position) for name, position in carried if name not in own]
+                # later moves of the same axis win
+                merged = dict(moves)
+                moves = [(name, merged.pop(name)) for name, position in moves if name in merged]
+                step = step._replace(moves=tuple(moves) + tuple(step.moves))
+                carried = []
+            steps.append(step)
+        return ScanPlan(steps, self.compile_time, self.setup, self.next_image)
+
+
+def limit_problems(axes, targets):
+    """
+    :param axes: dict of axis name: Axis
+    :param targets: list of (axis name, position)
+    :return: tuple of problem descriptions
+    """
+    problems = []
+    for name, position in targets:
+        axis = axes.get(name)
+        if axis is None:
+            problems.append('%s is not available' % name)
+        elif not axis.llm <= position <= axis.hlm:
+            problems.append('%s %.4f outside %.4f to %.4f' % (name, position, axis.llm, axis.hlm))
+    return tuple(problems)
+
+
+def speed_problems(axis, name, velo):
+    if axis is None:
+        return ()
+    vmax = axis.vmax or axis.velo
+    if not axis.vbas <= abs(velo) <= vmax:
+        return ('%s speed %.4f outside %.4f to %.4f' % (name, abs(velo), axis.vbas, vmax),)
+    return ()
+
+
+def first_file_for(setup, full_file_name, image_no):
+    if setup.name_flag:
+        return setup.sample_name + '_' + str(image_no).zfill(3) + '.tif'
+    return full_file_name + '_' + str(image_no).zfill(3) + '.tif'
+
+
+def scan_types(row):
+    """
+    :return: list of (file suffix, number of points) for the checked types
+    """
+    types = []
+    if row.wide:
+        types.append(('w', row.num_wide))
+    if row.steps:
+        types.append(('s', row.n_pts))
+    return types
+
+
+def synthesized_wide(row, setup):
+    """
+    True if the wide images of a row can be summed from its step frames
+
+    Only the Pilatus is free of readout noise, and each wide image has to
+    cover a whole number of step frames.
+    """
+    return (setup.synth_wide and setup.routine == PVT_1M and row.wide and row.steps and
+            row.num_wide > 0 and row.n_pts % row.num_wide == 0)
+
+
+def rotation_steps(row, file_part, setup, axes, image_no, progress, moves, direction=1):
+    """
+    steps for one Dx row at one sample point
+
+    With setup.alternate each sweep series (wide, then steps) runs the
+    other way from the one before, so omega never rewinds the whole
+    range.  Image numbers and the logged w_start/w_end stay in ascending
+    omega whichever way a series runs.
+    :param row: RotationRow
+    :param file_part: file name up to the point label, e.g. test_P1_C1
+    :param setup: PlanSetup
+    :param axes: dict of axis name: Axis
+    :param image_no: FileNumber of the first image
+    :param progress: text for the busy window
+    :param moves: sample moves to make with the first step
+    :param direction: 1 to sweep the first series up in omega, -1 down
+    :return: list of ScanSteps
+    """
+    steps = []
+    w_end = row.w_start + row.w_range
+    temp_velo = 1/row.t_per_deg
+    log_path = setup.path + setup.sample_name + '_P' + setup.pressure_no + '.txt'
+    if setup.routine not in (PVT_1M, PVT_CCD, STEP_CCD):
+        return steps
+    sign = 1
+    if 'W' in axes and axes['W'].dir:
+        sign = -1
+    # soller trajectories only run one way
+    if not setup.alternate or (setup.routine == PVT_1M and setup.soller):
+        direction = 1
+    synth = None
+    for suffix, num_points in scan_types(row):
+        full_file_name = file_part + '_' + row.label + suffix
+        if setup.name_flag:
+            file_name = setup.sample_name
+        else:
+            file_name = full_file_name
+        if suffix == 'w' and synthesized_wide(row, setup):
+            # summed from the step frames, keeping its file numbers
+            synth = (file_name, image_no, num_points)
+            image_no += num_points
+            continue
+        if setup.routine == PVT_1M:
+            # whole range in one pass, one scaler channel per image
+            omega = 'SolT' if setup.soller else 'W'
+            accl = axes[omega].accl if omega in axes else 0.0
+            ramp = temp_velo*accl*1.5
+            if direction > 0:
+                w_zero, w_final = row.w_start - ramp, w_end + ramp
+                sweep = (row.w_start, w_end)
+            else:
+                w_zero, w_final = w_end + ramp, row.w_start - ramp
+                sweep = (w_end, row.w_start)
+            acq_period = row.w_range/num_points*row.t_per_deg
+            if num_points != 1:
+                exp_time = acq_period - .003
+            else:
+                exp_time = acq_period
+            single_pass = row.w_range*row.t_per_deg
+            if not setup.soller:
+                prep = [('Det', row.det_pos), ('W', w_zero)]
+                trajectory = line_trajectory(w_zero, sweep[0], sweep[1], direction*temp_velo, sign,
+                                             setup.pvt_width, setup.w_positioner)
+                pulse = (2, 3, single_pass)
+            else:
+                r = SOLLER_RADIUS
+                prep = [('Det', row.det_pos), ('SolT', w_zero),
+                        ('SolX', -r + r*cos(w_zero*pi/180)),
+                        ('SolY', r*sin(w_zero*pi/180))]
+                # soller trajectories always carry one segment per step point
+                trajectory = soller_trajectory(w_zero, row.w_start, w_end, row.n_pts, single_pass)
+                pulse = (2, 1 + row.n_pts, single_pass)
+            targets = list(moves) + prep + [(omega, w_final)]
+            steps.append(ScanStep(
+                progress=progress, point=None, row=row.index, routine=setup.routine,
+                moves=tuple(moves) + tuple(prep), omega=omega,
+                det_pos=row.det_pos, w_zero=w_zero, w_start=row.w_start,
+                w_end=w_end, w_final=w_final, velo=temp_velo, direction=direction,
+                file_name=file_name,
+                first_file=first_file_for(setup, full_file_name, image_no),
+                first_path=setup.path + first_file_for(setup, full_file_name, image_no),
+                log_path=log_path, image_no=image_no, num_images=num_points,
+                num_points=num_points, acq_period=acq_period, exp_time=exp_time,
+                expected_time=single_pass, trajectory=trajectory,
+                traj_name=TrajectoryStore.name_for(trajectory), pulse=pulse,
+                accl_steps=None, micro_steps=None, fly_steps=None, synth=synth,
+                limits=limit_problems(axes, targets) + speed_problems(axes.get(omega), omega, temp_velo)))
+            image_no += num_points
+            moves = ()
+            if setup.alternate and not setup.soller:
+                direction = -direction
+            continue
+        # CCD and image plate, one image per sub-step
+        step_size = row.w_range/num_points
+        # a series run downwards takes the sub-steps from the top
+        order = range(num_points) if direction > 0 else range(num_points - 1, -1, -1)
+        for each in order:
+            step_start = row.w_start + each*step_size
+            step_end = step_start + step_size
+            if direction > 0:
+                sweep = (step_start, step_end)
+            else:
+                sweep = (step_end, step_start)
+            actual_exposure = step_size*row.t_per_deg
+            # Exp time and period arbitrary + 5 seconds
+            acq_period = actual_exposure + 5
+            axis = axes['W']
+            if setup.routine == PVT_CCD:
+                ramp = temp_velo*axis.accl*1.5
+                w_zero = sweep[0] - direction*ramp
+                w_final = sweep[1] + direction*ramp
+                trajectory = line_trajectory(w_zero, sweep[0], sweep[1], direction*temp_velo, sign,
+                                             setup.pvt_width, setup.w_positioner)
+                traj_name = TrajectoryStore.name_for(trajectory)
+                pulse = (2, 3, actual_exposure)
+                accl_steps = micro_steps = fly_steps = None
+            else:
+                resolution = abs(axis.mres)
+                micro_steps = step_size/resolution
+                accl_steps = round((axis.vbas + temp_velo)/2*axis.accl/resolution*1.25)
+                accl_distance = accl_steps*resolution
+                w_zero = sweep[0] - direction*accl_distance
+                w_final = sweep[1] + direction*accl_distance
+                # motor steps from w_zero to the end of the exposure
+                fly_steps = abs(sweep[1] - w_zero)/resolution
+                trajectory = traj_name = pulse = None
+            prep = [('Det', row.det_pos), ('W', w_zero)]
+            targets = list(moves) + prep + [('W', w_final)]
+            number = image_no + each
+            first_file = first_file_for(setup, full_file_name, number)
+            steps.append(ScanStep(
+                progress=progress, point=None, row=row.index, routine=setup.routine,
+                moves=tuple(moves) + tuple(prep), omega='W',
+                det_pos=row.det_pos, w_zero=w_zero, w_start=step_start,
+                w_end=step_end, w_final=w_final, velo=temp_velo, direction=direction,
+                file_name=file_name, first_file=first_file,
+                first_path=setup.path + first_file, log_path=log_path,
+                image_no=number, num_images=1, num_points=1,
+                acq_period=acq_period, exp_time=acq_period,
+                expected_time=actual_exposure, trajectory=trajectory,
+                traj_name=traj_name, pulse=pulse, accl_steps=accl_steps,
+                micro_steps=micro_steps, fly_steps=fly_steps, synth=None,
+                limits=limit_problems(axes, targets) + speed_problems(axes.get('W'), 'W', temp_velo)))
+            moves = ()
+        image_no += num_points
+        if setup.alternate:
+            direction = -direction
+    return steps
+
+
+def block_images(row, setup):
+    """
+    :return: number of images one Dx row writes at one sample point
+    """
+    if setup.routine not in (PVT_1M, PVT_CCD, STEP_CCD):
+        return 0
+    return sum(num_points for suffix, num_points in scan_types(row))
+
+
+def fly_grid_steps(setup, axes, ny, y_first, y_step, z_values, dwell, det_pos, positioner):
+    """
+    one step per Z row of a fly grid, Y swept through the row
+
+    Every other row runs backwards.  Each exposure spans the cell centred
+    on its point, and image numbers run on from row to row.
+    :param ny: points per row
+    :param y_first: Y of the first point in each row
+    :param y_step: Y spacing of the points
+    :param z_values: Z of each row
+    :param dwell: seconds per point
+    :param det_pos: detector position for the whole grid
+    :param positioner: place of Y in the XPS group
+    :return: ScanPlan
+    """
+    t0 = time.time()
+    velo = abs(y_step)/dwell
+    # ramps last 0.525 s at constant acceleration
+    ramp = velo*0.525/2
+    sign = 1
+    if 'Y' in axes and axes['Y'].dir:
+        sign = -1
+    log_path = setup.path + setup.sample_name + '_P' + setup.pressure_no + '.txt'
+    y_edge = y_first - y_step/2
+    image_no = setup.image_no
+    moves = [('Det', det_pos)]
+    steps = []
+    for zsteps, z in enumerate(z_values):
+        if zsteps % 2:
+            direction = -1
+            y_start = y_edge + ny*y_step
+        else:
+            direction = 1
+            y_start = y_edge
+        y_end = y_start + direction*ny*y_step
+        y_zero = y_start - direction*ramp
+        y_final = y_end + direction*ramp
+        moves.extend([('Z', z), ('Y', y_zero)])
+        trajectory = line_trajectory(y_zero, y_start, y_end, direction*velo, sign,
+                                     setup.pvt_width, positioner)
+        file_name = setup.sample_name + '_P' + setup.pressure_no + '_F' + str(zsteps + 1)
+        first_file = file_name + '_' + str(image_no).zfill(3) + '.tif'
+        steps.append(ScanStep(
+            progress='Grid row ' + str(zsteps + 1) + ' of ' + str(len(z_values)),
+            point=zsteps, row=None, routine=FLY_1M, moves=tuple(moves), omega='Y',
+            det_pos=det_pos, w_zero=y_zero, w_start=y_start, w_end=y_end, w_final=y_final,
+            velo=velo, direction=direction, file_name=file_name, first_file=first_file,
+            first_path=setup.path + first_file, log_path=log_path, image_no=image_no,
+            num_images=ny, num_points=ny, acq_period=dwell, exp_time=dwell - .003,
+            expected_time=ny*dwell, trajectory=trajectory,
+            traj_name=TrajectoryStore.name_for(trajectory), pulse=(2, 2, dwell),
+            accl_steps=None, micro_steps=None, fly_steps=None, synth=None,
+            limits=limit_problems(axes, moves + [('Y', y_final)]) +
+            speed_problems(axes.get('Y'), 'Y', velo)))
+        image_no += ny
+        moves = []
+    return ScanPlan(steps, time.time() - t0, setup, image_no)
+
+
+def compile_plan(points, rows, setup, axes, order=None):
+    """
+    compile every (point, row, scan type) combination into steps
+
+    Image numbers (and so file names) are handed out points first, rows
+    second, whatever order the blocks are then carried out in.  With
+    setup.alternate the sweep direction carries on from block to block.
+    :param points: ScanPoints in collection order
+    :param rows: RotationRows to collect at each point
+    :param setup: PlanSetup
+    :param axes: dict of axis name: Axis
+    :param order: (point index, row index) blocks in the order to carry
+                  them out, points outer and rows inner if not given
+    :return: ScanPlan
+    """
+    t0 = time.time()
+    first_image = {}
+    image_no = setup.image_no
+    for i, point in enumerate(points):
+        for j, row in enumerate(rows):
+            count = block_images(row, setup)
+            if count:
+                first_image[(i, j)] = image_no
+                image_no += count
+    if order is None:
+        order = sorted(first_image)
+    steps = []
+    last = {}
+    direction = 1
+    for key in order:
+        if key not in first_image:
+            continue
+        point = points[key[0]]
+        new = rotation_steps(rows[key[1]], point.file_part, setup, axes, first_image[key],
+                             point.progress, (), direction)
+        if not new:
+            continue
+        new = [step._replace(point=key[0]) for step in new]
+        if setup.alternate:
+            direction = -new[-1].direction
+        # leave out moves to where the axis already is
+        moves = tuple((name, position) for name, position in point.moves
+                      if last.get(name) != position)
+        if moves:
+            first = new[0]
+            new[0] = first._replace(moves=moves + first.moves,
+                                    limits=limit_problems(axes, moves) + first.limits)
+        last.update(moves)
+        # axes a step prepares (omega, detector) end up somewhere else
+        for number, step in enumerate(new):
+            skip = len(moves) if number == 0 else 0
+            for name, position in step.moves[skip:]:
+                last.pop(name, None)
+        steps.extend(new)
+    return ScanPlan(steps, time.time() - t0, setup, image_no)
+
+
+if __name__ == '__main__':
+    # compile a large grid plan and time it, no hardware needed
+    axes = {}
+    for name in ('X', 'Y', 'Z', 'W', 'Det'):
+        axes[name] = Axis(-100.0, 100.0, 1.0, 0.25, 0.0, 10.0, 0.0001, 0, 0.0)
+    rows = [RotationRow(0, 'D1', 0.0, -10.0, 20.0, 20, 1.0, 1, 1, 1)]
+    points = [ScanPoint('test_P1_G%d' % g, 'Grid point %d' % g, (('Z', z*0.01), ('Y', y*0.01)))
+              for g, (z, y) in enumerate([(z, y) for z in range(21) for y in range(21)], 1)]
+    for routine in (PVT_1M, PVT_CCD, STEP_CCD):
+        setup = PlanSetup(routine, 'test', '1', 1, 0, '', 0, 5, 4, 0, 0, 'GPHP', '1M', None)
+        plan = compile_plan(points, rows, setup, axes)
+        print '%-5s %5d steps, %3d trajectories, compiled in %.1f ms' % (
+            routine, len(plan), len(plan.trajectories()), plan.compile_time*1000)
+        plan.check()
+    # wide and step sweeps at a few crystals, one way and alternating
+    from SXD_model import DryRun
+    rows = [RotationRow(0, 'D1', 0.0, -15.0, 30.0, 30, 1.0, 1, 1, 1)]
+    for routine in (PVT_1M, STEP_CCD):
+        for alternate in (0, 1):
+            setup = PlanSetup(routine, 'test', '1', 1, 0, '', 0, 5, 4, alternate, 0,
+                              'GPHP', '1M', None)
+            plan = compile_plan(points[:3], rows, setup, axes)
+            plan.check()
+            model = DryRun(axes).run(plan)
+            print '%-5s %-11s %6.1f s of omega and stage moves' % (
+                routine, 'alternating' if alternate else 'one way', model.phases['move'])
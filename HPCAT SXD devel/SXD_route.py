@@ -0,0 +1,215 @@
+__author__ = 'j.smith'
+
+'''
+Order sample positions to cut stage travel time
+
+Moves between points are made with move_group, so a hop takes as long
+as its slowest axis, timed with the motor record's trapezoid ramp.  The
+route starts and ends where the stages are now (the run restores them
+afterwards).  Small sets are solved exactly, larger ones with nearest
+neighbour followed by 2-opt.
+
+choose_nesting() decides whether crystals or detector rows make the
+outer loop of a run, by modelling both against the motor records.
+'''
+
+import itertools
+from SXD_model import trapezoid_time, DryRun
+from SXD_plan import compile_plan
+
+# exact search up to this many points
+EXACT_LIMIT = 9
+
+
+def hop_time(a, b, axes):
+    """
+    seconds for a group move between two positions
+    :param a: dict of axis name: position
+    :param b: dict of axis name: position
+    :param axes: dict of axis name: SXD_plan.Axis
+    """
+    longest = 0.0
+    for name in b:
+        axis = axes[name]
+        longest = max(longest, trapezoid_time(b[name] - a.get(name, axis.rbv),
+                                              axis.velo, axis.accl, axis.vbas))
+    return longest
+
+
+def cost_matrix(positions, axes):
+    """
+    :param positions: list of dicts, the start position first
+    :return: list of lists of hop times
+    """
+    return [[hop_time(a, b, axes) if i != j else 0.0 for j, b in enumerate(positions)]
+            for i, a in enumerate(positions)]
+
+
+def tour_time(cost, order):
+    """
+    :param order: point indices (1..n), visited after and before index 0
+    """
+    path = [0] + list(order) + [0]
+    return sum(cost[i][j] for i, j in zip(path, path[1:]))
+
+
+def exact_order(cost):
+    """
+    Held-Karp over subsets, fine for up to about a dozen points
+    """
+    n = len(cost) - 1
+    best = {}
+    for k in range(1, n + 1):
+        best[(1 << k, k)] = (cost[0][k], 0)
+    for size in range(2, n + 1):
+        for subset in itertools.combinations(range(1, n + 1), size):
+            bits = 0
+            for k in subset:
+                bits |= 1 << k
+            for k in subset:
+                rest = bits & ~(1 << k)
+                best[(bits, k)] = min((best[(rest, m)][0] + cost[m][k], m)
+                                      for m in subset if m != k)
+    full = (1 << (n + 1)) - 2
+    last = min(range(1, n + 1), key=lambda k: best[(full, k)][0] + cost[k][0])
+    order = []
+    bits = full
+    while last:
+        order.append(last)
+        bits, last = bits & ~(1 << last), best[(bits, last)][1]
+    return order[::-1]
+
+
+def nearest_order(cost):
+    left = set(range(1, len(cost)))
+    order = []
+    here = 0
+    while left:
+        here = min(left, key=lambda k: (cost[here][k], k))
+        left.remove(here)
+        order.append(here)
+    return order
+
+
+def two_opt(cost, order):
+    """
+    reverse stretches of the route while that makes it shorter
+    """
+    path = [0] + list(order) + [0]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 2):
+            for j in range(i + 1, len(path) - 1):
+                a, b, c, d = path[i - 1], path[i], path[j], path[j + 1]
+                # hop times are symmetric, so the reversed stretch costs the same
+                if cost[a][c] + cost[b][d] < cost[a][b] + cost[c][d] - 1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+    return path[1:-1]
+
+
+def best_order(cost):
+    """
+    :param cost: hop times, index 0 is the start position
+    :return: point indices (1..n) in visiting order
+    """
+    if len(cost) - 1 <= EXACT_LIMIT:
+        return exact_order(cost)
+    return two_opt(cost, nearest_order(cost))
+
+
+def order_points(points, axes):
+    """
+    reorder ScanPoints for the least travel time
+
+    Points keep their file names, so files stay tied to the crystal
+    labels whatever order they are collected in.
+    :param points: list of SXD_plan.ScanPoint
+    :param axes: dict of axis name: SXD_plan.Axis, rbv is the start position
+    :return: (reordered list, seconds of travel in label order, seconds after)
+    """
+    if len(points) < 2:
+        return list(points), 0.0, 0.0
+    start = dict((name, axis.rbv) for name, axis in axes.items())
+    positions = [start] + [dict(point.moves) for point in points]
+    cost = cost_matrix(positions, axes)
+    order = best_order(cost)
+    before = tour_time(cost, range(1, len(points) + 1))
+    after = tour_time(cost, order)
+    if after >= before:
+        return list(points), before, before
+    return [points[k - 1] for k in order], before, after
+
+
+def nestings(n_points, n_rows):
+    """
+    candidate loop orders as lists of (point index, row index) blocks
+    :return: dict of name: blocks
+    """
+    points = range(n_points)
+    rows = range(n_rows)
+    return {
+        # the detector only comes back every other crystal
+        'crystals outer': [(i, j) for i in points
+                           for j in (rows if i % 2 == 0 else rows[::-1])],
+        # one detector move per row, the crystal route run back and forth
+        'rows outer': [(i, j) for j in rows
+                       for i in (points if j % 2 == 0 else points[::-1])]}
+
+
+def choose_nesting(points, rows, setup, axes):
+    """
+    compile the run with each loop order and keep the quickest
+
+    Image numbers follow points then rows in every order, so each
+    candidate writes the same set of files.
+    :param points: ScanPoints, already in route order
+    :param rows: RotationRows
+    :param setup: SXD_plan.PlanSetup
+    :param axes: dict of axis name: SXD_plan.Axis, rbv is the start position
+    :return: (ScanPlan, name of the order, dict of name: modelled seconds)
+    """
+    if len(points) < 2 or len(rows) < 2:
+        return compile_plan(points, rows, setup, axes), 'crystals outer', {}
+    best = None
+    seconds = {}
+    for name, order in sorted(nestings(len(points), len(rows)).items()):
+        plan = compile_plan(points, rows, setup, axes, order)
+        model = DryRun(axes).run(plan)
+        # everything else is the same whatever the order
+        seconds[name] = model.phases['move'] + model.phases['restore']
+        if best is None or seconds[name] < seconds[best[1]]:
+            best = (plan, name)
+    return best[0], best[1], seconds
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    from SXD_plan import Axis, ScanPoint
+    random.seed(1)
+    axes = {'X': Axis(-10.0, 10.0, 2.0, 0.1, 0.0, 2.0, 0.0001, 0, 0.0),
+            'Y': Axis(-10.0, 10.0, 2.0, 0.1, 0.0, 2.0, 0.0001, 0, 0.0),
+            'Z': Axis(-10.0, 10.0, 0.5, 0.5, 0.0, 0.5, 0.0001, 0, 0.0)}
+    for n in (9, 20, 50, 100):
+        points = [ScanPoint('test_P1_C%d' % (k + 1), 'Crystal spot C%d' % (k + 1),
+                            (('X', random.uniform(-3, 3)), ('Y', random.uniform(-3, 3)),
+                             ('Z', random.uniform(-1, 1))))
+                  for k in range(n)]
+        t0 = time.time()
+        ordered, before, after = order_points(points, axes)
+        print '%3d crystals: travel %6.1f s -> %6.1f s (%.0f ms to plan)' % (
+            n, before, after, (time.time() - t0)*1000)
+    # slow detector stage, three rows far apart
+    from SXD_plan import RotationRow, PlanSetup, PVT_1M
+    axes['W'] = Axis(-180.0, 180.0, 10.0, 0.2, 0.0, 10.0, 0.0001, 0, 0.0)
+    axes['Det'] = Axis(80.0, 500.0, 5.0, 0.5, 0.0, 5.0, 0.001, 0, 200.0)
+    rows = [RotationRow(k, 'D%d' % (k + 1), position, -10.0, 20.0, 20, 1.0, 0, 1, 1)
+            for k, position in enumerate((150.0, 250.0, 400.0))]
+    setup = PlanSetup(PVT_1M, 'test', '1', 1, 0, '', 0, 5, 4, 0, 0, 'GPHP', '1M', None)
+    ordered, before, after = order_points(points[:20], axes)
+    plan, name, seconds = choose_nesting(ordered, rows, setup, axes)
+    for each in sorted(seconds):
+        print '20 crystals x 3 rows, %-14s %6.1f s of moves' % (each, seconds[each])
+    print 'chosen:', name
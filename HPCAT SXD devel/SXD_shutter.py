@@ -0,0 +1,232 @@
+__author__ = 'j.smith'
+
+'''
+Shutter delays calibrated from the SoftGlue timing of every scan
+
+sync_errors measures how early or late the shutter opened
+and closed against the motor gate, and suggests the delays that would
+have been right.  ShutterCalibration keeps the last few suggestions for
+each sample stack, routine and exposure range, and offers a robust
+estimate (median, or an EWMA with outliers dropped) to apply between
+scans.  Suggestions rather than errors are stored, so the estimate does
+not depend on the delays in use when each was measured.  The state is
+saved as JSON and loaded again in the next session, so the first scan
+of a beamtime starts synchronized.
+'''
+
+import json
+import os
+import threading
+from collections import namedtuple
+from SXD_efficiency import median
+
+SHUTTER_STATE = os.path.join(os.path.expanduser('~'), '.sxd_shutter.json')
+
+# upper edges of the exposure ranges (s), a shutter lags differently
+# when it only just opens
+EXPOSURE_EDGES = [0.1, 0.3, 1.0, 3.0, 10.0, 30.0]
+
+# delays outside this are a failed measurement, not a slow shutter
+DELAY_RANGE = (0.0, 1.0)
+
+# SoftGlue counters run at 8 MHz
+COUNTER_HZ = 8000000.0
+
+# errors are positive when the shutter was late, the delays are the ones
+# that would have been right
+ShutterSync = namedtuple('ShutterSync', ['shutter_dwell', 'open_error', 'close_error',
+                                         'open_delay', 'close_delay'])
+
+# EWMA ignores samples further than this many MADs (and at least
+# OUTLIER_FLOOR seconds) from the median
+OUTLIER_MADS = 4.0
+OUTLIER_FLOOR = 0.002
+
+
+def regime(stack, routine, exposure):
+    """
+    :param stack: sample stack, e.g. 'GPHP'
+    :param routine: SXD_plan PVT_CCD or STEP_CCD
+    :param exposure: seconds the shutter should stay open
+    :return: key of the calibration, e.g. 'GPHP ccd 0.3-1 s'
+    """
+    low = 0.0
+    for edge in EXPOSURE_EDGES:
+        if exposure <= edge:
+            return '%s %s %g-%g s' % (stack, routine, low, edge)
+        low = edge
+    return '%s %s >%g s' % (stack, routine, low)
+
+
+def sync_errors(shutter_counts, delta_counts, shutter_first, motor_dwell, open_delay,
+                close_delay):
+    """
+    shutter timing of one scan against the motor gate
+    :param shutter_counts: counts the shutter was open (UpCntr-3)
+    :param delta_counts: counts between motor and shutter opening (UpCntr-4)
+    :param shutter_first: True if the shutter opened before the motor gate
+    :param motor_dwell: seconds the motor gate was open
+    :param open_delay: open delay the scan ran with
+    :param close_delay: close delay the scan ran with
+    :return: ShutterSync, None if the shutter never opened
+    """
+    if not shutter_counts:
+        return None
+    open_error = (-delta_counts if shutter_first else delta_counts)/COUNTER_HZ
+    close_error = open_error + shutter_counts/COUNTER_HZ - motor_dwell
+    return ShutterSync(shutter_counts/COUNTER_HZ, open_error, close_error,
+                       open_delay + open_error, close_delay + close_error)
+
+
+def robust_delay(samples, method='median', alpha=0.3):
+    """
+    :param samples: suggested delays, oldest first
+    :param method: 'median' or 'ewma'
+    :param alpha: weight of the newest sample for 'ewma'
+    """
+    middle = median(samples)
+    if method == 'median':
+        return middle
+    spread = max(OUTLIER_MADS*1.4826*median([abs(value - middle) for value in samples]),
+                 OUTLIER_FLOOR)
+    estimate = None
+    for value in samples:
+        if abs(value - middle) > spread:
+            continue
+        estimate = value if estimate is None else alpha*value + (1 - alpha)*estimate
+    return estimate
+
+
+class ShutterCalibration:
+    """
+    ShutterCalibration holds rolling windows of suggested shutter delays
+    """
+
+    def __init__(self, path=SHUTTER_STATE, window=20, min_samples=3, method='median', alpha=0.3):
+        """
+        :param path: JSON file the windows are kept in between sessions
+        :param window: suggestions kept for each regime
+        :param min_samples: suggestions needed before delays() answers
+        :param method: 'median' or 'ewma', see robust_delay
+        :param alpha: EWMA weight of the newest suggestion
+        :return: instance of ShutterCalibration
+        """
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.method = method
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        # regime: {'open': [...], 'close': [...]}
+        self.samples = {}
+        self.changed = False
+
+    def load(self):
+        """
+        read the windows saved by the last session, if any
+        :return: number of regimes loaded
+        """
+        try:
+            with open(self.path) as state:
+                samples = json.load(state)
+        except IOError:
+            return 0
+        except ValueError as error:
+            print 'Shutter calibration not loaded from %s: %s' % (self.path, error)
+            return 0
+        with self.lock:
+            self.samples = dict((str(key), {'open': value['open'][-self.window:],
+                                            'close': value['close'][-self.window:]})
+                                for key, value in samples.items())
+            self.changed = False
+        return len(self.samples)
+
+    def save(self):
+        """
+        write the windows, if anything was added since the last save
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            text = json.dumps(self.samples, sort_keys=True, indent=1)
+            self.changed = False
+        # written under a temporary name, so a crash never leaves half a file
+        part_path = self.path + '.part'
+        with open(part_path, 'w') as state:
+            state.write(text)
+        if os.path.exists(self.path):
+            # Windows will not rename over an existing file
+            os.remove(self.path)
+        os.rename(part_path, self.path)
+
+    def add(self, key, open_delay, close_delay):
+        """
+        :param key: see regime()
+        :param open_delay: open delay that would have been right this scan
+        :param close_delay: close delay that would have been right this scan
+        :return: False if the suggestion was out of range and dropped
+        """
+        low, high = DELAY_RANGE
+        if not (low <= open_delay < high and low <= close_delay < high):
+            return False
+        with self.lock:
+            window = self.samples.setdefault(key, {'open': [], 'close': []})
+            window['open'] = (window['open'] + [open_delay])[-self.window:]
+            window['close'] = (window['close'] + [close_delay])[-self.window:]
+            self.changed = True
+        return True
+
+    def count(self, key):
+        with self.lock:
+            return len(self.samples.get(key, {'open': []})['open'])
+
+    def delays(self, key):
+        """
+        :return: (open delay, close delay), None until min_samples are in
+        """
+        with self.lock:
+            window = self.samples.get(key)
+            if window is None or len(window['open']) < self.min_samples:
+                return None
+            return (robust_delay(window['open'], self.method, self.alpha),
+                    robust_delay(window['close'], self.method, self.alpha))
+
+    def forget(self, key):
+        with self.lock:
+            if self.samples.pop(key, None) is not None:
+                self.changed = True
+
+
+if __name__ == '__main__':
+    # a shutter slower than the defaults, measured with 1 ms jitter and
+    # the odd missed edge, auto-applied between scans
+    import random
+    import tempfile
+    random.seed(2)
+    true_open, true_close = 0.0375, 0.0542
+    calibration = ShutterCalibration(os.path.join(tempfile.mkdtemp(), 'shutter.json'))
+    key = regime('GPHP', 'ccd', 1.0)
+    for method in ('median', 'ewma'):
+        calibration.method = method
+        calibration.forget(key)
+        open_delay, close_delay = 0.032, 0.048
+        wasted = []
+        for scan in range(12):
+            open_error = true_open - open_delay + random.gauss(0, 0.001)
+            close_error = true_close - close_delay + random.gauss(0, 0.001)
+            if scan == 6:
+                open_error += 0.03
+            # lost beam on 1 s: opened late and closed early
+            wasted.append(max(open_error, 0) + max(-close_error, 0))
+            calibration.add(key, open_delay + open_error, close_delay + close_error)
+            estimate = calibration.delays(key)
+            if estimate is not None:
+                open_delay, close_delay = estimate
+        print '%-6s delays %.4f / %.4f (true %.4f / %.4f), beam lost %s ms' % (
+            method, open_delay, close_delay, true_open, true_close,
+            ' '.join('%.0f' % (1000*each) for each in wasted))
+    calibration.save()
+    restored = ShutterCalibration(calibration.path)
+    restored.load()
+    print 'next session starts at %.4f / %.4f from %d scans of %s' % (
+        restored.delays(key) + (restored.count(key), key))
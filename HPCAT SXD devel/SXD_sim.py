@@ -0,0 +1,603 @@
+__author__ = 'j.smith'
+
+'''
+Stand-in hardware for exercising the SXD code away from the beamline
+
+SimBeamline hands out motors, PVs, devices and a Struck by the same
+names the GUI uses, backed by the classes below, and runs a fake XPS
+that executes uploaded trajectories.  Run the GUI against it with
+
+    SXD_BACKEND=sim python HPCAT_SXD_1218.py
+'''
+
+import SocketServer
+import os
+import tempfile
+import threading
+import time
+import numpy
+from SXD_model import trapezoid_time
+from SXD_epics import STRUCK_EXTERNAL
+from SXD_frames import tiff_bytes
+
+# (position, VELO, ACCL, LLM, HLM) of the stack motors, by record name
+SIM_MOTORS = {
+    'XPSGP:m1': (0.0, 2.0, 0.1, -12.0, 12.0),
+    'XPSGP:m2': (0.0, 2.0, 0.1, -12.0, 12.0),
+    'XPSGP:m3': (0.0, 10.0, 0.2, -180.0, 180.0),
+    'XPSGP:m4': (0.0, 10.0, 0.2, -180.0, 180.0),
+    'XPSGP:m6': (0.0, 2.0, 0.1, -25.0, 25.0),
+    'XPSGP:m7': (0.0, 2.0, 0.1, -25.0, 25.0),
+    'XPSGP:m8': (0.0, 10.0, 0.2, -180.0, 180.0),
+    '16HEXGP:m1': (0.0, 0.5, 0.5, -10.0, 10.0),
+    '16HEXGP:m2': (0.0, 0.5, 0.5, -10.0, 10.0),
+    '16HEXGP:m3': (0.0, 0.5, 0.5, -10.0, 10.0),
+    'XPSLH:m1': (0.0, 2.0, 0.1, -12.0, 12.0),
+    'XPSLH:m2': (0.0, 2.0, 0.1, -12.0, 12.0),
+    'XPSLH:m3': (0.0, 2.0, 0.1, -12.0, 12.0),
+    'XPSLH:m4': (0.0, 10.0, 0.2, -180.0, 180.0),
+    '16IDB:m6': (200.0, 5.0, 0.5, 80.0, 500.0),
+    '16IDB:m13': (200.0, 5.0, 0.5, 80.0, 500.0),
+    '16BMD:m13': (0.0, 0.5, 0.2, -10.0, 10.0),
+    '16BMD:m20': (200.0, 5.0, 0.5, 80.0, 500.0),
+    '16BMD:m37': (0.0, 5.0, 0.2, -180.0, 180.0),
+    '16BMD:m38': (0.0, 0.5, 0.2, -10.0, 10.0),
+    '16BMD:m39': (0.0, 0.5, 0.2, -10.0, 10.0)}
+
+# seconds to read out one frame, by detector prefix
+SIM_READOUT = {
+    'HP1M-PIL1:cam1:': 0.003,
+    '16IDB:MARCCD:cam1:': 3.0,
+    'dp_mar165_xrd70:cam1:': 3.0,
+    '16BMDMAR345:cam1:': 90.0}
+
+# Struck clock channel frequency
+CLOCK = 50e6
+
+
+class SimPV:
+    """
+    In-memory stand-in for epics.PV with working monitors
+    """
+
+    def __init__(self, pvname, value=0):
+        self.pvname = pvname
+        self._value = value
+        self.callbacks = {}
+        self.next_index = 0
+        self.lock = threading.RLock()
+        self.connected = True
+
+    def get(self, **kws):
+        return self._value
+
+    def put(self, value, wait=False, **kws):
+        with self.lock:
+            changed = value != self._value
+            self._value = value
+            callbacks = list(self.callbacks.values())
+        if changed:
+            for callback, kwargs in callbacks:
+                callback(pvname=self.pvname, value=value, **kwargs)
+        return 1
+
+    @property
+    def value(self):
+        return self._value
+
+    def add_callback(self, callback=None, index=None, **kws):
+        with self.lock:
+            if index is None:
+                self.next_index += 1
+                index = self.next_index
+            self.callbacks[index] = (callback, kws)
+        return index
+
+    def remove_callback(self, index=None):
+        with self.lock:
+            self.callbacks.pop(index, None)
+
+    def clear_callbacks(self):
+        with self.lock:
+            self.callbacks = {}
+
+
+class SimDevice(object):
+    """
+    In-memory stand-in for epics.Device built from SimPVs
+    """
+
+    def __init__(self, prefix, attrs=(), defaults=None):
+        """
+        :param prefix: PV prefix, only used for names
+        :param attrs: field names created up front
+        :param defaults: dict of initial field values
+        """
+        object.__setattr__(self, '_prefix', prefix)
+        object.__setattr__(self, '_pvs', {})
+        defaults = defaults or {}
+        for attr in attrs:
+            self.PV(attr, value=defaults.get(attr, 0))
+        for attr, value in defaults.items():
+            self.PV(attr, value=value)
+
+    def PV(self, attr, value=0, **kws):
+        if attr not in self._pvs:
+            self._pvs[attr] = SimPV(self._prefix + attr, value)
+        return self._pvs[attr]
+
+    def get(self, attr, as_string=False, **kws):
+        value = self.PV(attr).get()
+        if as_string:
+            return str(value)
+        return value
+
+    def put(self, attr, value, wait=False, **kws):
+        return self.PV(attr).put(value, wait=wait)
+
+    def add_callback(self, attr, callback, **kws):
+        return self.PV(attr).add_callback(callback, **kws)
+
+    def remove_callbacks(self, attr, index=None):
+        self.PV(attr).remove_callback(index)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return self.get(attr)
+
+    def __setattr__(self, attr, value):
+        if attr.startswith('_'):
+            object.__setattr__(self, attr, value)
+        else:
+            self.put(attr, value)
+
+
+class SimMotor(SimDevice):
+    """
+    Stand-in for epics.Motor whose moves take as long as the real ones
+    """
+
+    def __init__(self, name, position=0.0, velo=1.0, accl=0.25, vbas=0.0,
+                 llm=-1000.0, hlm=1000.0, mres=0.0001, speedup=1.0):
+        """
+        :param name: motor record name
+        :param position: starting position
+        :param velo: VELO
+        :param accl: ACCL
+        :param vbas: VBAS
+        :param llm: low soft limit
+        :param hlm: high soft limit
+        :param mres: MRES
+        :param speedup: divide simulated move times by this
+        """
+        SimDevice.__init__(self, name + '.', defaults={
+            'VAL': position, 'RBV': position, 'DMOV': 1, 'VELO': velo,
+            'ACCL': accl, 'VBAS': vbas, 'LLM': llm, 'HLM': hlm,
+            'MRES': mres, 'RDBD': mres, 'BDST': 0.0, 'DIR': 0,
+            'DESC': name})
+        self._speedup = speedup
+        self._lock = threading.Lock()
+
+    def within_limits(self, val):
+        return self.LLM <= val <= self.HLM
+
+    def move(self, val=None, relative=False, wait=False, timeout=300.0, **kws):
+        if val is None:
+            return -13
+        val = float(val)
+        if relative:
+            val += self.RBV
+        if not self.within_limits(val):
+            return -12
+        start = self.RBV
+        duration = trapezoid_time(val - start, self.VELO, self.ACCL, self.VBAS)/self._speedup
+        if abs(val - start) <= self.RDBD:
+            self.put('VAL', val)
+            return 1
+        with self._lock:
+            self.put('VAL', val)
+            self.put('DMOV', 0)
+        mover = threading.Thread(target=self._travel, args=(start, val, duration))
+        mover.daemon = True
+        mover.start()
+        if wait:
+            mover.join(timeout)
+        return 1
+
+    def _travel(self, start, end, duration):
+        t0 = time.time()
+        while True:
+            fraction = min(1.0, (time.time() - t0)/duration) if duration else 1.0
+            self.put('RBV', start + (end - start)*fraction)
+            if fraction >= 1.0:
+                break
+            time.sleep(min(0.01, duration))
+        self.put('DMOV', 1)
+
+    def follow(self, distance, duration):
+        """
+        carried along by a trajectory, blocks for duration seconds
+        """
+        start = self.RBV
+        self._travel(start, start + distance, duration/self._speedup)
+        self.put('VAL', start + distance)
+
+
+def sim_frame(shape=(64, 64), background=10.0, spots=5):
+    """
+    Poisson background with a few bright spots
+    """
+    frame = numpy.random.poisson(background, shape)
+    for each in range(spots):
+        row = numpy.random.randint(1, shape[0] - 1)
+        col = numpy.random.randint(1, shape[1] - 1)
+        frame[row - 1:row + 2, col - 1:col + 2] += numpy.random.randint(200, 5000)
+    return numpy.clip(frame, 0, 65535)
+
+
+class SimStruck(SimDevice):
+    """
+    Stand-in for epics.devices.Struck
+
+    Channel 1 counts the 50 MHz clock and the others count a steady rate,
+    binned over NuseAll channel advances.  Acquisition ends when finish()
+    is called with the gate length (by SimBeamline) or on stop().
+    """
+
+    def __init__(self, prefix, rate=1e6, speedup=1.0):
+        """
+        :param prefix: PV prefix, only used for names
+        :param rate: counts per second on the counting channels
+        :param speedup: simulated seconds per real second
+        """
+        defaults = dict(STRUCK_EXTERNAL)
+        defaults['Acquiring'] = 0
+        SimDevice.__init__(self, prefix, defaults=defaults)
+        self._rate = rate
+        self._speedup = speedup
+        self._started = None
+        self._data = {}
+
+    def start(self):
+        self._data = {}
+        self._started = time.time()
+        self.put('Acquiring', 1)
+
+    def stop(self):
+        if self.Acquiring:
+            self.finish((time.time() - self._started)*self._speedup)
+
+    def acquiring(self):
+        return bool(self.Acquiring)
+
+    def finish(self, seconds):
+        """
+        end acquisition after a gate of seconds
+        """
+        bins = max(1, int(self.NuseAll))
+        width = seconds/bins
+        self._data = {1: numpy.array([int(width*CLOCK)]*bins)}
+        for channel in range(2, 9):
+            self._data[channel] = numpy.random.poisson(self._rate*width, bins)
+        self.put('Acquiring', 0)
+
+    def readmca(self, nmca=1, **kws):
+        bins = max(1, int(self.NuseAll))
+        return self._data.get(nmca, numpy.zeros(bins, dtype=int))
+
+
+class SimDetector(SimDevice):
+    """
+    Stand-in for an areaDetector cam that writes TIFF files
+
+    Acquire = 1 exposes until Acquire = 0 is put, the gate from a
+    trajectory closes (external trigger modes) or NumImages periods have
+    passed (internal trigger), then reads out and writes NumImages files
+    FileName_NNN.tif into FilePath_RBV.
+    """
+
+    def __init__(self, prefix, attrs=(), path=None, readout=0.1, speedup=1.0, shape=(64, 64)):
+        """
+        :param prefix: PV prefix, only used for names
+        :param attrs: field names created up front
+        :param path: folder files are written to
+        :param readout: seconds to read out one frame
+        :param speedup: divide simulated times by this
+        :param shape: frame size in pixels
+        """
+        SimDevice.__init__(self, prefix, attrs, defaults={
+            'Acquire': 0, 'DetectorState_RBV': 0, 'TriggerMode': 0,
+            'NumImages': 1, 'AcquireTime': 1.0, 'AcquirePeriod': 1.0,
+            'ShutterMode': 1, 'FilePath_RBV': path or tempfile.gettempdir(),
+            'FileName': 'sim', 'FileNumber': 1, 'AutoIncrement': 1,
+            'FullFileName_RBV': ''})
+        self._readout = readout
+        self._speedup = speedup
+        self._shape = shape
+        self._gate = threading.Event()
+        self._exposing = False
+        self._listeners = []
+        self._files = 0
+
+    def put(self, attr, value, wait=False, **kws):
+        if attr != 'Acquire':
+            return SimDevice.put(self, attr, value, wait=wait)
+        if value and not self._exposing:
+            self._exposing = True
+            self._gate.clear()
+            SimDevice.put(self, 'DetectorState_RBV', 1)
+            SimDevice.put(self, 'Acquire', 1)
+            worker = threading.Thread(target=self._expose)
+            worker.daemon = True
+            worker.start()
+        elif not value and self._exposing:
+            self._gate.set()
+        return 1
+
+    def end_gate(self):
+        self._gate.set()
+
+    def add_listener(self, listener):
+        """
+        :param listener: called with the exposure length when it ends
+        """
+        self._listeners.append(listener)
+
+    def _expose(self):
+        t0 = time.time()
+        frames = max(1, int(self.NumImages))
+        if self.TriggerMode:
+            self._gate.wait()
+        else:
+            self._gate.wait(frames*self.AcquirePeriod/self._speedup)
+        seconds = (time.time() - t0)*self._speedup
+        for listener in self._listeners:
+            listener(seconds)
+        SimDevice.put(self, 'DetectorState_RBV', 2)
+        time.sleep(frames*self._readout/self._speedup)
+        number = int(self.FileNumber)
+        for each in range(frames):
+            name = self.FileName + '_' + str(number).zfill(3) + '.tif'
+            full_name = os.path.join(self.FilePath_RBV, name)
+            with open(full_name, 'wb') as tif:
+                tif.write(tiff_bytes(sim_frame(self._shape)))
+            self._files += 1
+            SimDevice.put(self, 'FullFileName_RBV', full_name)
+            number += 1
+        if self.AutoIncrement:
+            SimDevice.put(self, 'FileNumber', number)
+        self._exposing = False
+        SimDevice.put(self, 'DetectorState_RBV', 0)
+        SimDevice.put(self, 'Acquire', 0)
+
+
+class FakeFTP:
+    """
+    In-process stand-in for an ftplib.FTP session to a FakeXPSServer
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.folder = ''
+
+    def cwd(self, folder):
+        self.folder = folder
+
+    def nlst(self):
+        with self.server.lock:
+            return sorted(self.server.files)
+
+    def storlines(self, command, source):
+        name = command.split(' ', 1)[1]
+        with self.server.lock:
+            self.server.files[name] = source.read()
+            self.server.uploads += 1
+
+    def quit(self):
+        pass
+
+
+class FakeXPSHandler(SocketServer.BaseRequestHandler):
+    """
+    Answers XPS_Q8_drivers commands the way the controller does
+
+    Every command is acknowledged with error code 0 unless a canned reply
+    is listed in the server's replies dict (keyed by function name).  A
+    function listed in the server's actions dict is called with the
+    command arguments first, and may return a reply of its own.
+    """
+
+    def handle(self):
+        server = self.server
+        time.sleep(server.connect_delay)
+        with server.lock:
+            server.connects += 1
+        buf = ''
+        while True:
+            try:
+                data = self.request.recv(1024)
+            except IOError:
+                return
+            if not data:
+                return
+            buf += data
+            # driver sends exactly one command and waits for the reply
+            while ')' in buf:
+                command, buf = buf.split(')', 1)
+                name, args = (command + '(').split('(')[:2]
+                name = name.strip()
+                with server.lock:
+                    server.commands.append(name)
+                time.sleep(server.command_delay)
+                reply = server.replies.get(name, '0,')
+                action = server.actions.get(name)
+                if action is not None:
+                    reply = action(args.split(',')) or reply
+                self.request.sendall(reply + 'EndOfAPI')
+
+
+class FakeXPSServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    In-process XPS look-alike listening on localhost
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0.0, command_delay=0.0,
+                 ftp_delay=0.0):
+        """
+        :param host: address to bind
+        :param port: port to bind, 0 picks a free one
+        :param connect_delay: seconds spent setting up each new client
+        :param command_delay: seconds spent on each command
+        :param ftp_delay: seconds spent opening each FTP session
+        :return: instance of FakeXPSServer
+        """
+        SocketServer.TCPServer.__init__(self, (host, port), FakeXPSHandler)
+        self.connect_delay = connect_delay
+        self.command_delay = command_delay
+        self.ftp_delay = ftp_delay
+        self.connects = 0
+        self.commands = []
+        self.actions = {}
+        # trajectory files uploaded through ftp()
+        self.files = {}
+        self.uploads = 0
+        self.lock = threading.Lock()
+        self.replies = {
+            'ElapsedTimeGet': '0,1.0,',
+            'GroupStatusGet': '0,12,',
+            'EventExtendedGet': '0,Always;M.PVT.TrajectoryStart,GPIO3.DO.DOSet,'}
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def ftp(self, ip=None, user=None, passwd=None):
+        """
+        ftplib.FTP look-alike, for TrajectoryStore(ftp=server.ftp)
+        """
+        time.sleep(self.ftp_delay)
+        return FakeFTP(self)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SimBeamline:
+    """
+    SimBeamline builds and wires the simulated hardware of one station
+
+    motor(), pv(), device() and struck() take the place of epics.Motor,
+    epics.PV, epics.Device and epics.devices.Struck.  Trajectories run on
+    the fake XPS carry the group M positioners along, then close the
+    Struck and detector gates.
+    """
+
+    def __init__(self, path=None, speedup=1.0, xps_delay=0.0, ftp_delay=0.0):
+        """
+        :param path: folder the detector writes to, a temporary one if not given
+        :param speedup: run everything this many times faster than real time
+        :param xps_delay: seconds the fake XPS spends on each command
+        :param ftp_delay: seconds the fake XPS spends opening an FTP session
+        :return: instance of SimBeamline
+        """
+        self.path = path or tempfile.mkdtemp(prefix='sxd_sim_')
+        self.speedup = speedup
+        self.motors = {}
+        self.pvs = {}
+        self.devices = {}
+        self.mcs = None
+        self.detector = None
+        self.positioners = {}
+        self.pulse = (1, 1, 1.0)
+        self.xps = FakeXPSServer(command_delay=xps_delay, ftp_delay=ftp_delay)
+        self.xps.actions['MultipleAxesPVTPulseOutputSet'] = self.pulse_set
+        self.xps.actions['MultipleAxesPVTExecution'] = self.execute
+        self.xps.start()
+        self.xps_ip, self.xps_port = self.xps.address
+
+    def motor(self, name):
+        if name not in self.motors:
+            position, velo, accl, llm, hlm = SIM_MOTORS.get(name, (0.0, 1.0, 0.25, -100.0, 100.0))
+            self.motors[name] = SimMotor(name, position, velo, accl, llm=llm, hlm=hlm,
+                                         speedup=self.speedup)
+        return self.motors[name]
+
+    def pv(self, name):
+        if name not in self.pvs:
+            self.pvs[name] = SimPV(name)
+        return self.pvs[name]
+
+    def device(self, prefix, attrs=()):
+        if prefix not in self.devices:
+            if prefix.endswith('cam1:'):
+                self.detector = SimDetector(prefix, attrs, self.path, SIM_READOUT.get(prefix, 0.1),
+                                            self.speedup)
+                self.detector.add_listener(self.exposure_done)
+                self.devices[prefix] = self.detector
+            else:
+                self.devices[prefix] = SimDevice(prefix, attrs)
+        return self.devices[prefix]
+
+    def struck(self, prefix):
+        if self.mcs is None:
+            self.mcs = SimStruck(prefix, speedup=self.speedup)
+        return self.mcs
+
+    def ftp(self, ip=None, user=None, passwd=None):
+        return self.xps.ftp(ip, user, passwd)
+
+    def group(self, positioners):
+        """
+        :param positioners: dict of place in group M: SimMotor, None places are left out
+        """
+        self.positioners = dict((place, motor) for place, motor in positioners.items()
+                                if place is not None)
+
+    def pulse_set(self, args):
+        self.pulse = (int(args[1]), int(args[2]), float(args[3]))
+
+    def execute(self, args):
+        """
+        run an uploaded trajectory, blocking like the controller does
+        """
+        rows = [[float(value) for value in line.split(',')]
+                for line in self.xps.files.get(args[1].strip(), '').splitlines() if line]
+        if not rows:
+            # ERR_READING_FILE
+            return '-61,'
+        durations = [row[0] for row in rows]
+        movers = []
+        for place, motor in self.positioners.items():
+            distance = sum(row[2*place - 1] for row in rows)
+            if motor.DIR:
+                distance = -distance
+            movers.append(threading.Thread(target=motor.follow, args=(distance, sum(durations))))
+        for mover in movers:
+            mover.start()
+        if not movers:
+            time.sleep(sum(durations)/self.speedup)
+        for mover in movers:
+            mover.join()
+        first, last, period = self.pulse
+        if self.mcs is not None and self.mcs.acquiring():
+            self.mcs.finish(sum(durations[first - 1:last]))
+        if self.detector is not None:
+            self.detector.end_gate()
+
+    def exposure_done(self, seconds):
+        # stepper scans have no trajectory, the exposure is the gate
+        if self.mcs is not None and self.mcs.acquiring():
+            self.mcs.finish(seconds)
+
+    def close(self):
+        self.xps.stop()
@@ -0,0 +1,160 @@
+__author__ = 'j.smith'
+
+'''
+Per-phase timing of a collection run, saved as a Chrome trace
+
+Each phase of a routine is wrapped in tracer.span('phase'), which
+records a complete ('X') event.  save() writes the run as JSON that
+chrome://tracing and ui.perfetto.dev open directly, and summary() says
+where the dead time between exposures went.
+'''
+
+import json
+import threading
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# best monotonic clock Python 2 offers (QueryPerformanceCounter on Windows)
+clock = timeit.default_timer
+
+# phases that count as collecting data, everything else is dead time
+EXPOSURE_PHASES = ('pvt execution', 'exposure move')
+
+
+class Tracer:
+    """
+    Tracer collects timed spans from any thread for one run at a time
+    """
+
+    def __init__(self, process='HPCAT SXD'):
+        """
+        :param process: process name shown in the trace viewer
+        :return: instance of Tracer
+        """
+        self.process = process
+        self.lock = threading.Lock()
+        self.begin()
+
+    def begin(self):
+        """
+        forget the previous run and start the clock for a new one
+        """
+        with self.lock:
+            self.events = []
+            self.threads = {}
+            self.t0 = clock()
+            self.t_end = None
+
+    def end(self):
+        with self.lock:
+            self.t_end = clock()
+
+    def add(self, name, start, stop, args=None):
+        """
+        record a span measured elsewhere (clock() values)
+        """
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append((name, start - self.t0, stop - start, thread.ident, args))
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        time the body of a with block as one phase
+        :param name: phase name, spans of the same name are summed up
+        :param args: extra values shown with the span in the viewer
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, start, clock(), args or None)
+
+    def chrome_events(self):
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+                  'args': {'name': self.process}}]
+        for ident, thread_name in threads.items():
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                          'tid': ident, 'args': {'name': thread_name}})
+        for name, start, duration, ident, args in events:
+            event = {'name': name, 'cat': 'scan', 'ph': 'X', 'pid': 1, 'tid': ident,
+                     'ts': round(start*1e6, 1), 'dur': round(duration*1e6, 1)}
+            if args:
+                event['args'] = args
+            trace.append(event)
+        return trace
+
+    def save(self, path):
+        """
+        write the run as a Chrome trace (JSON object format)
+        """
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms'},
+                      trace_file)
+
+    def mark(self):
+        """
+        :return: bookmark for totals(since=...), e.g. taken before a scan
+        """
+        with self.lock:
+            return len(self.events)
+
+    def totals(self, since=0):
+        """
+        :param since: mark() value, only spans recorded after it are counted
+        :return: OrderedDict of phase: (count, seconds), largest first
+        """
+        totals = {}
+        with self.lock:
+            for name, start, duration, ident, args in self.events[since:]:
+                count, seconds = totals.get(name, (0, 0.0))
+                totals[name] = (count + 1, seconds + duration)
+        return OrderedDict(sorted(totals.items(), key=lambda item: -item[1][1]))
+
+    def summary(self):
+        """
+        :return: text table of phases with their share of the dead time
+        """
+        totals = self.totals()
+        wall = (self.t_end or clock()) - self.t0
+        exposure = sum(seconds for name, (count, seconds) in totals.items()
+                       if name in EXPOSURE_PHASES)
+        dead = max(wall - exposure, 0.0)
+        lines = ['Run %.2f s, collecting %.2f s, dead time %.2f s (%.1f %%)' % (
+                 wall, exposure, dead, 100*dead/wall if wall else 0.0),
+                 '%-18s %6s %10s %8s' % ('Phase', 'Count', 'Total (s)', 'Dead %')]
+        traced = 0.0
+        for name, (count, seconds) in totals.items():
+            if name in EXPOSURE_PHASES:
+                share = '-'
+            else:
+                traced += seconds
+                share = '%.1f' % (100*seconds/dead if dead else 0.0)
+            lines.append('%-18s %6d %10.3f %8s' % (name, count, seconds, share))
+        # spans on other threads may overlap, so this is only a rough rest
+        lines.append('%-18s %6s %10.3f' % ('(untraced)', '', max(dead - traced, 0.0)))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import time
+    tracer = Tracer()
+    for each in range(3):
+        with tracer.span('prep move'):
+            time.sleep(0.02)
+        with tracer.span('pvt execution', image=each + 1):
+            time.sleep(0.1)
+        with tracer.span('readout wait'):
+            time.sleep(0.01)
+    tracer.end()
+    path = os.path.join(tempfile.gettempdir(), 'sxd_trace_demo.json')
+    tracer.save(path)
+    print tracer.summary()
+    print 'trace written to', path
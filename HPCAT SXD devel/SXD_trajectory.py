@@ -0,0 +1,274 @@
+__author__ = 'j.smith'
+
+'''
+Build and deliver PVT trajectory files for the XPS controllers
+'''
+
+import ftplib
+import hashlib
+import threading
+import time
+from math import cos, sin, pi
+from StringIO import StringIO
+import numpy
+
+# soller slit rotation offset (mm), GSECARS r = 34.430
+SOLLER_RADIUS = 62.700
+
+
+class TrajectoryStore:
+    """
+    TrajectoryStore uploads trajectories by content, not by name
+
+    Each trajectory is named after a hash of its text, so identical
+    trajectories (e.g. every sub-step of a CCD sweep, which only holds
+    relative deltas) share one file.  The store remembers which names each
+    controller already holds and only opens an FTP session when a new
+    trajectory actually has to be sent.
+    """
+
+    def __init__(self, user='Administrator', passwd='Administrator',
+                 remote_dir='Public/Trajectories/', ftp=ftplib.FTP):
+        """
+        :param user: controller FTP user
+        :param passwd: controller FTP password
+        :param remote_dir: trajectory folder on the controller
+        :param ftp: ftplib.FTP replacement, e.g. FakeXPSServer.ftp
+        :return: instance of TrajectoryStore
+        """
+        self.ftp = ftp
+        self.user = user
+        self.passwd = passwd
+        self.remote_dir = remote_dir
+        self.known = {}
+        self.uploads = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def name_for(content):
+        return 'traj_' + hashlib.sha1(content).hexdigest()[:12] + '.trj'
+
+    def publish(self, ip, content):
+        """
+        make sure a trajectory is on the controller
+        :param ip: controller address
+        :param content: full text of the trajectory file
+        :return: file name to pass to MultipleAxesPVTExecution
+        """
+        name = self.name_for(content)
+        with self.lock:
+            if name in self.known.get(ip, ()):
+                self.skipped += 1
+                return name
+            session = self.ftp(ip, user=self.user, passwd=self.passwd)
+            try:
+                session.cwd(self.remote_dir)
+                if ip not in self.known:
+                    # first contact, learn what survived from earlier sessions
+                    self.known[ip] = set(session.nlst())
+                if name in self.known[ip]:
+                    self.skipped += 1
+                else:
+                    session.storlines('STOR ' + name, StringIO(content))
+                    self.known[ip].add(name)
+                    self.uploads += 1
+            finally:
+                session.quit()
+        return name
+
+    def forget(self, ip=None):
+        """
+        drop cached knowledge, e.g. after the controller is rebooted
+        :param ip: controller address, or None for all controllers
+        """
+        with self.lock:
+            if ip is None:
+                self.known = {}
+            else:
+                self.known.pop(ip, None)
+
+
+def pvt_trajectory(width, positioner, segments):
+    """
+    PVT trajectory moving a single positioner of a motion group
+    :param width: number of positioners in the group
+    :param positioner: 1-based position of the moving axis in the group
+    :param segments: list of (duration, displacement, end velocity)
+    :return: trajectory file content
+    """
+    lines = []
+    for duration, displacement, velocity in segments:
+        line = ['0'] * (2*width + 1)
+        line[0] = str(duration)
+        line[2*positioner - 1] = str(displacement)
+        line[2*positioner] = str(velocity)
+        lines.append(','.join(line))
+    return '\n'.join(lines) + '\n'
+
+
+def line_trajectory(zero, start, end, velo, sign, width, positioner):
+    """
+    ramp up, constant velocity, ramp down for one positioner
+    :param zero: position at the start of the ramp up
+    :param start: position where the constant velocity part begins
+    :param end: position where the constant velocity part ends
+    :param velo: constant velocity, same sign as end - start
+    :param sign: -1 if the motor record has DIR set, otherwise 1
+    :param width: number of positioners in the group
+    :param positioner: 1-based position of the axis in the group
+    :return: trajectory file content
+    """
+    delta_xac = sign*(start - zero)
+    delta_xb = sign*(end - start)
+    velo_ab = sign*velo
+    delta_tb = delta_xb/velo_ab
+    return pvt_trajectory(width, positioner, [
+        ('0.525', delta_xac, velo_ab),
+        (delta_tb, delta_xb, velo_ab),
+        ('0.525', delta_xac, 0)])
+
+
+def soller_trajectory(theta_zero, theta_min, theta_max, num_points, time_total, r=SOLLER_RADIUS):
+    """
+    PVT trajectory for the soller slit X/Y/theta stack, all segments at once
+
+    Segment boundaries, X/Y deltas and boundary velocities are computed as
+    arrays in one pass and the CSV text is formatted in one join, so cost
+    grows linearly with num_points.
+    :param theta_zero: theta at the start of the ramp up
+    :param theta_min: theta where the constant velocity sweep begins
+    :param theta_max: theta where the constant velocity sweep ends
+    :param num_points: number of segment boundaries in the sweep
+    :param time_total: duration of the constant velocity sweep
+    :param r: soller rotation offset
+    :return: trajectory file content
+    """
+    # theta_range has to be negative, so min-max instead of max-min
+    theta_range = theta_max - theta_min
+    delta_time = time_total/(num_points - 1)
+    delta_theta = theta_range/(num_points - 1)
+    v_theta = theta_range/time_total
+    rad = pi/180
+    # ramp up from theta_zero to theta_min
+    ramp_up = [-r*(cos(theta_min*rad) - cos(theta_zero*rad)),
+               r*sin(theta_min*rad)*v_theta*rad,
+               -r*(sin(theta_min*rad) - sin(theta_zero*rad)),
+               -r*cos(theta_min*rad)*v_theta*rad,
+               -v_theta*.25*1.5,
+               -v_theta]
+    # every sweep segment, theta_i/theta_f are segment start/end
+    theta_i = theta_min + delta_theta*numpy.arange(num_points - 1)
+    theta_f = theta_i + delta_theta
+    cos_i, sin_i = numpy.cos(theta_i*rad), numpy.sin(theta_i*rad)
+    cos_f, sin_f = numpy.cos(theta_f*rad), numpy.sin(theta_f*rad)
+    run = numpy.empty((num_points - 1, 4))
+    run[:, 0] = -r*(cos_f - cos_i)
+    run[:, 1] = r*sin_f*v_theta*rad
+    run[:, 2] = -r*(sin_f - sin_i)
+    run[:, 3] = -r*cos_f*v_theta*rad
+    # ramp down past theta_max, ending at rest
+    theta_end = theta_min + theta_range
+    theta_final = theta_end + v_theta*0.375
+    ramp_down = [-r*(cos(theta_final*rad) - cos(theta_end*rad)),
+                 -r*(sin(theta_final*rad) - sin(theta_end*rad)),
+                 -v_theta*.25*1.5]
+    zeros = ',0' * 10
+    run_format = ('%.5f' % delta_time) + zeros + ',%.5f,%.5f,%.5f,%.5f,' + \
+        ('%.5f,%.5f' % (-delta_theta, -v_theta))
+    lines = ['0.525' + zeros + ',%.5f,%.5f,%.5f,%.5f,%.5f,%.5f' % tuple(ramp_up)]
+    lines.extend(run_format % tuple(row) for row in run.tolist())
+    lines.append('0.525' + zeros + ',%.5f,0.00000,%.5f,0.00000,%.5f,0.00000' % tuple(ramp_down))
+    return '\n'.join(lines) + '\n'
+
+
+def soller_trajectory_loop(theta_zero, theta_min, theta_max, num_points, time_total, r=SOLLER_RADIUS):
+    """
+    original segment-by-segment generator, kept as the reference for
+    checking soller_trajectory
+    """
+    theta_range = theta_max - theta_min
+    delta_time = time_total/(num_points - 1)
+    delta_theta = theta_range/(num_points - 1)
+    v_theta = theta_range/time_total
+    delta_sx_zero = r * (cos(theta_min * pi / 180) - cos(theta_zero * pi / 180))
+    delta_sy_zero = r * (sin(theta_min * pi / 180) - sin(theta_zero * pi / 180))
+    vx_out_zero = -r*sin(theta_min*pi/180)*v_theta*pi/180
+    vy_out_zero = r*cos(theta_min*pi/180)*v_theta*pi/180
+    delta_theta_zero = v_theta*.25*1.5
+    ramp_line = ['0.525', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
+    ramp_line[11] = '%.5f' % -delta_sx_zero
+    ramp_line[12] = '%.5f' % -vx_out_zero
+    ramp_line[13] = '%.5f' % -delta_sy_zero
+    ramp_line[14] = '%.5f' % -vy_out_zero
+    ramp_line[15] = '%.5f' % -delta_theta_zero
+    ramp_line[16] = '%.5f' % -v_theta
+    temp_line = ','.join(ramp_line)
+    complete_file = temp_line + '\n'
+    run_line = ['0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0', '0']
+    run_line[0] = '%.5f' % delta_time
+    run_line[15] = '%.5f' % -delta_theta
+    run_line[16] = '%.5f' % -v_theta
+    for each in range(num_points - 1):
+        theta_i = theta_min + (delta_theta*each)
+        theta_f = theta_i + delta_theta
+        delta_sx = r*(cos(theta_f*pi/180)-cos(theta_i*pi/180))
+        delta_sy = r*(sin(theta_f*pi/180)-sin(theta_i*pi/180))
+        vx_out = -r*sin(theta_f*pi/180)*v_theta*pi/180
+        vy_out = r*cos(theta_f*pi/180)*v_theta*pi/180
+        run_line[11] = '%.5f' % -delta_sx
+        run_line[12] = '%.5f' % -vx_out
+        run_line[13] = '%.5f' % -delta_sy
+        run_line[14] = '%.5f' % -vy_out
+        temp_line = ','.join(run_line)
+        complete_file += temp_line + '\n'
+    theta_max = theta_min + theta_range
+    theta_final = theta_max + v_theta*0.375
+    delta_theta_final = delta_theta_zero
+    delta_sx_final = r * (cos(theta_final * pi / 180) - cos(theta_max * pi / 180))
+    delta_sy_final = r * (sin(theta_final * pi / 180) - sin(theta_max * pi / 180))
+    ramp_line[11] = '%.5f' % -delta_sx_final
+    ramp_line[12] = '0.00000'
+    ramp_line[13] = '%.5f' % -delta_sy_final
+    ramp_line[14] = '0.00000'
+    ramp_line[15] = '%.5f' % -delta_theta_final
+    ramp_line[16] = '0.00000'
+    temp_line = ','.join(ramp_line)
+    complete_file += temp_line + '\n'
+    return complete_file
+
+
+def compare_soller(num_points, theta_min=-10.0, theta_max=10.0, t_per_deg=1.0):
+    """
+    time both soller generators and check they agree
+    :return: (loop seconds, numpy seconds, worst difference, lines differing)
+    """
+    time_total = (theta_max - theta_min)*t_per_deg
+    theta_zero = theta_min - 1.0/t_per_deg*0.25*1.5
+    args = (theta_zero, theta_min, theta_max, num_points, time_total)
+    t0 = time.time()
+    old = soller_trajectory_loop(*args)
+    t1 = time.time()
+    new = soller_trajectory(*args)
+    t2 = time.time()
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    if len(old_lines) != len(new_lines):
+        raise ValueError('Trajectories differ in length')
+    worst = 0.0
+    differ = 0
+    for line_a, line_b in zip(old_lines, new_lines):
+        if line_a != line_b:
+            differ += 1
+            for a, b in zip(line_a.split(','), line_b.split(',')):
+                worst = max(worst, abs(float(a) - float(b)))
+    return t1 - t0, t2 - t1, worst, differ
+
+
+if __name__ == '__main__':
+    print '%8s %10s %10s %10s %8s' % ('points', 'loop (s)', 'numpy (s)', 'max diff', 'lines')
+    for points in (20, 400, 10000):
+        loop_time, numpy_time, worst, differ = compare_soller(points)
+        print '%8d %10.4f %10.4f %10.1e %8d' % (points, loop_time, numpy_time, worst, differ)
+        # the numpy version must round to the same 5 decimal output
+        assert worst <= 1.5e-5
@@ -0,0 +1,266 @@
+__author__ = 'j.smith'
+
+'''
+Long-lived socket sessions to the Newport XPS motion controllers
+
+XPS_Q8_drivers keeps its socket table at class level and every new
+XPS() instance resets that table, so the whole program shares a single
+driver instance held by the pool below.  Each controller (keyed by IP)
+gets one session that stays connected between scans, is health checked
+after sitting idle, and reconnects by itself if the controller drops it.
+
+Only queries are sent again after a dropped socket.  A motion or
+execution command may already be running on the controller, so a
+resend could run a trajectory twice; those raise XPSError instead.
+execute() sends on a second socket of the session, opened with a
+timeout longer than any trajectory, so a long motion is not mistaken
+for a lost controller.
+'''
+
+import threading
+import time
+import XPS_Q8_drivers
+
+# error code XPS_Q8_drivers returns for socket timeouts and socket errors
+TCP_ERROR = -2
+
+# seconds allowed on top of the planned motion of execute()
+EXECUTION_MARGIN = 10.0
+
+# socket timeout of the execution socket, longer than any trajectory
+EXECUTION_TIMEOUT = 3600.0
+
+
+class XPSError(IOError):
+    pass
+
+
+def retry_safe(method):
+    """
+    queries (status, positions, ...) can be sent again, commands cannot
+    """
+    return method.endswith('Get')
+
+
+class XPSSession:
+    """
+    XPSSession holds one open socket to one controller
+
+    Driver methods are reached directly on the session with the socket
+    id left out, e.g. session.GroupStatusGet('M') instead of
+    myxps.GroupStatusGet(socketId, 'M').  A query that fails at the TCP
+    level reconnects and is tried once more, any other call raises.
+    Long motions go through execute() on a socket of their own.
+    """
+
+    def __init__(self, driver, ip, port=5001, timeout=20):
+        """
+        :param driver: shared XPS_Q8_drivers.XPS instance
+        :param ip: controller address
+        :param port: controller port
+        :param timeout: socket timeout in seconds
+        :return: instance of XPSSession
+        """
+        self.driver = driver
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.socket_id = -1
+        # socket for execute() and the timeout it was opened with
+        self.execution_id = -1
+        self.execution_timeout = 0.0
+        self.last_used = 0.0
+        self.connects = 0
+        self.calls = 0
+        self.lock = threading.RLock()
+
+    def open_socket(self, timeout):
+        socket_id = self.driver.TCP_ConnectToServer(self.ip, self.port, timeout)
+        if socket_id == -1:
+            raise XPSError('Unable to connect to XPS at ' + self.ip)
+        self.connects += 1
+        self.last_used = time.time()
+        return socket_id
+
+    def connect(self):
+        """
+        (re)open the session, the execution socket opens on first use
+        """
+        with self.lock:
+            self.close()
+            self.socket_id = self.open_socket(self.timeout)
+
+    def connect_execution(self, timeout):
+        """
+        :param timeout: socket timeout, at least EXECUTION_TIMEOUT
+        """
+        with self.lock:
+            self.close_execution()
+            timeout = max(timeout, EXECUTION_TIMEOUT)
+            self.execution_id = self.open_socket(timeout)
+            self.execution_timeout = timeout
+
+    def close_execution(self):
+        with self.lock:
+            if self.execution_id != -1:
+                self.driver.TCP_CloseSocket(self.execution_id)
+                self.execution_id = -1
+
+    def close(self):
+        with self.lock:
+            self.close_execution()
+            if self.socket_id != -1:
+                self.driver.TCP_CloseSocket(self.socket_id)
+                self.socket_id = -1
+
+    def healthy(self):
+        """
+        cheap round trip on each open socket to confirm it is still usable
+        :return: True if the controller answered
+        """
+        with self.lock:
+            if self.socket_id == -1:
+                return False
+            for socket_id in (self.socket_id, self.execution_id):
+                if socket_id != -1 and self.driver.ElapsedTimeGet(socket_id)[0] != 0:
+                    return False
+            return True
+
+    def call(self, method, *args):
+        return self.send(method, args)
+
+    def execute(self, seconds, method, *args):
+        """
+        motion or execution command that takes a while to reply, sent
+        on the execution socket and never sent twice
+        :param seconds: planned length of the motion
+        :raise XPSError: if the socket was lost or timed out
+        """
+        timeout = seconds + EXECUTION_MARGIN
+        with self.lock:
+            if self.execution_id == -1 or self.execution_timeout < timeout:
+                self.connect_execution(timeout)
+            reply = getattr(self.driver, method)(self.execution_id, *args)
+            if isinstance(reply, list) and reply[0] == TCP_ERROR:
+                self.close_execution()
+                raise XPSError('%s to XPS at %s got no reply, not resent' % (method, self.ip))
+            self.calls += 1
+            self.last_used = time.time()
+            return reply
+
+    def send(self, method, args):
+        """
+        :raise XPSError: if a command other than a query lost its socket
+        """
+        with self.lock:
+            if self.socket_id == -1:
+                self.connect()
+            function = getattr(self.driver, method)
+            reply = function(self.socket_id, *args)
+            if isinstance(reply, list) and reply[0] == TCP_ERROR:
+                if not retry_safe(method):
+                    # it may be running on the controller, never send it twice
+                    self.close()
+                    raise XPSError('%s to XPS at %s got no reply, not resent' % (method, self.ip))
+                # controller dropped us (reboot, idle timeout), try once more
+                self.connect()
+                reply = function(self.socket_id, *args)
+            self.calls += 1
+            self.last_used = time.time()
+            return reply
+
+    def __getattr__(self, method):
+        driver = self.__dict__.get('driver')
+        if method.startswith('_') or not hasattr(driver, method):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+
+class XPSPool:
+    """
+    XPSPool hands out one persistent XPSSession per controller IP
+    """
+
+    def __init__(self, port=5001, timeout=20, idle_check=30.0):
+        """
+        :param port: controller port
+        :param timeout: socket timeout in seconds
+        :param idle_check: seconds idle before a session is health checked
+        :return: instance of XPSPool
+        """
+        self.driver = XPS_Q8_drivers.XPS()
+        self.port = port
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, ip):
+        """
+        get the open session for a controller, (re)connecting as needed
+        :param ip: controller address
+        :return: XPSSession
+        """
+        with self.lock:
+            if ip not in self.sessions:
+                self.sessions[ip] = XPSSession(self.driver, ip, self.port, self.timeout)
+            xps = self.sessions[ip]
+        with xps.lock:
+            if xps.socket_id == -1:
+                xps.connect()
+            elif time.time() - xps.last_used > self.idle_check and not xps.healthy():
+                xps.connect()
+        return xps
+
+    def stats(self):
+        return dict((ip, {'connects': s.connects, 'calls': s.calls})
+                    for ip, s in self.sessions.items())
+
+    def close_all(self):
+        with self.lock:
+            for xps in self.sessions.values():
+                xps.close()
+            self.sessions = {}
+
+
+def benchmark(scans=200, connect_delay=0.005):
+    """
+    compare a new socket per scan against a pooled session using the
+    fake XPS server from SXD_sim (no controller needed)
+    :param scans: number of simulated scans
+    :param connect_delay: seconds the fake controller spends per new client
+    :return: dict of total times in seconds
+    """
+    from SXD_sim import FakeXPSServer
+    server = FakeXPSServer(connect_delay=connect_delay)
+    server.start()
+    ip, port = server.address
+    try:
+        # old way, one connection per scan
+        t0 = time.time()
+        for each in range(scans):
+            myxps = XPS_Q8_drivers.XPS()
+            socket_id = myxps.TCP_ConnectToServer(ip, port, 20)
+            myxps.MultipleAxesPVTPulseOutputSet(socket_id, 'M', 2, 3, 1.0)
+            myxps.MultipleAxesPVTExecution(socket_id, 'M', 'traj.trj', 1)
+            myxps.TCP_CloseSocket(socket_id)
+        per_scan = time.time() - t0
+        # pooled session
+        pool = XPSPool(port=port)
+        t0 = time.time()
+        for each in range(scans):
+            xps = pool.session(ip)
+            xps.MultipleAxesPVTPulseOutputSet('M', 2, 3, 1.0)
+            xps.MultipleAxesPVTExecution('M', 'traj.trj', 1)
+        pooled = time.time() - t0
+        connects = pool.stats()[ip]['connects']
+        pool.close_all()
+    finally:
+        server.stop()
+    return {'per_scan': per_scan, 'pooled': pooled, 'pooled_connects': connects}
+
+
+if __name__ == '__main__':
+    results = benchmark()
+    print 'socket per scan: %.3f s' % results['per_scan']
+    print 'pooled session:  %.3f s (%d connect)' % (results['pooled'], results['pooled_connects'])